@@ -16,7 +16,10 @@ jupyter nbconvert --to=script --FilesWriter.build_directory=scripts/ notebooks/*
 cd scripts/ || exit
 
 python 0.update_file_structure.py --HPC True
-python 1.make_z-stack_images.py
+# build the z-stacks for each plate (well-sites are processed in parallel within a plate)
+for plate in NF0014 NF0016 NF0018; do
+    python 1.make_z-stack_images.py --plate "$plate"
+done
 
 cd .. || exit
 
@@ -2,27 +2,33 @@
 # coding: utf-8
 
 # # Copy raw images into one folder to use for CellProfiler processing
-# 
-# Currently, the images are located nest deep within multiple folders. 
+#
+# Currently, the images are located nest deep within multiple folders.
 # For best practices, we will copy the images (preserving metadata) to one folder that can be used for CellProfiler processing.
+# To avoid extra copies of large plates, the images can instead be staged with hardlinks, reflinks or symlinks using `--mode`.
+# With `--build_zstacks`, the z-stack images are written straight from the nested folders, and `--no_copy` skips the flattened copy so each z-slice is only read once.
+# With `--hash --verify`, the copied images are checked against the hashes in the plate manifest after the copy.
+# With `--thumbnails`, a pyramid of downsampled thumbnails of every raw image is cached (see `utils/thumbnails.py`), which the QC notebooks read to display outliers instead of the full resolution images.
 # This file is modified from its original version: https://github.com/WayScience/GFF_2D_organoid_prototyping .
 
 # ## Import libraries
 
-# In[1]:
+# In[ ]:
 
 
 import argparse
 import pathlib
-import shutil
 import sys
 
-import tqdm
-
+sys.path.append("../../utils")
+import ingest
+import thumbnails
+import zstack
+from image_catalog import ImageCatalog
 
 # ## Set paths and variables
 
-# In[2]:
+# In[ ]:
 
 
 argparse = argparse.ArgumentParser(
@@ -31,15 +37,67 @@ argparse = argparse.ArgumentParser(
 argparse.add_argument(
     "--HPC", type=bool, default=False, help="Type of compute to run on (default: False)"
 )
+argparse.add_argument(
+    "--workers",
+    type=int,
+    default=8,
+    help="Number of threads used to copy images (default: 8)",
+)
+argparse.add_argument(
+    "--hash",
+    action="store_true",
+    help="Compute a hash for each copied image to verify transfers",
+)
+argparse.add_argument(
+    "--verify",
+    action="store_true",
+    help="Check the copied images against the hashes in the plate manifest after copying (use with --hash)",
+)
+argparse.add_argument(
+    "--mode",
+    type=str,
+    default="copy",
+    choices=["copy", "auto", "hardlink", "reflink", "symlink"],
+    help="Stage images with copies or links, where 'auto' picks the best link type per filesystem (default: copy)",
+)
+argparse.add_argument(
+    "--build_zstacks",
+    action="store_true",
+    help="Build the z-stack images straight from the nested acquisition folders",
+)
+argparse.add_argument(
+    "--no_copy",
+    action="store_true",
+    help="Skip the flattened copy of the raw images (use with --build_zstacks)",
+)
+argparse.add_argument(
+    "--thumbnails",
+    action="store_true",
+    help="Cache thumbnails of the raw images for reviewing QC outliers",
+)
 
 # Parse arguments
 args = argparse.parse_args(args=sys.argv[1:] if "ipykernel" not in sys.argv[0] else [])
 HPC = args.HPC
+workers = args.workers
+compute_hash = args.hash
+verify = args.verify
+staging_mode = args.mode
+build_zstacks = args.build_zstacks
+no_copy = args.no_copy
+build_thumbnails = args.thumbnails
 
 print(f"HPC: {HPC}")
+print(f"Copy workers: {workers}")
+print(f"Compute hashes: {compute_hash}")
+print(f"Verify copies: {verify}")
+print(f"Staging mode: {staging_mode}")
+print(f"Build z-stacks: {build_zstacks}")
+print(f"Copy raw images: {not no_copy}")
+print(f"Cache thumbnails: {build_thumbnails}")
 
 
-# In[3]:
+# In[ ]:
 
 
 # Define parent and destination directories in a single dictionary
@@ -51,6 +109,7 @@ dir_mapping = {
             else "/pl/active/koala/GFF_Data/GFF-Raw/NF0014-Thawed 3 (Raw image files)-Combined/NF0014-Thawed 3 (Raw image files)-Combined copy"
         ).resolve(strict=True),
         "destination": pathlib.Path("../../data/NF0014_raw_images").resolve(),
+        "zstack": pathlib.Path("../../data/NF0014_zstack_images").resolve(),
     },
     "NF0016": {
         "parent": pathlib.Path(
@@ -59,6 +118,7 @@ dir_mapping = {
             else "/pl/active/koala/GFF_Data/GFF-Raw/NF0016 Cell Painting-Pilot Drug Screening-selected/NF0016-Cell Painting Images/NF0016-images copy"
         ).resolve(strict=True),
         "destination": pathlib.Path("../../data/NF0016_raw_images").resolve(),
+        "zstack": pathlib.Path("../../data/NF0016_zstack_images").resolve(),
     },
     "NF0018": {
         "parent": pathlib.Path(
@@ -67,18 +127,16 @@ dir_mapping = {
             else "/pl/active/koala/GFF_Data/GFF-Raw/NF0018 (T6) Cell Painting-Pilot Drug Screeining-selected/NF0018-Cell Painting Images/NF0018-All Acquisitions"
         ).resolve(strict=True),
         "destination": pathlib.Path("../../data/NF0018_raw_images").resolve(),
+        "zstack": pathlib.Path("../../data/NF0018_zstack_images").resolve(),
     },
 }
 
-# Image extensions that we are looking to copy
-image_extensions = {".tif", ".tiff"}
-
 
 # ## Reach the nested images and copy to one folder
 
 # Run this cell through the script
 
-# In[4]:
+# In[ ]:
 
 
 # Loop through each key in the mapping to copy data from the parent to the destination
@@ -86,26 +144,78 @@ for key, paths in dir_mapping.items():
     parent_dir = paths["parent"]
     dest_dir = paths["destination"]
 
-    print(f"Processing {key}: {parent_dir} -> {dest_dir}")
+    if not no_copy:
+        print(f"Processing {key}: {parent_dir} -> {dest_dir}")
+
+        # Walk the acquisition tree once and copy (or link) only new or changed images (tracked in the plate manifest)
+        summary = ingest.ingest_plate(
+            parent_dir=parent_dir,
+            destination_dir=dest_dir,
+            max_workers=workers,
+            compute_hash=compute_hash,
+            mode=staging_mode,
+        )
+
+        print(
+            f"Completed processing {key}: {summary['copied']} images copied, {summary['skipped']} already up to date"
+        )
+
+        if verify:
+            # Re-hash the copied images (only images that were copied with a hash can be checked)
+            mismatched = ingest.verify_plate(dest_dir)
+            if mismatched:
+                raise RuntimeError(
+                    f"{len(mismatched)} images of {key} are missing or do not match their hash, e.g., {mismatched[:5]}"
+                )
+            print(f"Verified the copied images of {key} against their hashes")
+
+    if build_zstacks:
+        print(f"Stacking {key}: {parent_dir} -> {paths['zstack']}")
+
+        # Stream the z-slices from the acquisition tree into one z-stack per channel for each well-site
+        # (z-slices missing in any channel of a well-site are left out so all channels have the same depth)
+        summary = zstack.build_zstacks_from_acquisition_tree(
+            parent_dir=parent_dir, output_dir=paths["zstack"]
+        )
+
+        print(
+            f"Completed stacking {key}: {summary['written']} z-stacks written, {summary['skipped']} already up to date"
+        )
+
+
+# ## Catalog the copied images and z-stacks
+
+# The catalog (plate/well/site/channel/z-slice per image) is used by the following steps to find their input files without listing the directories again.
+
+# In[ ]:
+
+
+catalog_path = pathlib.Path("../../data/image_catalog.parquet").resolve()
+catalog = ImageCatalog.build(
+    [
+        directory
+        for paths in dir_mapping.values()
+        for directory in (paths["destination"], paths["zstack"])
+        if directory.exists()
+    ],
+    catalog_path,
+)
+print(f"Cataloged {len(catalog.catalog)} images in {catalog_path}")
 
-    # Ensure the destination directory exists
-    dest_dir.mkdir(parents=True, exist_ok=True)
 
-    # Loop through the well-level directories and copy the images
-    for image_file in tqdm.tqdm(parent_dir.rglob("*")):
-        # Get all subdirectories
-        list_of_dirs = list(image_file.rglob("*"))
-        list_of_dirs = [x for x in list_of_dirs if x.is_dir()]
+# ## Cache the thumbnails of the raw images
 
-        for dir in list_of_dirs:
-            # Create the corresponding well directory in the destination
-            well_dir = dest_dir / dir.name
-            well_dir.mkdir(parents=True, exist_ok=True)
+# The thumbnails are keyed by the path and modification time of each image, so only new or changed images are read again.
+# Without `--thumbnails`, the QC notebooks build the thumbnails of the images they display on first access.
 
-            # Copy images that match the allowed extensions
-            for image in dir.rglob("*/*"):
-                if image.suffix.lower() in image_extensions:
-                    shutil.copy2(image, well_dir)
+# In[ ]:
 
-    print(f"Completed processing {key}: {parent_dir} -> {dest_dir}")
 
+if build_thumbnails:
+    thumbnail_dir = pathlib.Path("../../data/thumbnails").resolve()
+    summary = thumbnails.build_thumbnails(
+        catalog.query(kind="raw")["path"], thumbnail_dir, max_workers=workers
+    )
+    print(
+        f"Cached thumbnails: {summary['written']} images written, {summary['skipped']} already up to date"
+    )
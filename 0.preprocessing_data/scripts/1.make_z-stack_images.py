@@ -5,101 +5,174 @@
 
 # ## Import libraries
 
-# In[1]:
+# In[ ]:
 
 
+import argparse
+import os
 import pathlib
+import sys
 
-import numpy as np
-import tifffile as tiff
-import tqdm
-
+sys.path.append("../../utils")
+import zrange
+import zstack
+from image_catalog import ImageCatalog
 
 # ## Set input and output directories
 
-# In[2]:
+# In[ ]:
+
+
+argparse = argparse.ArgumentParser(
+    description="Create z-stack images from the z-slice images of a plate"
+)
+argparse.add_argument(
+    "--plate",
+    type=str,
+    default="NF0014",
+    help="Plate to create z-stacks for (default: NF0014)",
+)
+argparse.add_argument(
+    "--workers",
+    type=int,
+    default=len(os.sched_getaffinity(0)),
+    help="Number of processes used to build well-sites (default: number of CPUs)",
+)
+argparse.add_argument(
+    "--threads",
+    type=int,
+    default=4,
+    help="Number of threads per process used to read z-slices (default: 4)",
+)
+argparse.add_argument(
+    "--memory_budget",
+    type=float,
+    default=16,
+    help="Memory in GiB for z-stacks held in memory across all processes, larger z-stacks are streamed to disk (default: 16)",
+)
+argparse.add_argument(
+    "--format",
+    type=str,
+    default="tiff",
+    choices=["tiff", "zarr"],
+    help="Write one TIFF per channel or one chunked OME-Zarr store per well-site (default: tiff)",
+)
+argparse.add_argument(
+    "--qc",
+    action="store_true",
+    help="Measure the whole image QC metrics of every z-slice while the z-stacks are built",
+)
+
+# Parse arguments
+args = argparse.parse_args(args=sys.argv[1:] if "ipykernel" not in sys.argv[0] else [])
+plate = args.plate
+workers = args.workers
+threads = args.threads
+memory_budget = int(args.memory_budget * 1024**3)
+zstack_format = args.format
+qc = args.qc
+
+print(f"Plate: {plate}")
+print(f"Workers: {workers}")
+print(f"Threads per worker: {threads}")
+print(f"Memory budget: {args.memory_budget} GiB")
+print(f"Z-stack format: {zstack_format}")
+print(f"Measure QC metrics: {qc}")
+
+
+# In[ ]:
+
+
+input_dir = pathlib.Path(f"../../data/{plate}_raw_images").resolve(strict=True)
+
+output_z_stack_dir = pathlib.Path(f"../../data/{plate}_zstack_images").resolve()
+output_z_stack_dir.mkdir(exist_ok=True, parents=True)
 
+# catalog of all images (built when the raw images are copied)
+catalog_path = pathlib.Path("../../data/image_catalog.parquet").resolve()
 
-input_dir = pathlib.Path("../../data/NF0014_raw_images").resolve(strict=True)
-
-output_z_stack_dir = pathlib.Path("../../data/NF0014_zstack_images").resolve()
-output_z_stack_dir.mkdir(exist_ok=True, parents=True)
+# QC metrics measured while building the z-stacks (same columns as the native QC results of 1.image_quality_control)
+quality_path = pathlib.Path(
+    f"../../1.image_quality_control/qc_results/{plate}_native_qc_results.parquet"
+).resolve()
 
 
 # ## Create list of the well-site folders
 
-# In[3]:
+# In[ ]:
 
 
-# get a list of all dirs in the input dir
-input_dirs = [x for x in input_dir.iterdir() if x.is_dir()]
-input_dirs.sort()
-print(f"There are {len(input_dirs)} directories in the input directory.")
+# load the catalog (or build it for the input dir if the plate has not been cataloged yet)
+catalog = ImageCatalog.load(catalog_path) if catalog_path.exists() else None
+if catalog is None or plate not in catalog.plates(kind="raw"):
+    catalog = ImageCatalog.build([input_dir], catalog_path)
 
+# get a list of all well-sites in the input dir
+well_sites = catalog.well_sites(plate, kind="raw")
+print(f"There are {len(well_sites)} directories in the input directory.")
 
-# ## For the NF0014 dataset, remove the files for one of the z-slices due to missing channel (640)
 
-# In[4]:
+# ## Set the channel names
 
+# In[ ]:
 
-# Remove files containing 'ZS000' (first z-slice) in the F11-3 directory because it is missing 640 channel
-for file in pathlib.Path(f'{input_dir}/F11-3').glob('*ZS000*'):
-    file.unlink()
-    print(f"Removed: {file}")
 
+channel_names = ["405", "488", "555", "640", "TRANS"]
+channel_names
 
-# ## Set the dictionary for filenames and filepaths
 
-# In[5]:
+# ## Create z-stack images for each FOV of each well in their respective directories.
 
+# Well-sites are processed in parallel and each z-stack is read into one preallocated array (or streamed to disk if it does not fit in the memory budget).
+# Z-slices that are missing a channel are left out of all channels for that well-site (e.g., ZS000 in F11-3 of NF0014 is missing the 640 channel), so every channel has the same depth.
+# With `--format zarr`, all channels of a well-site are written to one OME-Zarr store with one compressed chunk per channel and z-slice, so the following steps can read single z-slices or channels (see `read_zstack` in `utils/zstack_io.py`).
+# With `--qc`, the whole image QC metrics (blur, saturation and intensity statistics) of every z-slice are measured from the z-slices that are already in memory and saved to the native QC results of the plate, so the image quality control does not need to read the raw images again.
+# Well-sites that are not in the QC results yet are rebuilt even if their z-stacks are up to date.
+
+# In[ ]:
+
+
+summary = zstack.build_zstacks_from_catalog(
+    catalog,
+    plate,
+    output_z_stack_dir,
+    channel_names=channel_names,
+    max_workers=workers,
+    max_threads=threads,
+    memory_budget=memory_budget,
+    output_format=zstack_format,
+    quality_path=quality_path if qc else None,
+)
+print(f"{summary['written']} z-stacks written, {summary['skipped']} already up to date")
+
+
+# ## Find the useful z-range of each well-site
+
+# The z-slices above and below the organoid are out of focus and do not need to be segmented.
+# The focus of each z-slice of the nuclei channel is measured on a downsampled copy and the range of in-focus z-slices is saved next to the z-stacks (`<well-site>_zrange.json`), which the segmentation steps use to skip the other z-slices.
+# Well-sites whose sidecar is newer than their z-stack are up to date and are not read again; the z-range of new or rebuilt z-stacks is computed again.
+
+# In[ ]:
+
+
+zranges = zrange.compute_zranges(
+    [output_z_stack_dir / well_site for well_site in well_sites],
+    channel="405",
+    max_workers=workers,
+)
+kept_slices = sum(well["z_stop"] - well["z_start"] for well in zranges.values())
+total_slices = sum(well["z_count"] for well in zranges.values())
+print(
+    f"{kept_slices} of {total_slices} z-slices are in the useful z-range of {len(zranges)} well-sites"
+)
+
+
+# ## Add the z-stack images to the catalog
+
+# In[ ]:
 
-image_extensions = {".tif", ".tiff"}
-channel_names = ["405", "488", "555", "640", "TRANS"]
-# make a dictionary that contains a list for each channel name, storing both filepath and filename
-channel_images = {channel_name: {"filename": [], "filepath": []} for channel_name in channel_names}
-channel_images
-
-
-# ## Loop thorugh and create z-stack images for each FOV of each well in their respective directories.
-
-# In[6]:
-
-
-for well_dir in tqdm.tqdm(input_dirs):
-    print(f"Processing well_dir: {well_dir.stem}")  # Debug
-    channel_images = {channel_name: {"filepath": []} for channel_name in channel_names}
-    
-    # Get all the images in the directory
-    for filename in well_dir.glob("*"):
-        if filename.suffix in image_extensions:
-            for channel_name in channel_names:
-                if channel_name in filename.name:
-                    channel_images[channel_name]["filepath"].append(filename)
-                    break
-
-    # Iterate through each channel
-    for channel_name in channel_names:
-        # Sort and check filepaths
-        channel_images[channel_name]["filepath"] = sorted(
-            channel_images[channel_name]["filepath"]
-        )
-        if not channel_images[channel_name]["filepath"]:
-            print(f"No files found for channel {channel_name} in {well_dir}. Skipping...")
-            continue
-
-        # Confirm before accessing
-        print(f"Stacking channel {channel_name}")  # Debug
-    
-        # read the image files from the sorted file paths and stack them into a numpy array
-        images_to_stack = np.array(
-            [
-                tiff.imread(filepath)
-                for filepath in channel_images[channel_name]["filepath"]
-            ]
-        )
-        filepath = channel_images[channel_name]["filepath"][0]
-        well = str(filepath.parent).split("/")[-1]
-        output_path = output_z_stack_dir / f"{well}" / f"{well}_{channel_name}.tif"
-        output_path.parent.mkdir(exist_ok=True, parents=True)
-        tiff.imwrite(output_path, images_to_stack)
 
+catalog = ImageCatalog.build([output_z_stack_dir], catalog_path)
+print(
+    f"The catalog contains {len(catalog.query(kind='zstack', plate=plate))} z-stack images for {plate}."
+)
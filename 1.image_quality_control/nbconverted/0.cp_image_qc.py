@@ -2,24 +2,23 @@
 # coding: utf-8
 
 # # Run whole image QC pipeline in CellProfiler
-# 
+#
 # To determine if there are images that of poor quality, we run a CellProfiler pipeline specific to extracting image quality metrics.
 # We extract blur and saturation metrics, we can use to identify thresholds for these metrics to separate the good and poor quality images.
-# 
+#
 
 # ## Import libraries
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
 import pprint
-
 import sys
 
 sys.path.append("../../utils")
 import cp_parallel
-
+from image_catalog import ImageCatalog
 
 # ## Set paths and variables
 
@@ -30,20 +29,30 @@ import cp_parallel
 run_name = "quality_control"
 
 # set path for pipeline for whole image QC
-path_to_pipeline = pathlib.Path("../pipeline/whole_image_qc.cppipe").resolve(strict=True)
+# (the images are loaded from a LoadData CSV per plate that is written from one scan of the plate directory,
+# so CellProfiler does not need to list the images and extract their metadata at the start of each run)
+path_to_pipeline = pathlib.Path("../pipeline/whole_image_qc_loaddata.cppipe").resolve(
+    strict=True
+)
 
 # set main output dir for all plates if it doesn't exist
 output_dir = pathlib.Path("../qc_results")
 output_dir.mkdir(exist_ok=True)
 
-# directory where images are located within folders (parent folder is the plate and the child folders are wells containing images)
-images_dir = pathlib.Path("../data/raw_images").resolve(strict=True)
-
-# list for plate names based on folders to use to create dictionary
-plate_names = []
-# iterate through 0.download_data and append plate names from folder names that contain image data from that plate
-for file_path in images_dir.iterdir():
-    plate_names.append(str(file_path.stem.split("_")[0]))
+# catalog of all images (parent folder is the plate and the child folders are wells containing images)
+# used to find the plates without walking the image directories
+# (built during ingest, or here from the raw image directories if it does not exist yet)
+catalog_path = pathlib.Path("../../data/image_catalog.parquet").resolve()
+if catalog_path.exists():
+    catalog = ImageCatalog.load(catalog_path)
+else:
+    catalog = ImageCatalog.build(
+        pathlib.Path("../../data").resolve(strict=True).glob("*_raw_images"),
+        catalog_path,
+    )
+
+# list for plate names based on the raw images in the catalog to use to create dictionary
+plate_names = catalog.plates(kind="raw")
 
 print("There are a total of", len(plate_names), "plates. The names of the plates are:")
 for plate in plate_names:
@@ -52,13 +61,13 @@ for plate in plate_names:
 
 # ## Generate dictionary with plate info to run CellProfiler
 
-# In[3]:
+# In[ ]:
 
 
 # create plate info dictionary with all parts of the CellProfiler CLI command
 plate_info_dictionary = {
     name: {
-        "path_to_images": pathlib.Path(list(images_dir.rglob(f"{name}_raw_images"))[0]).resolve(
+        "path_to_images": catalog.plate_directory(name, kind="raw").resolve(
             strict=True
         ),
         "path_to_output": pathlib.Path(f"{output_dir}/{name}_qc_results"),
@@ -73,10 +82,14 @@ pprint.pprint(plate_info_dictionary, indent=4)
 
 # ## Run QC pipeline in CellProfiler
 
+# Each plate is split into shards of wells so all CPUs are used, and the shard results are merged into one `Image.csv` per plate.
+
 # In[ ]:
 
 
+# split the plates into enough shards to use all of the CPUs (one CellProfiler process per CPU)
 cp_parallel.run_cellprofiler_parallel(
-    plate_info_dictionary=plate_info_dictionary, run_name=run_name
+    plate_info_dictionary=plate_info_dictionary,
+    run_name=run_name,
+    shards_per_plate=None,
 )
-
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Measure whole image QC metrics without CellProfiler
+#
+# The whole image QC pipeline only uses CellProfiler to measure blur (`PowerLogLogSlope`) and saturation (`PercentMaximal`/`PercentMinimal`) with the `MeasureImageQuality` module.
+# In this notebook, we measure the same metrics with NumPy and SciPy (see `utils/image_quality.py`), with batched FFTs over the z-slices of each well-site and one process per well-site.
+# The results have the same columns as the `Image.csv` from CellProfiler and are saved as one Parquet file per plate.
+# When the CellProfiler results of a plate exist, the metrics are compared to validate that they match.
+
+# ## Import libraries
+
+# In[ ]:
+
+
+import os
+import pathlib
+import sys
+
+sys.path.append("../../utils")
+import image_quality
+from image_catalog import ImageCatalog
+
+# ## Set paths and variables
+
+# In[ ]:
+
+
+# set main output dir for all plates if it doesn't exist
+output_dir = pathlib.Path("../qc_results")
+output_dir.mkdir(exist_ok=True)
+
+# catalog of all images, used to find the z-slices of each well-site without walking the image directories
+# (built during ingest, or here from the raw image directories if it does not exist yet)
+catalog_path = pathlib.Path("../../data/image_catalog.parquet").resolve()
+if catalog_path.exists():
+    catalog = ImageCatalog.load(catalog_path)
+else:
+    catalog = ImageCatalog.build(
+        pathlib.Path("../../data").resolve(strict=True).glob("*_raw_images"),
+        catalog_path,
+    )
+
+# list for plate names based on the raw images in the catalog
+plate_names = catalog.plates(kind="raw")
+
+# one process per CPU to measure the well-sites in parallel
+num_cpus = len(os.sched_getaffinity(0))
+
+print("There are a total of", len(plate_names), "plates. The names of the plates are:")
+for plate in plate_names:
+    print(plate)
+
+
+# ## Measure the QC metrics for each plate
+
+# In[ ]:
+
+
+for plate in plate_names:
+    plate_metrics = image_quality.measure_plate(
+        catalog=catalog,
+        plate=plate,
+        output_path=output_dir / f"{plate}_native_qc_results.parquet",
+        max_workers=num_cpus,
+    )
+    print(f"Measured {len(plate_metrics)} image sets for {plate}")
+
+    # compare with the CellProfiler results of the plate if they exist
+    image_csv_path = output_dir / f"{plate}_qc_results" / "Image.csv"
+    if image_csv_path.exists():
+        print(image_quality.compare_to_cellprofiler(plate_metrics, image_csv_path))
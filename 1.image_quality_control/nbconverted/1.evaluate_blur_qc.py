@@ -2,40 +2,44 @@
 # coding: utf-8
 
 # # Whole image quality control metric evaluation - Blur
-# 
+#
 # In this notebook, we will use the outputted QC metrics per image (every z-slice per channel) to start working on developing thresholds using z-score to flag images during CellProfiler processing.
 # We are loading in the results from the preliminary data (across three patients) to attempt to develop generalizable thresholds.
 # This data is 3D, so we are decide if it make sense to remove a whole organoid based on if one z-slice fails.
-# 
+#
 # ## Blurry image detection
-# 
+#
 # For detecting poor quality images based on blur, we use the feature `PowerLogLogSlope`, where more negative values indicate blurry images.
 # We first create distribution plots per plates and per channel to evaluate if the distributions across channels are different.
 # We will use this to determine if we process the data with all channels combined or separately.
-# 
+#
 # We will use a method called `coSMicQC`, which takes a feature of interest and detect outliers based on z-scoring and how far from the mean that outliers will be.
+# The same z-score logic is applied to all channels in one pass (see `utils/qc_flags.py`), with the thresholds per channel in the QC config that `3.flag_image_qc` uses to flag the z-slices.
 
 # ## Import libraries
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
-import pandas as pd
-import cosmicqc
-import cv2
+import sys
+
 import matplotlib.pyplot as plt
+import pandas as pd
 import seaborn as sns
-import re
 
+sys.path.append("../../utils")
+import qc_flags
+import qc_results
+import thumbnails
 
 # ## Set paths and variables
 
-# In[2]:
+# In[ ]:
 
 
-# Set the threshold for identifying outliers with z-scoring for all metrics (# of standard deviations away from mean)
-threshold_z = 2
+# QC config with the z-score threshold per channel for blur (see utils/qc_flags.py)
+blur_config = {"Blurry": qc_flags.QC_CONFIG["Blurry"]}
 
 # Directory for figures to be outputted
 figure_dir = pathlib.Path("../qc_figures")
@@ -44,16 +48,19 @@ figure_dir.mkdir(exist_ok=True)
 # Directory containing the QC results
 qc_results_dir = pathlib.Path("../qc_results")
 
+# Directory with the cached thumbnails of the z-slice images (built during ingest or on first access)
+thumbnail_dir = pathlib.Path("../../data/thumbnails")
+
 # Find all Image.csv files for all plates using glob
 image_csv_paths = qc_results_dir.glob("*/Image.csv")
 
-# Path to the template pipeline file to update with proper thresholds for flagging
-pipeline_path = pathlib.Path("../pipeline/template_flag_pipeline.cppipe")
+# Convert the Image.csv files to Parquet in parallel (only the ones that changed since the last conversion)
+image_parquet_paths = qc_results.convert_image_csvs(image_csv_paths)
 
 
 # ## Load in QC results per plate and combine
 
-# In[3]:
+# In[ ]:
 
 
 # Define prefixes for columns to select
@@ -66,20 +73,10 @@ prefixes = (
 
 # Load and concatenate the data for all plates
 qc_dfs = []
-for path in image_csv_paths:
+for path in image_parquet_paths:
     # Load only the required columns by filtering columns with specified prefixes
-    plate_df = pd.read_csv(path, usecols=lambda col: col.startswith(prefixes))
-    
-    # Check for NaNs in the Metadata_Plate, Metadata_Well, and Metadata_Site columns
-    if plate_df[["Metadata_Plate", "Metadata_Well", "Metadata_Site"]].isna().any().any():
-        print(f"NaNs detected in {path} in Metadata_Plate, Metadata_Well, or Metadata_Site columns")
-    
-    # Fill NaNs for specific conditions
-    if "NF0018_qc_results" in str(path):
-        plate_df["Metadata_Plate"] = plate_df["Metadata_Plate"].fillna("NF0018")
-        plate_df["Metadata_Well"] = plate_df["Metadata_Well"].fillna("E5")
-        plate_df["Metadata_Site"] = plate_df["Metadata_Site"].fillna(3)
-    
+    # (metadata that is known to be missing for a plate is filled in, see utils/qc_results.py)
+    plate_df = qc_results.read_image_qc(path, prefixes)
     qc_dfs.append(plate_df)
 
 
@@ -160,27 +157,21 @@ plt.show()
 
 # ## Detect blur in DNA channel
 
-# In[6]:
+# In[ ]:
 
 
-# Identify metadata columns (columns that do not start with 'ImageQuality')
-metadata_columns = [
-    col for col in concat_qc_df.columns if not col.startswith("ImageQuality")
-]
+# Flag the blur outliers of all channels in one pass with the thresholds in the QC config
+blur_labels = qc_flags.label_outliers(concat_qc_df, blur_config)
 
-# Find large nuclei outliers for the current plate
-blur_DNA_outliers = cosmicqc.find_outliers(
-    df=concat_qc_df,
-    metadata_columns=metadata_columns,
-    feature_thresholds={
-        "ImageQuality_PowerLogLogSlope_DNA": -2,
-    },
+# Get the blur outliers in the DNA channel
+blur_DNA_outliers = qc_flags.outliers(
+    concat_qc_df, blur_labels, "Blurry_DNA", blur_config
 )
 
 pd.DataFrame(blur_DNA_outliers)
 
 
-# In[7]:
+# In[ ]:
 
 
 # Combine PathName and FileName columns to construct full paths for DNA
@@ -199,18 +190,16 @@ for idx, row in enumerate(blur_DNA_outliers.itertuples(), start=1):
     # Format the metadata title
     metadata_title = f"{row.Metadata_Plate}_{row.Metadata_Well}-{int(row.Metadata_Site)}_{row.Metadata_Zslice} (Total z-slices: {row.Metadata_zslice_total})"
 
-    # Read the image
-    image = cv2.imread(image_path)
-    if image is None:
+    # Read the thumbnail of the image from the cache (the full resolution image is only read on first access)
+    try:
+        image = thumbnails.read_thumbnail(image_path, thumbnail_dir)
+    except FileNotFoundError:
         print(f"Warning: Could not read image at {image_path}")
         continue
-    image = cv2.cvtColor(
-        image, cv2.COLOR_BGR2RGB
-    )  # Convert from BGR to RGB for proper display
 
     # Add the image to the plot
     plt.subplot(1, 3, idx)  # Use idx for subplot placement
-    plt.imshow(image)
+    plt.imshow(image, cmap="gray")
     plt.title(metadata_title)  # Set the formatted metadata as the title
     plt.axis("off")
 
@@ -221,21 +210,12 @@ plt.show()
 
 # ## Detect blur in Mito channel
 
-# In[8]:
+# In[ ]:
 
 
-# Identify metadata columns (columns that do not start with 'ImageQuality')
-metadata_columns = [
-    col for col in concat_qc_df.columns if not col.startswith("ImageQuality")
-]
-
-# Find large nuclei outliers for the current plate
-blur_Mito_outliers = cosmicqc.find_outliers(
-    df=concat_qc_df,
-    metadata_columns=metadata_columns,
-    feature_thresholds={
-        "ImageQuality_PowerLogLogSlope_Mito": -3,
-    },
+# Get the blur outliers in the Mito channel
+blur_Mito_outliers = qc_flags.outliers(
+    concat_qc_df, blur_labels, "Blurry_Mito", blur_config
 )
 
 pd.DataFrame(blur_Mito_outliers)
@@ -247,7 +227,7 @@ blur_Mito_outliers = blur_Mito_outliers.sort_values(
 blur_Mito_outliers.head()
 
 
-# In[9]:
+# In[ ]:
 
 
 # Combine PathName and FileName columns to construct full paths for Mito
@@ -282,18 +262,16 @@ for idx, row in enumerate(selected_images.itertuples(), start=1):
     # Format the metadata title
     metadata_title = f"{row.Metadata_Plate}_{row.Metadata_Well}-{int(row.Metadata_Site)}_{row.Metadata_Zslice} (Total z-slices: {row.Metadata_zslice_total})"
 
-    # Read the image
-    image = cv2.imread(image_path)
-    if image is None:
+    # Read the thumbnail of the image from the cache (the full resolution image is only read on first access)
+    try:
+        image = thumbnails.read_thumbnail(image_path, thumbnail_dir)
+    except FileNotFoundError:
         print(f"Warning: Could not read image at {image_path}")
         continue
-    image = cv2.cvtColor(
-        image, cv2.COLOR_BGR2RGB
-    )  # Convert from BGR to RGB for proper display
 
     # Add the image to the plot
     plt.subplot(1, 3, idx)  # Use idx for subplot placement
-    plt.imshow(image)
+    plt.imshow(image, cmap="gray")
     plt.title(metadata_title)  # Set the formatted metadata as the title
     plt.axis("off")
 
@@ -304,27 +282,18 @@ plt.show()
 
 # ## Detect blur in ER channel
 
-# In[10]:
-
+# In[ ]:
 
-# Identify metadata columns (columns that do not start with 'ImageQuality')
-metadata_columns = [
-    col for col in concat_qc_df.columns if not col.startswith("ImageQuality")
-]
 
-# Find large nuclei outliers for the current plate
-blur_er_outliers = cosmicqc.find_outliers(
-    df=concat_qc_df,
-    metadata_columns=metadata_columns,
-    feature_thresholds={
-        "ImageQuality_PowerLogLogSlope_ER": -2,
-    },
+# Get the blur outliers in the ER channel
+blur_er_outliers = qc_flags.outliers(
+    concat_qc_df, blur_labels, "Blurry_ER", blur_config
 )
 
 pd.DataFrame(blur_er_outliers).head()
 
 
-# In[11]:
+# In[ ]:
 
 
 # Combine PathName and FileName columns to construct full paths
@@ -361,18 +330,16 @@ for idx, row in enumerate(
     # Format the metadata title
     metadata_title = f"{row.Metadata_Plate}_{row.Metadata_Well}-{int(row.Metadata_Site)}_{row.Metadata_Zslice} (Total z-slices: {row.Metadata_zslice_total})"
 
-    # Read the image
-    image = cv2.imread(image_path)
-    if image is None:
+    # Read the thumbnail of the image from the cache (the full resolution image is only read on first access)
+    try:
+        image = thumbnails.read_thumbnail(image_path, thumbnail_dir)
+    except FileNotFoundError:
         print(f"Warning: Could not read image at {image_path}")
         continue
-    image = cv2.cvtColor(
-        image, cv2.COLOR_BGR2RGB
-    )  # Convert from BGR to RGB for proper display
 
     # Add the image to the plot
     plt.subplot(1, 3, idx)  # Use idx for subplot placement
-    plt.imshow(image)
+    plt.imshow(image, cmap="gray")
     plt.title(metadata_title)
     plt.axis("off")
 
@@ -383,27 +350,18 @@ plt.show()
 
 # ## Detect blur in AGP channel
 
-# In[12]:
-
+# In[ ]:
 
-# Identify metadata columns (columns that do not start with 'ImageQuality')
-metadata_columns = [
-    col for col in concat_qc_df.columns if not col.startswith("ImageQuality")
-]
 
-# Find large nuclei outliers for the current plate
-blur_agp_outliers = cosmicqc.find_outliers(
-    df=concat_qc_df,
-    metadata_columns=metadata_columns,
-    feature_thresholds={
-        "ImageQuality_PowerLogLogSlope_AGP": -2.25,
-    },
+# Get the blur outliers in the AGP channel
+blur_agp_outliers = qc_flags.outliers(
+    concat_qc_df, blur_labels, "Blurry_AGP", blur_config
 )
 
 pd.DataFrame(blur_agp_outliers).head()
 
 
-# In[13]:
+# In[ ]:
 
 
 # Combine PathName and FileName columns to construct full paths
@@ -440,18 +398,16 @@ for idx, row in enumerate(
     # Format the metadata title
     metadata_title = f"{row.Metadata_Plate}_{row.Metadata_Well}-{int(row.Metadata_Site)}_{row.Metadata_Zslice} (Total z-slices: {row.Metadata_zslice_total})"
 
-    # Read the image
-    image = cv2.imread(image_path)
-    if image is None:
+    # Read the thumbnail of the image from the cache (the full resolution image is only read on first access)
+    try:
+        image = thumbnails.read_thumbnail(image_path, thumbnail_dir)
+    except FileNotFoundError:
         print(f"Warning: Could not read image at {image_path}")
         continue
-    image = cv2.cvtColor(
-        image, cv2.COLOR_BGR2RGB
-    )  # Convert from BGR to RGB for proper display
 
     # Add the image to the plot
     plt.subplot(1, 3, idx)  # Use idx for subplot placement
-    plt.imshow(image)
+    plt.imshow(image, cmap="gray")
     plt.title(metadata_title)
     plt.axis("off")
 
@@ -462,27 +418,18 @@ plt.show()
 
 # ## Detect blur in Brightfield channel
 
-# In[14]:
+# In[ ]:
 
 
-# Identify metadata columns (columns that do not start with 'ImageQuality')
-metadata_columns = [
-    col for col in concat_qc_df.columns if not col.startswith("ImageQuality")
-]
-
-# Find large nuclei outliers for the current plate
-blur_brightfield_outliers = cosmicqc.find_outliers(
-    df=concat_qc_df,
-    metadata_columns=metadata_columns,
-    feature_thresholds={
-        "ImageQuality_PowerLogLogSlope_Brightfield": -3,
-    },
+# Get the blur outliers in the Brightfield channel
+blur_brightfield_outliers = qc_flags.outliers(
+    concat_qc_df, blur_labels, "Blurry_Brightfield", blur_config
 )
 
 pd.DataFrame(blur_brightfield_outliers).head()
 
 
-# In[15]:
+# In[ ]:
 
 
 # Combine PathName and FileName columns to construct full paths
@@ -521,18 +468,16 @@ for idx, row in enumerate(
     # Format the metadata title
     metadata_title = f"{row.Metadata_Plate}_{row.Metadata_Well}-{int(row.Metadata_Site)}_{row.Metadata_Zslice} (Total z-slices: {row.Metadata_zslice_total})"
 
-    # Read the image
-    image = cv2.imread(image_path)
-    if image is None:
+    # Read the thumbnail of the image from the cache (the full resolution image is only read on first access)
+    try:
+        image = thumbnails.read_thumbnail(image_path, thumbnail_dir)
+    except FileNotFoundError:
         print(f"Warning: Could not read image at {image_path}")
         continue
-    image = cv2.cvtColor(
-        image, cv2.COLOR_BGR2RGB
-    )  # Convert from BGR to RGB for proper display
 
     # Add the image to the plot
     plt.subplot(1, 3, idx)  # Use idx for subplot placement
-    plt.imshow(image)
+    plt.imshow(image, cmap="gray")
     plt.title(metadata_title)
     plt.axis("off")
 
@@ -541,68 +486,28 @@ plt.tight_layout()
 plt.show()
 
 
-# ## Create parquet file with each plate/well/site combos and boolean for pass/fail blur per channel
-
-# In[16]:
-
-
-# Combine all blur outliers dataframes into a single dataframe
-blur_outliers = pd.concat(
-    [
-        blur_DNA_outliers,
-        blur_Mito_outliers,
-        blur_agp_outliers,
-        blur_brightfield_outliers,
-        blur_er_outliers,
-    ],
-    keys=["DNA", "Mito", "AGP", "Brightfield", "ER"],
-    names=["Channel"],
-).reset_index(level="Channel")
-
-# Create a new dataframe with only Metadata_Plate, Metadata_Well, Metadata_Site, and Metadata_Zslice columns to assign blur flags
-blur_outliers_per_zslice = concat_qc_df[
-    ["Metadata_Plate", "Metadata_Well", "Metadata_Site", "Metadata_Zslice"]
-].drop_duplicates()
-
-# Initialize columns for each channel with False
-for channel in ["DNA", "Mito", "AGP", "Brightfield", "ER"]:
-    blur_outliers_per_zslice[f"Blurry_{channel}"] = False
-
-# Flag the combos for blur detection
-for channel in ["DNA", "Mito", "AGP", "Brightfield", "ER"]:
-    blur_combos = blur_outliers[blur_outliers["Channel"] == channel][
-        ["Metadata_Plate", "Metadata_Well", "Metadata_Site", "Metadata_Zslice"]
-    ].drop_duplicates()
-    blur_outliers_per_zslice.loc[
-        blur_outliers_per_zslice.set_index(
-            ["Metadata_Plate", "Metadata_Well", "Metadata_Site", "Metadata_Zslice"]
-        ).index.isin(
-            blur_combos.set_index(
-                ["Metadata_Plate", "Metadata_Well", "Metadata_Site", "Metadata_Zslice"]
-            ).index
-        ),
-        f"Blurry_{channel}",
-    ] = True
-
-# Reset the index on the unique combos dataframe
-blur_outliers_per_zslice = blur_outliers_per_zslice.reset_index(drop=True)
-
-# Save the blur_outliers_per_zslice dataframe to a parquet file
-blur_outliers_per_zslice.to_parquet(qc_results_dir / "all_plates_qc_results.parquet")
+# ## Summarize the z-slices that are flagged for blur in any channel
+
+# The flags of every z-slice for all conditions are saved in one pass by `3.flag_image_qc`, with the thresholds in the QC config.
+
+# In[ ]:
+
+
+# Flag the z-slices for blur in all channels
+blur_flags = qc_flags.flag_zslices(concat_qc_df, blur_config)
 
 # Print the number of rows with at least one Blurry column set to True
-num_blurry_rows = blur_outliers_per_zslice.loc[:, "Blurry_DNA":"Blurry_ER"].any(axis=1).sum()
+num_blurry_rows = blur_flags.filter(like="Blurry_").any(axis=1).sum()
 print(
     f"Number of z-slices across all organoids detected as poor quality due to blur (in any channel): {num_blurry_rows}"
 )
 
-# Calculate and print the percentage of organoids detected as containing blur
-percentage_blurry = (num_blurry_rows / len(blur_outliers_per_zslice)) * 100
+# Calculate and print the percentage of z-slices detected as poor quality
+percentage_blurry = (num_blurry_rows / len(blur_flags)) * 100
 print(
     f"Percentage of z-slices detected as poor quality due to blur: {percentage_blurry:.2f}%"
 )
 
 # Display the resulting dataframe
-print(blur_outliers_per_zslice.shape)
-blur_outliers_per_zslice.head()
-
+print(blur_flags.shape)
+blur_flags.head()
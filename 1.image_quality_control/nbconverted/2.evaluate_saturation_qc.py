@@ -2,39 +2,43 @@
 # coding: utf-8
 
 # # Whole image quality control metric evaluation - Saturation
-# 
+#
 # In this notebook, we will use the outputted QC metrics per image (every z-slice per channel) to start working on developing thresholds using z-score to flag images during CellProfiler processing.
 # We are loading in the results from the preliminary data (across three patients) to attempt to develop generalizable thresholds.
 # This data is 3D, so we are decide if it make sense to remove a whole organoid based on if one z-slice fails.
-# 
+#
 # ## Over-saturated image detection
-# 
+#
 # For detecting poor quality images based on saturation, we use the feature `PercentMaximal`, where higher values means the image contains overly saturated pixels.
 # We know that this metric is on a scale from 0 to 100, where 100 means that all of the pixels in an image are at the highest pixel intensity based on the intensity distribution of that image.
 # We will process each channel independently but including all plates together.
-# 
+#
 # We will use a method called `coSMicQC`, which takes a feature of interest and detect outliers based on z-scoring and how far from the mean that outliers will be.
+# The same z-score logic is applied to all channels in one pass (see `utils/qc_flags.py`), with the thresholds per channel in the QC config that `3.flag_image_qc` uses to flag the z-slices.
 
 # ## Import libraries
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
-import pandas as pd
-import cosmicqc
-import cv2
+import sys
+
 import matplotlib.pyplot as plt
-import re
+import pandas as pd
 
+sys.path.append("../../utils")
+import qc_flags
+import qc_results
+import thumbnails
 
 # ## Set paths and variables
 
-# In[2]:
+# In[ ]:
 
 
-# Set the threshold for identifying outliers with z-scoring for all metrics (# of standard deviations away from mean)
-threshold_z = 2
+# QC config with the z-score threshold per channel for saturation (see utils/qc_flags.py)
+saturation_config = {"Saturated": qc_flags.QC_CONFIG["Saturated"]}
 
 # Directory for figures to be outputted
 figure_dir = pathlib.Path("../qc_figures")
@@ -43,21 +47,19 @@ figure_dir.mkdir(exist_ok=True)
 # Directory containing the QC results
 qc_results_dir = pathlib.Path("../qc_results")
 
-# Path to the QC results file for all plates (currently contains blur results)
-existing_qc_results_path = pathlib.Path(
-    qc_results_dir / "all_plates_qc_results.parquet"
-)
+# Directory with the cached thumbnails of the z-slice images (built during ingest or on first access)
+thumbnail_dir = pathlib.Path("../../data/thumbnails")
 
 # Find all Image.csv files for all plates using glob
 image_csv_paths = qc_results_dir.glob("*/Image.csv")
 
-# Path to the template pipeline file to update with proper thresholds for flagging
-pipeline_path = pathlib.Path("../pipeline/template_flag_pipeline.cppipe")
+# Convert the Image.csv files to Parquet in parallel (only the ones that changed since the last conversion)
+image_parquet_paths = qc_results.convert_image_csvs(image_csv_paths)
 
 
 # ## Load in QC results per plate and combine
 
-# In[3]:
+# In[ ]:
 
 
 # Define prefixes for columns to select
@@ -70,20 +72,10 @@ prefixes = (
 
 # Load and concatenate the data for all plates
 qc_dfs = []
-for path in image_csv_paths:
+for path in image_parquet_paths:
     # Load only the required columns by filtering columns with specified prefixes
-    plate_df = pd.read_csv(path, usecols=lambda col: col.startswith(prefixes))
-    
-    # Check for NaNs in the Metadata_Plate, Metadata_Well, and Metadata_Site columns
-    if plate_df[["Metadata_Plate", "Metadata_Well", "Metadata_Site"]].isna().any().any():
-        print(f"NaNs detected in {path} in Metadata_Plate, Metadata_Well, or Metadata_Site columns")
-    
-    # Fill NaNs for specific conditions
-    if "NF0018_qc_results" in str(path):
-        plate_df["Metadata_Plate"] = plate_df["Metadata_Plate"].fillna("NF0018")
-        plate_df["Metadata_Well"] = plate_df["Metadata_Well"].fillna("E5")
-        plate_df["Metadata_Site"] = plate_df["Metadata_Site"].fillna(3)
-    
+    # (metadata that is known to be missing for a plate is filled in, see utils/qc_results.py)
+    plate_df = qc_results.read_image_qc(path, prefixes)
     qc_dfs.append(plate_df)
 
 
@@ -104,27 +96,21 @@ concat_qc_df.head(2)
 
 # ## Detect over-saturation in DNA channel
 
-# In[5]:
+# In[ ]:
 
 
-# Identify metadata columns (columns that do not start with 'ImageQuality')
-metadata_columns = [
-    col for col in concat_qc_df.columns if not col.startswith("ImageQuality")
-]
+# Flag the saturation outliers of all channels in one pass with the thresholds in the QC config
+saturation_labels = qc_flags.label_outliers(concat_qc_df, saturation_config)
 
-# Find outliers for blur in DNA channel
-saturation_DNA_outliers = cosmicqc.find_outliers(
-    df=concat_qc_df,
-    metadata_columns=metadata_columns,
-    feature_thresholds={
-        "ImageQuality_PercentMaximal_DNA": 8,
-    },
+# Get the saturation outliers in the DNA channel
+saturation_DNA_outliers = qc_flags.outliers(
+    concat_qc_df, saturation_labels, "Saturated_DNA", saturation_config
 )
 
 pd.DataFrame(saturation_DNA_outliers).head()
 
 
-# In[6]:
+# In[ ]:
 
 
 # Combine PathName and FileName columns to construct full paths for DNA
@@ -145,18 +131,16 @@ for idx, row in enumerate(saturation_DNA_outliers.itertuples(), start=1):
     # Format the metadata title
     metadata_title = f"{row.Metadata_Plate}_{row.Metadata_Well}-{int(row.Metadata_Site)}_{row.Metadata_Zslice} (Total z-slices: {row.Metadata_zslice_total})"
 
-    # Read the image
-    image = cv2.imread(image_path)
-    if image is None:
+    # Read the thumbnail of the image from the cache (the full resolution image is only read on first access)
+    try:
+        image = thumbnails.read_thumbnail(image_path, thumbnail_dir)
+    except FileNotFoundError:
         print(f"Warning: Could not read image at {image_path}")
         continue
-    image = cv2.cvtColor(
-        image, cv2.COLOR_BGR2RGB
-    )  # Convert from BGR to RGB for proper display
 
     # Add the image to the plot
     plt.subplot(1, 3, idx)  # Use idx for subplot placement
-    plt.imshow(image)
+    plt.imshow(image, cmap="gray")
     plt.title(metadata_title)  # Set the formatted metadata as the title
     plt.axis("off")
 
@@ -167,21 +151,12 @@ plt.show()
 
 # ## Detect over-saturation in Mito channel
 
-# In[7]:
+# In[ ]:
 
 
-# Identify metadata columns (columns that do not start with 'ImageQuality')
-metadata_columns = [
-    col for col in concat_qc_df.columns if not col.startswith("ImageQuality")
-]
-
-# Find outliers for Mito channel
-saturation_Mito_outliers = cosmicqc.find_outliers(
-    df=concat_qc_df,
-    metadata_columns=metadata_columns,
-    feature_thresholds={
-        "ImageQuality_PercentMaximal_Mito": 6,
-    },
+# Get the saturation outliers in the Mito channel
+saturation_Mito_outliers = qc_flags.outliers(
+    concat_qc_df, saturation_labels, "Saturated_Mito", saturation_config
 )
 
 pd.DataFrame(saturation_Mito_outliers)
@@ -193,7 +168,7 @@ saturation_Mito_outliers = saturation_Mito_outliers.sort_values(
 saturation_Mito_outliers.head()
 
 
-# In[8]:
+# In[ ]:
 
 
 # Combine PathName and FileName columns to construct full paths for Mito
@@ -230,18 +205,16 @@ for idx, row in enumerate(selected_images.itertuples(), start=1):
     # Format the metadata title
     metadata_title = f"{row.Metadata_Plate}_{row.Metadata_Well}-{int(row.Metadata_Site)}_{row.Metadata_Zslice} (Total z-slices: {row.Metadata_zslice_total})"
 
-    # Read the image
-    image = cv2.imread(image_path)
-    if image is None:
+    # Read the thumbnail of the image from the cache (the full resolution image is only read on first access)
+    try:
+        image = thumbnails.read_thumbnail(image_path, thumbnail_dir)
+    except FileNotFoundError:
         print(f"Warning: Could not read image at {image_path}")
         continue
-    image = cv2.cvtColor(
-        image, cv2.COLOR_BGR2RGB
-    )  # Convert from BGR to RGB for proper display
 
     # Add the image to the plot
     plt.subplot(1, 3, idx)  # Use idx for subplot placement
-    plt.imshow(image)
+    plt.imshow(image, cmap="gray")
     plt.title(metadata_title)  # Set the formatted metadata as the title
     plt.axis("off")
 
@@ -252,27 +225,18 @@ plt.show()
 
 # ## Detect over-saturation in ER channel
 
-# In[9]:
-
+# In[ ]:
 
-# Identify metadata columns (columns that do not start with 'ImageQuality')
-metadata_columns = [
-    col for col in concat_qc_df.columns if not col.startswith("ImageQuality")
-]
 
-# Find outliers for the ER channel
-saturation_er_outliers = cosmicqc.find_outliers(
-    df=concat_qc_df,
-    metadata_columns=metadata_columns,
-    feature_thresholds={
-        "ImageQuality_PercentMaximal_ER": 2,
-    },
+# Get the saturation outliers in the ER channel
+saturation_er_outliers = qc_flags.outliers(
+    concat_qc_df, saturation_labels, "Saturated_ER", saturation_config
 )
 
 pd.DataFrame(saturation_er_outliers).head()
 
 
-# In[10]:
+# In[ ]:
 
 
 # Combine PathName and FileName columns to construct full paths
@@ -309,18 +273,16 @@ for idx, row in enumerate(
     # Format the metadata title
     metadata_title = f"{row.Metadata_Plate}_{row.Metadata_Well}-{int(row.Metadata_Site)}_{row.Metadata_Zslice} (Total z-slices: {row.Metadata_zslice_total})"
 
-    # Read the image
-    image = cv2.imread(image_path)
-    if image is None:
+    # Read the thumbnail of the image from the cache (the full resolution image is only read on first access)
+    try:
+        image = thumbnails.read_thumbnail(image_path, thumbnail_dir)
+    except FileNotFoundError:
         print(f"Warning: Could not read image at {image_path}")
         continue
-    image = cv2.cvtColor(
-        image, cv2.COLOR_BGR2RGB
-    )  # Convert from BGR to RGB for proper display
 
     # Add the image to the plot
     plt.subplot(1, 3, idx)  # Use idx for subplot placement
-    plt.imshow(image)
+    plt.imshow(image, cmap="gray")
     plt.title(metadata_title)
     plt.axis("off")
 
@@ -331,27 +293,18 @@ plt.show()
 
 # ## Detect over-saturation in AGP channel
 
-# In[11]:
+# In[ ]:
 
 
-# Identify metadata columns (columns that do not start with 'ImageQuality')
-metadata_columns = [
-    col for col in concat_qc_df.columns if not col.startswith("ImageQuality")
-]
-
-# Find outliers for AGP channel
-saturation_agp_outliers = cosmicqc.find_outliers(
-    df=concat_qc_df,
-    metadata_columns=metadata_columns,
-    feature_thresholds={
-        "ImageQuality_PercentMaximal_AGP": 4,
-    },
+# Get the saturation outliers in the AGP channel
+saturation_agp_outliers = qc_flags.outliers(
+    concat_qc_df, saturation_labels, "Saturated_AGP", saturation_config
 )
 
 pd.DataFrame(saturation_agp_outliers).head()
 
 
-# In[12]:
+# In[ ]:
 
 
 # Combine PathName and FileName columns to construct full paths
@@ -390,18 +343,16 @@ for idx, row in enumerate(
     # Format the metadata title
     metadata_title = f"{row.Metadata_Plate}_{row.Metadata_Well}-{int(row.Metadata_Site)}_{row.Metadata_Zslice} (Total z-slices: {row.Metadata_zslice_total})"
 
-    # Read the image
-    image = cv2.imread(image_path)
-    if image is None:
+    # Read the thumbnail of the image from the cache (the full resolution image is only read on first access)
+    try:
+        image = thumbnails.read_thumbnail(image_path, thumbnail_dir)
+    except FileNotFoundError:
         print(f"Warning: Could not read image at {image_path}")
         continue
-    image = cv2.cvtColor(
-        image, cv2.COLOR_BGR2RGB
-    )  # Convert from BGR to RGB for proper display
 
     # Add the image to the plot
     plt.subplot(1, 3, idx)  # Use idx for subplot placement
-    plt.imshow(image)
+    plt.imshow(image, cmap="gray")
     plt.title(metadata_title)
     plt.axis("off")
 
@@ -412,27 +363,18 @@ plt.show()
 
 # ## Detect over-saturation in Brightfield channel
 
-# In[13]:
-
+# In[ ]:
 
-# Identify metadata columns (columns that do not start with 'ImageQuality')
-metadata_columns = [
-    col for col in concat_qc_df.columns if not col.startswith("ImageQuality")
-]
 
-# Find outliers for Brightfield channel
-saturation_brightfield_outliers = cosmicqc.find_outliers(
-    df=concat_qc_df,
-    metadata_columns=metadata_columns,
-    feature_thresholds={
-        "ImageQuality_PercentMaximal_Brightfield": 10,
-    },
+# Get the saturation outliers in the Brightfield channel
+saturation_brightfield_outliers = qc_flags.outliers(
+    concat_qc_df, saturation_labels, "Saturated_Brightfield", saturation_config
 )
 
 pd.DataFrame(saturation_brightfield_outliers).head()
 
 
-# In[14]:
+# In[ ]:
 
 
 # Combine PathName and FileName columns to construct full paths
@@ -471,18 +413,16 @@ for idx, row in enumerate(
     # Format the metadata title
     metadata_title = f"{row.Metadata_Plate}_{row.Metadata_Well}-{int(row.Metadata_Site)}_{row.Metadata_Zslice} (Total z-slices: {row.Metadata_zslice_total})"
 
-    # Read the image
-    image = cv2.imread(image_path)
-    if image is None:
+    # Read the thumbnail of the image from the cache (the full resolution image is only read on first access)
+    try:
+        image = thumbnails.read_thumbnail(image_path, thumbnail_dir)
+    except FileNotFoundError:
         print(f"Warning: Could not read image at {image_path}")
         continue
-    image = cv2.cvtColor(
-        image, cv2.COLOR_BGR2RGB
-    )  # Convert from BGR to RGB for proper display
 
     # Add the image to the plot
     plt.subplot(1, 3, idx)  # Use idx for subplot placement
-    plt.imshow(image)
+    plt.imshow(image, cmap="gray")
     plt.title(metadata_title)
     plt.axis("off")
 
@@ -491,82 +431,28 @@ plt.tight_layout()
 plt.show()
 
 
-# ## Create parquet file with each plate/well/site combos and boolean for pass/fail saturation per channel
-
-# In[15]:
-
-
-# Load the existing parquet file with blur results
-existing_qc_results = pd.read_parquet(existing_qc_results_path)
-
-# Combine all saturation outliers dataframes into a single dataframe
-saturation_outliers = pd.concat(
-    [
-        saturation_DNA_outliers,
-        saturation_Mito_outliers,
-        saturation_agp_outliers,
-        saturation_brightfield_outliers,
-        saturation_er_outliers,
-    ],
-    keys=["DNA", "Mito", "AGP", "Brightfield", "ER"],
-    names=["Channel"],
-).reset_index(level="Channel")
-
-# Create a new dataframe with unique combinations of Metadata_Plate, Metadata_Well, Metadata_Site, and Metadata_ZSlice
-saturation_outliers_per_zslice = concat_qc_df[
-    ["Metadata_Plate", "Metadata_Well", "Metadata_Site", "Metadata_Zslice"]
-].drop_duplicates()
-
-# Initialize columns for each channel with False
-for channel in ["DNA", "Mito", "AGP", "Brightfield", "ER"]:
-    saturation_outliers_per_zslice[f"Saturated_{channel}"] = False
-
-# Flag the combos for saturation detection
-for channel in ["DNA", "Mito", "AGP", "Brightfield", "ER"]:
-    saturation_combos = saturation_outliers[saturation_outliers["Channel"] == channel][
-        ["Metadata_Plate", "Metadata_Well", "Metadata_Site", "Metadata_Zslice"]
-    ].drop_duplicates()
-    saturation_outliers_per_zslice.loc[
-        saturation_outliers_per_zslice.set_index(
-            ["Metadata_Plate", "Metadata_Well", "Metadata_Site", "Metadata_Zslice"]
-        ).index.isin(
-            saturation_combos.set_index(
-                ["Metadata_Plate", "Metadata_Well", "Metadata_Site", "Metadata_Zslice"]
-            ).index
-        ),
-        f"Saturated_{channel}",
-    ] = True
-
-# Reset the index on the unique combos dataframe
-saturation_outliers_per_zslice = saturation_outliers_per_zslice.reset_index(drop=True)
-
-# Merge the new Saturated_ columns onto the existing dataframe
-merged_qc_results = existing_qc_results.merge(
-    saturation_outliers_per_zslice,
-    on=["Metadata_Plate", "Metadata_Well", "Metadata_Site", "Metadata_Zslice"],
-    how="left",
-)
+# ## Summarize the z-slices that are flagged for saturation in any channel
+
+# The flags of every z-slice for all conditions are saved in one pass by `3.flag_image_qc`, with the thresholds in the QC config.
+
+# In[ ]:
+
 
-# Save the merged dataframe back to the parquet file
-merged_qc_results.to_parquet(existing_qc_results_path)
+# Flag the z-slices for saturation in all channels
+saturation_flags = qc_flags.flag_zslices(concat_qc_df, saturation_config)
 
 # Print the number of rows with at least one Saturated column set to True
-num_saturated_rows = (
-    saturation_outliers_per_zslice.loc[:, "Saturated_DNA":"Saturated_ER"].any(axis=1).sum()
-)
+num_saturated_rows = saturation_flags.filter(like="Saturated_").any(axis=1).sum()
 print(
     f"Number of z-slices across all organoids detected as poor quality due to saturation (in any channel): {num_saturated_rows}"
 )
 
-# Calculate and print the percentage of organoids detected as containing saturation
-percentage_saturated = (num_saturated_rows / len(saturation_outliers_per_zslice)) * 100
+# Calculate and print the percentage of z-slices detected as poor quality
+percentage_saturated = (num_saturated_rows / len(saturation_flags)) * 100
 print(
     f"Percentage of z-slices detected as poor quality due to saturation: {percentage_saturated:.2f}%"
 )
 
-# Print the shape of the merged dataframe
-print(merged_qc_results.shape)
-
-# Display the first few rows of the merged dataframe
-merged_qc_results.head()
-
+# Display the resulting dataframe
+print(saturation_flags.shape)
+saturation_flags.head()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Flag z-slices that fail whole image quality control
+#
+# In this notebook, we flag every z-slice of every plate for all QC conditions (blur and saturation) and channels in one pass.
+# The metrics, channels and z-score thresholds are set in a config (`QC_CONFIG` in `utils/qc_flags.py`), which holds the thresholds found in the blur and saturation evaluation notebooks.
+# Like `coSMicQC`, each feature is z-scored across all plates and a positive threshold flags values above the mean, while a negative threshold flags values below the mean.
+# The statistics of all plates are computed in a streaming pass over the plates before the z-slices of each plate are flagged, so the QC results of all plates are never loaded at once.
+# The flags are saved as a Hive-partitioned Parquet dataset with one partition per plate and condition (e.g., `Metadata_Plate=NF0014/Condition=Blurry`) and one row per z-slice and channel, which is used to generate the QC report.
+# Partitions whose flags did not change are not rewritten, so new plates or conditions only add partitions.
+
+# ## Import libraries
+
+# In[ ]:
+
+
+import pathlib
+import sys
+
+sys.path.append("../../utils")
+import organoid_qc
+import qc_flags
+import qc_results
+import qc_statistics
+
+# ## Set paths and variables
+
+# In[ ]:
+
+
+# Directory containing the QC results
+qc_results_dir = pathlib.Path("../qc_results")
+
+# Path to the QC results dataset for all plates with the flags of every z-slice (partitioned by plate and condition)
+qc_dataset_path = qc_results_dir / "all_plates_qc_results"
+
+# Path to the skip list of organoids that failed QC, which the segmentation scripts check before segmenting
+skip_list_path = qc_results_dir / "organoid_skip_list.csv"
+
+# Directory where the segmentation scripts save their runtime for each well-site
+runtime_dir = pathlib.Path("../../1.segment_images/runtimes")
+
+# Find all Image.csv files for all plates using glob
+image_csv_paths = qc_results_dir.glob("*/Image.csv")
+
+# Convert the Image.csv files to Parquet in parallel (only the ones that changed since the last conversion)
+image_parquet_paths = qc_results.convert_image_csvs(image_csv_paths)
+
+
+# ## Compute the statistics of every QC feature over all plates
+
+# The QC results are never combined in memory: the mean and standard deviation of every feature are computed in a first streaming pass that reads one plate at a time (Welford updates merged plate by plate, see `utils/qc_statistics.py`), together with quantiles from a mergeable sketch with a relative error of at most 1%.
+# The z-slices are then flagged plate by plate in a second pass with these statistics, so the memory does not grow with the number of plates.
+
+# In[ ]:
+
+
+# Compute the statistics of the features in the QC config, reading only the feature columns of one plate at a time
+feature_statistics = qc_statistics.feature_statistics(image_parquet_paths)
+statistics_df = feature_statistics.summary()
+statistics_df
+
+
+# ## Flag every z-slice plate by plate for all conditions and channels and save the results
+
+# In[ ]:
+
+
+# Load only the metadata and the metrics that are in the QC config
+prefixes = qc_flags.qc_prefixes()
+
+# Flag the z-slices of each plate with the statistics of all plates and save them to the QC results dataset
+write_summary = {"written": 0, "unchanged": 0}
+num_zslices = 0
+num_failed = {condition: 0 for condition in qc_flags.QC_CONFIG}
+for path in image_parquet_paths:
+    # Load the QC results of the plate (metadata that is known to be missing for a plate is filled in)
+    plate_df = qc_results.read_image_qc(path, prefixes)
+
+    # Flag the z-slices of the plate for all conditions and channels in one pass
+    plate_flags_df = qc_flags.flag_zslices(plate_df, statistics=statistics_df)
+
+    # Save the flags of the plate to its partitions of the QC results dataset
+    for key, count in qc_flags.write_qc_dataset(
+        plate_flags_df, qc_dataset_path
+    ).items():
+        write_summary[key] += count
+
+    num_zslices += len(plate_flags_df)
+    for condition in num_failed:
+        num_failed[condition] += (
+            plate_flags_df.filter(like=f"{condition}_").any(axis=1).sum()
+        )
+
+print(write_summary)
+
+# Print the number and percentage of z-slices that fail each condition (in any channel)
+for condition, num_failed_rows in num_failed.items():
+    print(
+        f"{condition}: {num_failed_rows} z-slices ({(num_failed_rows / num_zslices) * 100:.2f}%) fail in any channel"
+    )
+
+
+# ## Decide which organoids fail QC and save the skip list
+
+# An organoid fails QC if more than `organoid_qc.MAX_FAILED_ZSLICES` of its z-slices are flagged for any condition in any channel.
+# The failed organoids are saved in a skip list, so the segmentation scripts do not spend any compute on them (see `is_skipped` in `utils/organoid_qc.py`).
+# The compute saved is estimated from the runtimes per z-slice of the segmentation steps that were run so far.
+
+# In[ ]:
+
+
+# Decide for every organoid if it fails QC based on the flags of all plates and conditions
+verdicts_df = organoid_qc.organoid_verdicts(qc_flags.read_qc_dataset(qc_dataset_path))
+
+# Save the organoids that failed QC to the skip list
+skip_list_df = organoid_qc.write_skip_list(verdicts_df, skip_list_path)
+print(
+    f"{len(skip_list_df)} of {len(verdicts_df)} organoids fail QC and will not be segmented"
+)
+
+# Estimate the segmentation compute that is saved by skipping the failed organoids
+compute_saved = organoid_qc.compute_saved(verdicts_df, runtime_dir)
+print(
+    f"{compute_saved['skipped_zslices']} z-slices of skipped organoids will not be segmented"
+)
+if compute_saved["saved_seconds"] is not None:
+    print(
+        f"Estimated segmentation compute saved: {compute_saved['saved_seconds'] / 3600:.1f} hours"
+    )
+else:
+    print("No segmentation runtimes were recorded yet to estimate the compute saved")
+
+skip_list_df.head()
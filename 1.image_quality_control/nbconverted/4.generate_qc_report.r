@@ -15,30 +15,22 @@ if (!dir.exists(figures_dir)) {
     dir.create(figures_dir)
 }
 
-# Load the dataframe from a path
-qc_results_df <- read_parquet("../qc_results/all_plates_qc_results.parquet")
+# Open the QC results dataset (partitioned by plate and condition) without loading it
+qc_results_ds <- open_dataset("../qc_results/all_plates_qc_results")
 
-# Check for any NaNs in the columns starting with Metadata_
-metadata_cols <- grep("^Metadata_", colnames(qc_results_df), value = TRUE)
-na_counts <- sapply(qc_results_df[metadata_cols], function(x) sum(is.na(x)))
+# Check for any NaNs in the columns starting with Metadata_ (computed by arrow on the dataset)
+na_counts <- qc_results_ds %>%
+    summarise(across(starts_with("Metadata_"), ~ sum(is.na(.x)))) %>%
+    collect()
 
 # Print the count of NaNs for each Metadata_ column
 na_counts
 
-# Look at the dimensions and head of the dataframe
-dim(qc_results_df)
-head(qc_results_df)
-
-condition_cols <- grep("Blurry|Saturated", colnames(qc_results_df), value = TRUE)
-
-# Assuming qc_results_df is your dataframe and condition_cols is a vector of column names
-melted_qc_df <- qc_results_df %>%
-  pivot_longer(
-    cols = all_of(condition_cols),
-    names_to = c("Condition", "Channel"),
-    names_sep = "_",
-    values_to = "Failed"
-  )
+# The dataset is in long format with one row per z-slice, condition and channel
+melted_qc_df <- qc_results_ds %>%
+    select(Metadata_Plate, Metadata_Well, Metadata_Site, Metadata_Zslice, Condition, Channel, Failed) %>%
+    collect() %>%
+    mutate(across(where(is.factor), as.character))
 
 dim(melted_qc_df)
 head(melted_qc_df)
@@ -97,24 +89,11 @@ missing_across_plates <- non_matching_rows %>%
 cat("Breakdown of missing organoids due to empty folders per plate:\n")
 print(missing_across_plates)
 
-# Extract the condition and channel information from the column names
-conditions_channels <- data.frame(
-    Condition = sub("_(.*)", "", condition_cols),
-    Channel = sub("^(Blurry|Saturated)_(.*)", "\\2", condition_cols),
-    Column = condition_cols
-)
-
-# Calculate the counts of failed z-slices for each condition and channel
-failed_counts <- conditions_channels %>%
-    rowwise() %>%
-    mutate(
-        # Construct the column name by combining Condition and Channel
-        Column = paste(Condition, Channel, sep = "_"),
-        
-        # Sum the counts of failed z-slices in the constructed column
-        Count = sum(qc_results_df[[Column]] > 0, na.rm = TRUE)
-    ) %>%
-    select(-Column) %>%
+# Calculate the counts of failed z-slices for each condition and channel (computed by arrow on the dataset)
+failed_counts <- qc_results_ds %>%
+    group_by(Condition, Channel) %>%
+    summarise(Count = sum(Failed, na.rm = TRUE)) %>%
+    collect() %>%
     ungroup()
 
 # Show dimension and head of failed counts dataframe
@@ -263,8 +242,10 @@ print(histogram_plot)
 ggsave(file.path(figures_dir, "failed_norm_zslice_count_channel_and_condition.png"), plot = histogram_plot, width = width, height = height, dpi = 500)
 
 
-# Filter the dataframe for rows where any of the condition columns are TRUE
-failed_zslices_df <- qc_results_df[apply(qc_results_df[condition_cols], 1, any), ]
+# Filter the z-slices that failed at least one condition in any channel
+failed_zslices_df <- melted_qc_df %>%
+  filter(Failed) %>%
+  distinct(Metadata_Plate, Metadata_Well, Metadata_Site, Metadata_Zslice)
 
 # Count the unique combinations of Metadata_Plate, Metadata_Well, and Metadata_Site
 unique_failed_organoids <- failed_zslices_df %>%
@@ -276,7 +257,7 @@ total_unique_organoids <- nrow(unique_failed_organoids)
 cat("Total unique organoids that would fail:", total_unique_organoids, "\n")
 
 # Calculate and print the percentage of unique failed organoids out of the total
-total_organoids <- qc_results_df %>%
+total_organoids <- melted_qc_df %>%
   select(Metadata_Plate, Metadata_Well, Metadata_Site) %>%
   distinct() %>%
   nrow()
@@ -379,7 +360,7 @@ print(treatment_dose_failed_plot)
 ggsave(file.path(figures_dir, "failed_organoid_count_treatment_dose_number_failed_zslices.png"), plot = treatment_dose_failed_plot, width = width, height = height, dpi = 500)
 
 # Get the total organoid count per plate
-total_organoid_counts <- qc_results_df %>%
+total_organoid_counts <- melted_qc_df %>%
     select(Metadata_Plate, Metadata_Well, Metadata_Site) %>%
     distinct() %>%
     group_by(Metadata_Plate) %>%
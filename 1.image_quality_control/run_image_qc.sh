@@ -12,9 +12,15 @@ cd notebooks
 jupyter nbconvert --to script --output-dir=../nbconverted/ *.ipynb
 
 # run script(s)
-python nbconverted/0.cp_image_qc.py
-python nbconverted/1.evaluate_blur_qc.py
-python nbconverted/2.evaluate_saturation_qc.py
+python ../nbconverted/0.cp_image_qc.py
+# execute the evaluation notebooks in place so the outlier figures are saved with them
+jupyter nbconvert --to notebook --execute --inplace 1.evaluate_blur_qc.ipynb
+jupyter nbconvert --to notebook --execute --inplace 2.evaluate_saturation_qc.ipynb
+python ../nbconverted/3.flag_image_qc.py
+
+# activate the R environment and execute the QC report in place against the flags dataset
+conda activate gff_figure_env
+jupyter nbconvert --to notebook --execute --inplace 4.generate_qc_report.ipynb
 
 # navigate back to the image_quality_control directory
 cd ..
@@ -7,11 +7,13 @@
 
 # ## import libraries
 
-# In[1]:
+# In[ ]:
 
 
 import argparse
 import pathlib
+import sys
+import time
 
 import matplotlib.pyplot as plt
 
@@ -21,7 +23,12 @@ import skimage
 import tifffile
 import torch
 from cellpose import core, models
-from skimage import io
+
+sys.path.append(str(pathlib.Path("../../utils/").resolve()))
+from organoid_qc import flagged_zslices, is_skipped, record_runtime
+from projection import sliding_window_projection
+from zrange import kept_zslices, read_zrange, restore_reconstruction_dict
+from zstack_io import read_zstack
 
 # check if in a jupyter notebook
 try:
@@ -33,7 +40,7 @@ except NameError:
 
 # ## parse args and set paths
 
-# In[2]:
+# In[ ]:
 
 
 if not in_notebook:
@@ -54,39 +61,99 @@ if not in_notebook:
         type=float,
         help="Clip limit for the adaptive histogram equalization",
     )
+    parser.add_argument(
+        "--skip_list",
+        type=str,
+        default="../../1.image_quality_control/qc_results/organoid_skip_list.csv",
+        help="Path to the skip list of organoids that failed QC",
+    )
+    parser.add_argument(
+        "--qc_dataset",
+        type=str,
+        default="../../1.image_quality_control/qc_results/all_plates_qc_results",
+        help="Path to the QC dataset with the flags of each z-slice",
+    )
+    parser.add_argument(
+        "--flagged_fill",
+        type=str,
+        default="empty",
+        choices=["empty", "nearest"],
+        help="Fill the masks of z-slices flagged by QC with empty masks or the masks of the nearest z-slice (default: empty)",
+    )
 
     args = parser.parse_args()
     window_size = args.window_size
     clip_limit = args.clip_limit
     input_dir = pathlib.Path(args.input_dir).resolve(strict=True)
+    skip_list_path = pathlib.Path(args.skip_list).resolve()
+    qc_dataset_path = pathlib.Path(args.qc_dataset).resolve()
+    flagged_fill = args.flagged_fill
 else:
     print("Running in a notebook")
     input_dir = pathlib.Path("../../data/z-stack_images/C4-2/").resolve(strict=True)
     window_size = 3
     clip_limit = 0.05
+    skip_list_path = pathlib.Path(
+        "../../1.image_quality_control/qc_results/organoid_skip_list.csv"
+    ).resolve()
+    qc_dataset_path = pathlib.Path(
+        "../../1.image_quality_control/qc_results/all_plates_qc_results"
+    ).resolve()
+    flagged_fill = "empty"
+
+# organoids that failed QC are not segmented (see 1.image_quality_control/notebooks/3.flag_image_qc.ipynb)
+if is_skipped(input_dir, skip_list_path):
+    # stop here in a notebook too, so the remaining cells do not segment the organoid
+    if in_notebook:
+        raise RuntimeError(
+            f"{input_dir.name} failed QC and is in the skip list {skip_list_path}"
+        )
+    print(f"Skipping {input_dir.name}, the organoid failed QC")
+    sys.exit(0)
+
+# time the segmentation to estimate the compute the skip list saves
+start_time = time.perf_counter()
 
 mask_path = pathlib.Path(f"../processed_data/{input_dir.stem}").resolve()
 mask_path.mkdir(exist_ok=True, parents=True)
 
+# the runtimes are saved outside of the mask directories (see record_runtime in utils/organoid_qc.py)
+runtime_dir = pathlib.Path("../runtimes").resolve()
+
 
 # ## Set up images, paths and functions
 
-# In[3]:
+# In[ ]:
+
 
+# z-stacks are read from the OME-Zarr store of the well-site if there is one, otherwise the TIFF for each channel
+# is looked up in the image catalog (falls back to listing the input directory)
+catalog_path = pathlib.Path("../../data/image_catalog.parquet").resolve()
 
-image_extensions = {".tif", ".tiff"}
-files = sorted(input_dir.glob("*"))
-files = [str(x) for x in files if x.suffix in image_extensions]
+# only segment the useful z-range of the well-site if it was found by the z-range pre-pass
+zrange = read_zrange(input_dir)
+z_start, z_stop = (zrange["z_start"], zrange["z_stop"]) if zrange else (0, None)
+print(f"Segmenting z-slices {z_start} to {z_stop if z_stop is not None else 'end'}")
 
 
-# In[4]:
+# In[ ]:
 
 
 # get the nuclei image
-for f in files:
-    if "405" in f:
-        nuclei = io.imread(f)
-nuclei = np.array(nuclei)
+nuclei = read_zstack(
+    input_dir, "405", zslices=slice(z_start, z_stop), catalog_path=catalog_path
+)
+full_z_slice_count = zrange["z_count"] if zrange else len(nuclei)
+
+# leave the z-slices flagged by QC out of the sliding window projection and the Cellpose input
+zslices = kept_zslices(
+    z_start,
+    z_start + len(nuclei),
+    flagged_zslices(input_dir, qc_dataset_path, full_z_slice_count),
+    min_slices=window_size,
+)
+print(f"Leaving out {len(nuclei) - len(zslices)} z-slices flagged by QC")
+nuclei = nuclei[[zslice - z_start for zslice in zslices]]
 imgs = skimage.exposure.equalize_adapthist(nuclei, clip_limit=clip_limit)
 original_imgs = imgs
 print("Subsampled image shape:", imgs.shape)
@@ -95,22 +162,13 @@ original_z_slice_count = len(imgs)
 print("number of z slices in the original image:", original_z_slice_count)
 
 
-# In[5]:
+# In[ ]:
 
 
 # make a 2.5 D max projection image stack with a sliding window of 3 slices
+image_stack_2_5D = sliding_window_projection(imgs, window_size, reducer="max")
 
-image_stack_2_5D = np.empty((0, imgs.shape[1], imgs.shape[2]), dtype=imgs.dtype)
-for image_index in range(imgs.shape[0]):
-    image_stack_window = imgs[image_index : image_index + window_size]
-    if not image_stack_window.shape[0] == window_size:
-        break
-    # max project the image stack
-    image_stack_2_5D = np.append(
-        image_stack_2_5D, np.max(image_stack_window, axis=0)[np.newaxis, :, :], axis=0
-    )
-
-imgs = np.array(image_stack_2_5D)
+imgs = image_stack_2_5D
 print("2.5D image stack shape:", image_stack_2_5D.shape)
 
 
@@ -155,5 +213,24 @@ for z_stack_mask_index in range(len(labels)):
                 z_stack_mask
             )
 
+# move the masks back to their z-slice and fill the z-slices outside of the useful z-range (empty) and the z-slices
+# flagged by QC to match the full z-stack
+reconstruction_dict = restore_reconstruction_dict(
+    reconstruction_dict,
+    zslices,
+    full_z_slice_count,
+    fill=flagged_fill,
+    mask_shape=original_imgs.shape[1:],
+)
+
 # save the reconstruction_dict to a file for downstream decoupling
 np.save(mask_path / "nuclei_reconstruction_dict.npy", reconstruction_dict)
+
+# save the runtime of the segmentation in the runtime directory (outside of the mask directory)
+record_runtime(
+    runtime_dir,
+    input_dir,
+    "nuclei",
+    time.perf_counter() - start_time,
+    original_z_slice_count,
+)
@@ -9,8 +9,10 @@
 
 
 import argparse
+import functools
 import pathlib
 import sys
+import time
 
 import matplotlib.pyplot as plt
 
@@ -26,12 +28,15 @@ cellpose_io.logger_setup()
 import torch
 from cellpose.io import imread
 from PIL import Image
-from skimage import io
 
 use_GPU = torch.cuda.is_available()
 
 # set import path
 sys.path.append(str(pathlib.Path("../../utils/").resolve()))
+from organoid_qc import flagged_zslices, is_skipped, record_runtime
+from projection import sliding_window_projection
+from zrange import kept_zslices, read_zrange, restore_zstack
+from zstack_io import read_zstack
 
 # check if in a jupyter notebook
 try:
@@ -63,48 +68,114 @@ if not in_notebook:
         type=float,
         help="Clip limit for the adaptive histogram equalization",
     )
+    parser.add_argument(
+        "--skip_list",
+        type=str,
+        default="../../1.image_quality_control/qc_results/organoid_skip_list.csv",
+        help="Path to the skip list of organoids that failed QC",
+    )
+    parser.add_argument(
+        "--qc_dataset",
+        type=str,
+        default="../../1.image_quality_control/qc_results/all_plates_qc_results",
+        help="Path to the QC dataset with the flags of each z-slice",
+    )
+    parser.add_argument(
+        "--flagged_fill",
+        type=str,
+        default="empty",
+        choices=["empty", "nearest"],
+        help="Fill the masks of z-slices flagged by QC with empty masks or the masks of the nearest z-slice (default: empty)",
+    )
 
     args = parser.parse_args()
     window_size = args.window_size
     clip_limit = args.clip_limit
     input_dir = pathlib.Path(args.input_dir).resolve(strict=True)
+    skip_list_path = pathlib.Path(args.skip_list).resolve()
+    qc_dataset_path = pathlib.Path(args.qc_dataset).resolve()
+    flagged_fill = args.flagged_fill
 
 else:
     input_dir = pathlib.Path("../../data/z-stack_images/C4-2/").resolve(strict=True)
     window_size = 3
     clip_limit = 0.1
+    skip_list_path = pathlib.Path(
+        "../../1.image_quality_control/qc_results/organoid_skip_list.csv"
+    ).resolve()
+    qc_dataset_path = pathlib.Path(
+        "../../1.image_quality_control/qc_results/all_plates_qc_results"
+    ).resolve()
+    flagged_fill = "empty"
+
+# organoids that failed QC are not segmented (see 1.image_quality_control/notebooks/3.flag_image_qc.ipynb)
+if is_skipped(input_dir, skip_list_path):
+    # stop here in a notebook too, so the remaining cells do not segment the organoid
+    if in_notebook:
+        raise RuntimeError(
+            f"{input_dir.name} failed QC and is in the skip list {skip_list_path}"
+        )
+    print(f"Skipping {input_dir.name}, the organoid failed QC")
+    sys.exit(0)
+
+# time the segmentation to estimate the compute the skip list saves
+start_time = time.perf_counter()
 
 mask_path = pathlib.Path(f"../processed_data/{input_dir.stem}").resolve()
 mask_path.mkdir(exist_ok=True, parents=True)
 
+# the runtimes are saved outside of the mask directories (see record_runtime in utils/organoid_qc.py)
+runtime_dir = pathlib.Path("../runtimes").resolve()
+
 
 # ## Set up images, paths and functions
 
 # In[3]:
 
 
-image_extensions = {".tif", ".tiff"}
-files = sorted(input_dir.glob("*"))
-files = [str(x) for x in files if x.suffix in image_extensions]
+# z-stacks are read from the OME-Zarr store of the well-site if there is one, otherwise the TIFF for each channel
+# is looked up in the image catalog (falls back to listing the input directory)
+catalog_path = pathlib.Path("../../data/image_catalog.parquet").resolve()
+
+# only segment the useful z-range of the well-site if it was found by the z-range pre-pass
+zrange = read_zrange(input_dir)
+z_start, z_stop = (zrange["z_start"], zrange["z_stop"]) if zrange else (0, None)
+print(f"Segmenting z-slices {z_start} to {z_stop if z_stop is not None else 'end'}")
 
 
 # In[4]:
 
 
 # find the cytoplasmic channels in the image set
-for f in files:
-    if "405" in f:
-        nuclei = io.imread(f)
-    elif "488" in f:
-        cyto1 = io.imread(f)
-    elif "555" in f:
-        cyto2 = io.imread(f)
-    elif "640" in f:
-        cyto3 = io.imread(f)
-    elif "TRANS" in f:
-        brightfield = io.imread(f)
-    else:
-        print(f"Unknown channel: {f}")
+nuclei = read_zstack(
+    input_dir, "405", zslices=slice(z_start, z_stop), catalog_path=catalog_path
+)
+cyto1 = read_zstack(
+    input_dir, "488", zslices=slice(z_start, z_stop), catalog_path=catalog_path
+)
+cyto2 = read_zstack(
+    input_dir, "555", zslices=slice(z_start, z_stop), catalog_path=catalog_path
+)
+cyto3 = read_zstack(
+    input_dir, "640", zslices=slice(z_start, z_stop), catalog_path=catalog_path
+)
+brightfield = read_zstack(
+    input_dir, "TRANS", zslices=slice(z_start, z_stop), catalog_path=catalog_path
+)
+full_z_count = zrange["z_count"] if zrange else len(cyto1)
+
+# leave the z-slices flagged by QC out of the sliding window projection and the Cellpose input
+zslices = kept_zslices(
+    z_start,
+    z_start + len(cyto1),
+    flagged_zslices(input_dir, qc_dataset_path, full_z_count),
+    min_slices=window_size,
+)
+print(f"Leaving out {len(cyto1) - len(zslices)} z-slices flagged by QC")
+cyto1, cyto2, cyto3, brightfield = (
+    zstack[[zslice - z_start for zslice in zslices]]
+    for zstack in [cyto1, cyto2, cyto3, brightfield]
+)
 
 cyto = np.max([cyto1, cyto2, cyto3], axis=0)
 # pick which channels to use for cellpose
@@ -120,20 +191,13 @@ original_cyto_z_count = cyto.shape[0]
 
 
 # make a 2.5 D max projection image stack with a sliding window of 3 slices
-image_stack_2_5D = np.empty((0, cyto.shape[1], cyto.shape[2]), dtype=cyto.dtype)
-for image_index in range(cyto.shape[0]):
-    image_stack_window = cyto[image_index : image_index + window_size]
-    if not image_stack_window.shape[0] == window_size:
-        break
-    # guassian blur the image stack
-    image_stack_window = skimage.filters.gaussian(image_stack_window, sigma=1)
-    # max project the image stack
-    image_stack_2_5D = np.append(
-        image_stack_2_5D, np.max(image_stack_window, axis=0)[np.newaxis, :, :], axis=0
-    )
-
-image_stack_2_5D = np.array(image_stack_2_5D)
-cyto = np.array(image_stack_2_5D)
+# (each window is gaussian blurred before it is max projected)
+cyto = sliding_window_projection(
+    cyto,
+    window_size,
+    reducer="max",
+    window_function=functools.partial(skimage.filters.gaussian, sigma=1),
+)
 print("2.5D cyto image stack shape:", cyto.shape)
 
 
@@ -222,9 +286,24 @@ for z_stack_index in range(original_cyto_z_count):
 
 full_mask_z_stack = np.array(full_mask_z_stack)
 
+# move the masks back to their z-slice and fill the z-slices outside of the useful z-range (empty) and the z-slices
+# flagged by QC to match the full z-stack
+full_mask_z_stack = restore_zstack(
+    full_mask_z_stack, zslices, full_z_count, fill=flagged_fill
+)
+
 # save the reconstructed image stack to a tiff file
 tifffile.imsave(mask_path / "organoid_mask.tiff", full_mask_z_stack)
 
+# save the runtime of the segmentation in the runtime directory (outside of the mask directory)
+record_runtime(
+    runtime_dir,
+    input_dir,
+    "organoid",
+    time.perf_counter() - start_time,
+    original_cyto_z_count,
+)
+
 
 # In[9]:
 
@@ -6,12 +6,16 @@
 
 import argparse
 import pathlib
+import sys
 
 import imageio
 import numpy as np
 import skimage
 import skimage.io as io
 
+sys.path.append(str(pathlib.Path("../../utils/").resolve()))
+from zstack_io import read_zstack
+
 # check if in a jupyter notebook
 try:
     cfg = get_ipython().config
@@ -60,7 +64,6 @@ else:
 output_path = pathlib.Path(f"../processed_data/{input_dir.stem}/gifs/").resolve()
 output_path.mkdir(parents=True, exist_ok=True)
 
-img_files = sorted(input_dir.glob("*"))
 mask_files = sorted(mask_input_dir.glob("*"))
 
 
@@ -69,16 +72,13 @@ mask_files = sorted(mask_input_dir.glob("*"))
 # In[3]:
 
 
-for f in img_files:
-    if compartment == "nuclei":
-        if "405" in str(f.stem):
-            img_path = f
-    elif compartment == "cell":
-        if "555" in str(f.stem):
-            img_path = f
-    elif compartment == "cytoplasm":
-        if "555" in str(f.stem):
-            img_path = f
+# channel of the image shown for each compartment
+if compartment == "nuclei":
+    img_channel = "405"
+elif compartment == "cell":
+    img_channel = "555"
+elif compartment == "cytoplasm":
+    img_channel = "555"
 
 for f in mask_files:
 
@@ -106,7 +106,7 @@ for f in mask_files:
         raise ValueError("Invalid compartment, please choose either 'nuclei' or 'cell'")
 
 # read in the cell masks
-img = io.imread(img_path)
+img = np.asarray(read_zstack(input_dir, img_channel))
 mask = io.imread(mask_input_dir)
 
 # scale the images to unit8
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
@@ -13,11 +13,14 @@ import tqdm
 
 sys.path.append(str(pathlib.Path("../../utils").resolve()))
 from file_checking import check_number_of_files
+from staging import stage_file, stage_tree
 
-# In[2]:
+# In[ ]:
 
 
 overwrite = True
+# stage files with links instead of copies ("auto" picks hardlinks, reflinks or symlinks per filesystem)
+staging_mode = "auto"
 
 
 # In[3]:
@@ -66,28 +69,28 @@ for file in normalized_data_dir_directories:
     check_number_of_files(file, 5)
 
 
-# ## Copy the normalized images to the cellprofiler images dir
+# ## Stage the normalized images in the cellprofiler images dir
 
-# In[5]:
+# In[ ]:
 
 
 # get the list of dirs in the normalized_data_dir
 norm_dirs = [x for x in normalized_data_dir.iterdir() if x.is_dir()]
-# copy each dir and files to cellprofiler_dir
+# stage each dir and files in cellprofiler_dir
 for norm_dir in tqdm.tqdm(norm_dirs):
     dest_dir = pathlib.Path(cellprofiler_dir, norm_dir.name)
     if dest_dir.exists() and overwrite:
         shutil.rmtree(dest_dir)
-        shutil.copytree(norm_dir, dest_dir)
+        stage_tree(norm_dir, dest_dir, mode=staging_mode)
     elif not dest_dir.exists():
-        shutil.copytree(norm_dir, dest_dir)
+        stage_tree(norm_dir, dest_dir, mode=staging_mode)
     else:
         pass
 
 
-# ## Copy files from processed dir to cellprofiler images dir
+# ## Stage files from processed dir in cellprofiler images dir
 
-# In[6]:
+# In[ ]:
 
 
 # get a list of dirs in processed_data
@@ -98,11 +101,11 @@ for well_dir in tqdm.tqdm(dirs):
     files = [x for x in well_dir.iterdir() if x.is_file()]
     for file in files:
         if file.suffix in file_extensions:
-            # copy each of the raw files to the cellprofiler_dir for feature extraction
+            # stage each of the raw files in the cellprofiler_dir for feature extraction
             new_file_dir = pathlib.Path(
                 cellprofiler_dir, well_dir.name, file.stem + file.suffix
             )
-            shutil.copy(file, new_file_dir)
+            stage_file(file, new_file_dir, mode=staging_mode)
 
 
 # In[7]:
@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# the utils modules are imported by name, like in the notebooks and scripts
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "utils"))
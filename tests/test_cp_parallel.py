@@ -0,0 +1,223 @@
+import os
+import pathlib
+
+import pandas as pd
+import pytest
+from cp_parallel import (
+    COMPLETION_MARKER,
+    input_fingerprint,
+    is_complete,
+    merge_shard_outputs,
+    run_cellprofiler_parallel,
+    shard_plate,
+    write_completion_marker,
+)
+
+
+def write_images(well_site_dir: pathlib.Path, count: int) -> None:
+    well_site_dir.mkdir(parents=True)
+    for index in range(count):
+        (well_site_dir / f"{well_site_dir.name}_{index}.tif").touch()
+
+
+@pytest.fixture
+def plate_dir(tmp_path) -> pathlib.Path:
+    plate_dir = tmp_path / "NF0014"
+    write_images(plate_dir / "C4-1", 2)
+    write_images(plate_dir / "C4-2", 2)
+    write_images(plate_dir / "D5-1", 3)
+    write_images(plate_dir / "E6-1", 1)
+    (plate_dir / "notes.txt").touch()
+    return plate_dir
+
+
+def shard_wells(file_list: pathlib.Path) -> set:
+    return {
+        pathlib.Path(line).parent.name.split("-")[0]
+        for line in file_list.read_text().splitlines()
+    }
+
+
+def test_shard_plate_keeps_wells_together(plate_dir, tmp_path):
+    file_lists = shard_plate(plate_dir, 2, tmp_path / "shards")
+
+    assert [file_list.name for file_list in file_lists] == [
+        "shard00_file_list.txt",
+        "shard01_file_list.txt",
+    ]
+    # the largest well goes first, the others fill the shard with the fewest images
+    assert [shard_wells(file_list) for file_list in file_lists] == [
+        {"C4"},
+        {"D5", "E6"},
+    ]
+    images = [
+        line for file_list in file_lists for line in file_list.read_text().split()
+    ]
+    assert len(images) == len(set(images)) == 8
+
+
+def test_shard_plate_at_most_one_shard_per_well(plate_dir, tmp_path):
+    file_lists = shard_plate(plate_dir, 5, tmp_path / "shards")
+
+    assert [shard_wells(file_list) for file_list in file_lists] == [
+        {"C4"},
+        {"D5"},
+        {"E6"},
+    ]
+
+
+def write_shard(
+    shard_output_dir: pathlib.Path, image_sets: int, grouped: bool = False
+) -> None:
+    shard_output_dir.mkdir(parents=True)
+    image_numbers = list(range(1, image_sets + 1))
+    pd.DataFrame(
+        {
+            "ImageNumber": image_numbers,
+            "Group_Number": [1 + grouped * number for number in image_numbers],
+            "Group_Index": [1 if grouped else number for number in image_numbers],
+        }
+    ).to_csv(shard_output_dir / "Image.csv", index=False)
+    pd.DataFrame(
+        {
+            "ImageNumber": [number for number in image_numbers for _ in range(2)],
+            "ObjectNumber": [1, 2] * image_sets,
+        }
+    ).to_csv(shard_output_dir / "Nuclei.csv", index=False)
+    pd.DataFrame({"Key": ["Version"], "Value": [shard_output_dir.name]}).to_csv(
+        shard_output_dir / "Experiment.csv", index=False
+    )
+
+
+def test_merge_shard_outputs_offsets_image_numbers(tmp_path):
+    shard_output_dirs = [tmp_path / "shard00", tmp_path / "shard01"]
+    write_shard(shard_output_dirs[0], 3)
+    write_shard(shard_output_dirs[1], 2)
+    path_to_output = tmp_path / "plate"
+    path_to_output.mkdir()
+
+    merge_shard_outputs(shard_output_dirs, path_to_output)
+
+    image = pd.read_csv(path_to_output / "Image.csv")
+    assert image["ImageNumber"].tolist() == [1, 2, 3, 4, 5]
+    # without grouping, the group index follows the image number
+    assert image["Group_Index"].tolist() == [1, 2, 3, 4, 5]
+    nuclei = pd.read_csv(path_to_output / "Nuclei.csv")
+    assert nuclei["ImageNumber"].tolist() == [1, 1, 2, 2, 3, 3, 4, 4, 5, 5]
+    assert nuclei["ObjectNumber"].tolist() == [1, 2] * 5
+    # tables without image numbers come from the first shard
+    experiment = pd.read_csv(path_to_output / "Experiment.csv")
+    assert experiment["Value"].tolist() == ["shard00"]
+
+
+def test_merge_shard_outputs_keeps_group_index_of_groups(tmp_path):
+    shard_output_dirs = [tmp_path / "shard00", tmp_path / "shard01"]
+    write_shard(shard_output_dirs[0], 2, grouped=True)
+    write_shard(shard_output_dirs[1], 2, grouped=True)
+    path_to_output = tmp_path / "plate"
+    path_to_output.mkdir()
+
+    merge_shard_outputs(shard_output_dirs, path_to_output)
+
+    image = pd.read_csv(path_to_output / "Image.csv")
+    assert image["ImageNumber"].tolist() == [1, 2, 3, 4]
+    assert image["Group_Index"].tolist() == [1, 1, 1, 1]
+
+
+@pytest.fixture
+def pipeline(tmp_path) -> pathlib.Path:
+    pipeline = tmp_path / "whole_image_qc.cppipe"
+    pipeline.write_text("CellProfiler Pipeline\n")
+    return pipeline
+
+
+def plate_command(pipeline: pathlib.Path, plate_dir: pathlib.Path) -> list:
+    return ["cellprofiler", "-c", "-r", "-p", pipeline, "-o", "out", "-i", plate_dir]
+
+
+def test_input_fingerprint_changes_with_inputs(pipeline, plate_dir):
+    command = plate_command(pipeline, plate_dir)
+    fingerprint = input_fingerprint(command)
+    assert input_fingerprint(command) == fingerprint
+
+    pipeline.write_text("CellProfiler Pipeline\nMeasureImageQuality\n")
+    assert input_fingerprint(command) != fingerprint
+    fingerprint = input_fingerprint(command)
+
+    (plate_dir / "D5-1" / "D5-1_0.tif").write_bytes(b"new image")
+    assert input_fingerprint(command) != fingerprint
+    fingerprint = input_fingerprint(command)
+
+    (plate_dir / "E6-1" / "E6-1_1.tif").touch()
+    assert input_fingerprint(command) != fingerprint
+
+
+def test_input_fingerprint_of_file_list(pipeline, plate_dir, tmp_path):
+    file_list = shard_plate(plate_dir, 2, tmp_path / "shards")[1]
+    command = ["cellprofiler", "-c", "-r", "-p", pipeline, "-o", "out"]
+    command += ["--file-list", file_list]
+    fingerprint = input_fingerprint(command)
+
+    # only the images in the file list are part of the fingerprint
+    (plate_dir / "C4-1" / "C4-1_0.tif").write_bytes(b"new image")
+    assert input_fingerprint(command) == fingerprint
+    (plate_dir / "E6-1" / "E6-1_0.tif").write_bytes(b"new image")
+    assert input_fingerprint(command) != fingerprint
+
+
+def test_is_complete(tmp_path):
+    assert not is_complete(tmp_path, "abc")
+
+    write_completion_marker(tmp_path, {"name": "NF0014", "fingerprint": "abc"})
+
+    assert is_complete(tmp_path, "abc")
+    assert not is_complete(tmp_path, "def")
+    assert [path.name for path in tmp_path.iterdir()] == [COMPLETION_MARKER]
+
+
+def test_run_cellprofiler_parallel_skips_completed_runs(
+    pipeline, plate_dir, tmp_path, monkeypatch
+):
+    # a stand-in for CellProfiler that counts its runs and writes an image table
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    cellprofiler = bin_dir / "cellprofiler"
+    cellprofiler.write_text(
+        "#!/bin/sh\n"
+        f"echo run >> {tmp_path / 'runs.txt'}\n"
+        'printf "ImageNumber\\n1\\n" > "$6/Image.csv"\n'
+    )
+    cellprofiler.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.chdir(tmp_path)
+    plate_info_dictionary = {
+        "NF0014": {
+            "path_to_pipeline": pipeline,
+            "path_to_images": plate_dir,
+            "path_to_output": tmp_path / "NF0014_qc_results",
+        }
+    }
+
+    def run(**kwargs) -> int:
+        results = run_cellprofiler_parallel(
+            plate_info_dictionary,
+            "qc",
+            max_workers=1,
+            memory_budget=2**20,
+            memory_per_run=2**20,
+            progress_interval=3600,
+            retry_backoff=0,
+            **kwargs,
+        )
+        assert [result.returncode for result in results] == [0]
+        return len((tmp_path / "runs.txt").read_text().splitlines())
+
+    assert run() == 1
+    assert (tmp_path / "NF0014_qc_results" / COMPLETION_MARKER).exists()
+    # a rerun with the same inputs is skipped
+    assert run() == 1
+    assert run(force=True) == 2
+    # a changed image makes the run go again
+    (plate_dir / "C4-1" / "C4-1_0.tif").write_bytes(b"new image")
+    assert run() == 3
+    assert run() == 3
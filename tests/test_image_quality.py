@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+import scipy.linalg
+import scipy.ndimage
+from image_quality import percent_extreme, power_log_log_slope
+
+
+def rps(img: np.ndarray):
+    """
+    This function is the radial power spectrum of centrosome (centrosome.radial_power_spectrum.rps).
+    """
+    radii2 = (np.arange(img.shape[0]).reshape((img.shape[0], 1)) ** 2) + (
+        np.arange(img.shape[1]) ** 2
+    )
+    radii2 = np.minimum(radii2, np.flipud(radii2))
+    radii2 = np.minimum(radii2, np.fliplr(radii2))
+    maxwidth = min(img.shape[0], img.shape[1]) / 8.0
+    if np.ptp(img) > 0:
+        img = img / np.median(abs(img - img.mean()))
+    mag = abs(np.fft.fft2(img - np.mean(img)))
+    power = mag**2
+    radii = np.floor(np.sqrt(radii2)).astype(int) + 1
+    labels = np.arange(2, np.floor(maxwidth)).astype(int).tolist()
+    if len(labels) > 0:
+        magsum = scipy.ndimage.sum(mag, radii, labels)
+        powersum = scipy.ndimage.sum(power, radii, labels)
+        return np.array(labels), np.array(magsum), np.array(powersum)
+    return [2], [0], [0]
+
+
+def cellprofiler_slope(pixel_data: np.ndarray) -> float:
+    """
+    This function is the PowerLogLogSlope of CellProfiler MeasureImageQuality (calculate_image_blur).
+    """
+    radii, magnitude, power = rps(pixel_data)
+    if sum(magnitude) > 0 and len(np.unique(pixel_data)) > 1:
+        valid = magnitude > 0
+        radii = radii[valid].reshape((-1, 1))
+        power = power[valid].reshape((-1, 1))
+        if radii.shape[0] > 1:
+            idx = np.isfinite(np.log(power))
+            powerslope = scipy.linalg.lstsq(
+                np.hstack(
+                    (
+                        np.log(radii)[idx][:, np.newaxis],
+                        np.ones(radii.shape)[idx][:, np.newaxis],
+                    )
+                ),
+                np.log(power)[idx][:, np.newaxis],
+            )[0][0]
+            return powerslope[0]
+    return 0
+
+
+def cellprofiler_percent_extreme(pixel_data: np.ndarray):
+    """
+    This function is the PercentMaximal and PercentMinimal of CellProfiler MeasureImageQuality.
+    """
+    pixel_count = np.prod(pixel_data.shape)
+    percent_maximal = (
+        100.0 * np.sum(pixel_data == np.max(pixel_data)) / float(pixel_count)
+    )
+    percent_minimal = (
+        100.0 * np.sum(pixel_data == np.min(pixel_data)) / float(pixel_count)
+    )
+    return percent_maximal, percent_minimal
+
+
+@pytest.fixture(params=[(300, 260), (97, 131)])
+def images(request) -> np.ndarray:
+    """
+    This fixture builds 16-bit images in focus, blurred, constant and partially saturated.
+    """
+    rng = np.random.default_rng(0)
+    images = rng.poisson(200, (5,) + request.param).astype(np.uint16)
+    images[1] = scipy.ndimage.gaussian_filter(images[1].astype(float), 3).astype(
+        np.uint16
+    )
+    images[2] = 7
+    images[3, :50] = 65535
+    images[4] = scipy.ndimage.gaussian_filter(
+        rng.random(request.param) * 4000, 1
+    ).astype(np.uint16)
+    return images
+
+
+def test_power_log_log_slope_matches_cellprofiler(images):
+    # CellProfiler scales 16-bit images to [0, 1], the slope does not depend on the scale
+    expected = [cellprofiler_slope(image / 65535) for image in images]
+
+    slopes = power_log_log_slope(images)
+
+    np.testing.assert_allclose(slopes, expected, rtol=1e-10, atol=1e-12)
+    # the constant image has no contrast and the blurred one a lower slope
+    assert slopes[2] == 0
+    assert slopes[1] < slopes[0]
+
+
+def test_power_log_log_slope_workers(images):
+    np.testing.assert_array_equal(
+        power_log_log_slope(images, workers=2), power_log_log_slope(images)
+    )
+
+
+def test_power_log_log_slope_small_image():
+    # images narrower than 32 pixels have fewer than two radii, like in CellProfiler
+    image = np.random.default_rng(1).random((20, 40))
+
+    assert cellprofiler_slope(image) == 0
+    np.testing.assert_array_equal(power_log_log_slope(image[np.newaxis]), [0])
+
+
+def test_percent_extreme_matches_cellprofiler(images):
+    expected = np.array(
+        [cellprofiler_percent_extreme(image / 65535) for image in images]
+    )
+
+    percent_maximal, percent_minimal = percent_extreme(images)
+
+    np.testing.assert_allclose(percent_maximal, expected[:, 0])
+    np.testing.assert_allclose(percent_minimal, expected[:, 1])
+    assert percent_maximal[2] == percent_minimal[2] == 100
+    assert percent_maximal[3] == pytest.approx(100 * 50 / images.shape[1])
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from benchmark_projection import append_projection
+from projection import projection_dtype, sliding_window_projection
+
+
+def append_percentile_projection(
+    zstack: np.ndarray, window_size: int, q: float
+) -> np.ndarray:
+    """
+    This function builds the percentile projection with the np.append loop the segmentation scripts used before.
+    """
+    image_stack_2_5D = np.empty((0,) + zstack.shape[1:])
+    for image_index in range(zstack.shape[0] - window_size + 1):
+        image_stack_window = zstack[image_index : image_index + window_size]
+        image_stack_2_5D = np.append(
+            image_stack_2_5D,
+            np.percentile(image_stack_window, q, axis=0)[np.newaxis, :, :],
+            axis=0,
+        )
+    return image_stack_2_5D.astype(projection_dtype(zstack.dtype, "percentile"))
+
+
+@pytest.fixture(params=[np.float64, np.uint16])
+def zstack(request) -> np.ndarray:
+    return (np.random.default_rng(0).random((11, 17, 13)) * 4000).astype(request.param)
+
+
+@pytest.mark.parametrize("window_size", [1, 2, 3, 5])
+def test_max_matches_append_loop(zstack, window_size):
+    assert np.array_equal(
+        sliding_window_projection(zstack, window_size),
+        append_projection(zstack, window_size),
+    )
+
+
+@pytest.mark.parametrize("window_size", [1, 2, 3, 4, 5, 8, 17])
+@pytest.mark.parametrize("q", [0, 10, 33.3, 50, 62.5, 90, 100])
+def test_percentile_matches_append_loop(zstack, window_size, q):
+    original = zstack.copy()
+    expected = append_percentile_projection(zstack, window_size, q)
+
+    projection = sliding_window_projection(
+        zstack, window_size, reducer="percentile", q=q
+    )
+
+    assert projection.dtype == projection_dtype(zstack.dtype, "percentile")
+    assert np.array_equal(projection, expected)
+    # the windows are sorted in copies, never in the z-stack itself
+    assert np.array_equal(zstack, original)
+
+
+def test_percentile_large_window_matches_append_loop():
+    zstack = np.random.default_rng(1).random((20, 8, 8))
+
+    assert np.array_equal(
+        sliding_window_projection(zstack, 17, reducer="percentile", q=75),
+        append_percentile_projection(zstack, 17, 75),
+    )
+
+
+def test_mean_matches_numpy():
+    zstack = np.random.default_rng(2).random((9, 6, 7))
+    expected = np.stack([zstack[index : index + 3].mean(axis=0) for index in range(7)])
+
+    np.testing.assert_allclose(
+        sliding_window_projection(zstack, 3, reducer="mean"), expected
+    )
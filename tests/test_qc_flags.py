@@ -0,0 +1,77 @@
+import pathlib
+
+import numpy as np
+import pandas as pd
+import pytest
+from qc_flags import partition_path, read_qc_dataset, write_qc_dataset
+
+
+@pytest.fixture
+def flags() -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    flags = pd.DataFrame(
+        {
+            "Metadata_Plate": np.repeat(["NF0014", "NF0016"], 6),
+            "Metadata_Well": np.tile(np.repeat(["C4", "D5"], 3), 2),
+            "Metadata_Site": 2,
+            "Metadata_Zslice": np.tile(["000", "001", "002"], 4),
+        }
+    )
+    for flag in ["Blurry_DNA", "Blurry_Mito", "Saturated_DNA", "Saturated_Mito"]:
+        flags[flag] = rng.random(len(flags)) > 0.7
+    return flags
+
+
+def partition_inodes(dataset_path: pathlib.Path) -> dict:
+    return {
+        (plate, condition): partition_path(dataset_path, plate, condition).stat().st_ino
+        for plate in ["NF0014", "NF0016"]
+        for condition in ["Blurry", "Saturated"]
+    }
+
+
+def test_write_qc_dataset_skips_unchanged_partitions(flags, tmp_path):
+    dataset_path = tmp_path / "qc_flags"
+    assert write_qc_dataset(flags, dataset_path) == {"written": 4, "unchanged": 0}
+    inodes = partition_inodes(dataset_path)
+
+    assert write_qc_dataset(flags, dataset_path) == {"written": 0, "unchanged": 4}
+    assert partition_inodes(dataset_path) == inodes
+
+    # only the partition with the changed flag is rewritten
+    flags.loc[7, "Saturated_Mito"] = not flags.loc[7, "Saturated_Mito"]
+    assert write_qc_dataset(flags, dataset_path) == {"written": 1, "unchanged": 3}
+    changed = {
+        partition
+        for partition, inode in partition_inodes(dataset_path).items()
+        if inode != inodes[partition]
+    }
+    assert changed == {("NF0016", "Saturated")}
+    assert not list(dataset_path.rglob("*.partial"))
+
+
+def test_write_qc_dataset_keeps_other_plates(flags, tmp_path):
+    dataset_path = tmp_path / "qc_flags"
+    write_qc_dataset(flags[flags["Metadata_Plate"] == "NF0014"], dataset_path)
+
+    assert write_qc_dataset(
+        flags[flags["Metadata_Plate"] == "NF0016"], dataset_path
+    ) == {"written": 2, "unchanged": 0}
+
+    dataset = read_qc_dataset(dataset_path)
+    assert len(dataset) == len(flags) * 4
+    assert set(dataset["Metadata_Plate"]) == {"NF0014", "NF0016"}
+
+
+def test_read_qc_dataset_partitions(flags, tmp_path):
+    dataset_path = tmp_path / "qc_flags"
+    write_qc_dataset(flags, dataset_path)
+
+    dataset = read_qc_dataset(dataset_path, plates=["NF0016"], conditions=["Blurry"])
+
+    expected = flags[flags["Metadata_Plate"] == "NF0016"]
+    assert len(dataset) == len(expected) * 2
+    assert set(dataset["Condition"]) == {"Blurry"}
+    assert (
+        dataset["Failed"].sum() == expected[["Blurry_DNA", "Blurry_Mito"]].sum().sum()
+    )
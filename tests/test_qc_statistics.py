@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import pytest
+from qc_statistics import RELATIVE_ACCURACY, FeatureStatistics, QuantileSketch
+
+QUANTILES = [0, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 1]
+
+
+@pytest.fixture
+def values() -> np.ndarray:
+    # slopes are negative, saturation percents are mostly zero and spread over orders of magnitude
+    rng = np.random.default_rng(0)
+    return np.concatenate(
+        [
+            -rng.lognormal(0.5, 0.4, 3000),
+            rng.lognormal(-2, 2, 2000),
+            np.zeros(500),
+        ]
+    )
+
+
+@pytest.mark.parametrize("relative_accuracy", [RELATIVE_ACCURACY, 0.05])
+def test_quantile_sketch_relative_error(values, relative_accuracy):
+    sketch = QuantileSketch(relative_accuracy)
+    sketch.add(values)
+
+    for q in QUANTILES:
+        # the sketch estimates the value at rank q * (count - 1)
+        expected = np.quantile(values, q, method="lower")
+        assert abs(sketch.quantile(q) - expected) <= relative_accuracy * abs(
+            expected
+        ) * (1 + 1e-9)
+
+
+def test_quantile_sketch_merge(values):
+    sketch = QuantileSketch()
+    sketch.add(values)
+    merged = QuantileSketch()
+    for batch in np.array_split(np.random.default_rng(1).permutation(values), 4):
+        other = QuantileSketch()
+        other.add(batch)
+        merged.merge(other)
+
+    assert merged.count == sketch.count == len(values)
+    assert merged.positive == sketch.positive
+    assert merged.negative == sketch.negative
+    assert merged.zero_count == sketch.zero_count
+    assert [merged.quantile(q) for q in QUANTILES] == [
+        sketch.quantile(q) for q in QUANTILES
+    ]
+
+
+def test_quantile_sketch_merge_other_accuracy():
+    with pytest.raises(ValueError):
+        QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+
+def test_quantile_sketch_missing_values():
+    sketch = QuantileSketch()
+    assert np.isnan(sketch.quantile(0.5))
+
+    sketch.add(np.array([np.nan, 2.0, np.nan]))
+
+    assert sketch.count == 1
+    assert sketch.quantile(0.5) == pytest.approx(2, rel=RELATIVE_ACCURACY)
+
+
+@pytest.fixture
+def qc_df(values) -> pd.DataFrame:
+    rng = np.random.default_rng(2)
+    qc_df = pd.DataFrame(
+        {
+            "ImageQuality_PowerLogLogSlope_DNA": rng.permutation(values),
+            "ImageQuality_PercentMaximal_DNA": rng.permutation(values),
+        }
+    )
+    qc_df.iloc[::7, 1] = np.nan
+    return qc_df
+
+
+def test_feature_statistics_merge(qc_df):
+    features = list(qc_df.columns)
+    statistics = FeatureStatistics(features)
+    statistics.update(qc_df)
+    # the plates are added one at a time and by separate workers
+    merged = FeatureStatistics(features)
+    for start in range(0, len(qc_df), 2000):
+        plate_statistics = FeatureStatistics(features)
+        plate_statistics.update(qc_df.iloc[start : start + 2000])
+        merged.merge(plate_statistics)
+
+    assert merged.count.tolist() == qc_df.count().tolist()
+    pd.testing.assert_series_equal(merged.mean, qc_df.mean(), check_names=False)
+    pd.testing.assert_series_equal(merged.std, qc_df.std(ddof=0), check_names=False)
+    pd.testing.assert_frame_equal(merged.summary(), statistics.summary())
+
+
+def test_feature_statistics_empty_plate(qc_df):
+    features = list(qc_df.columns)
+    statistics = FeatureStatistics(features)
+    statistics.update(qc_df.iloc[:0])
+    statistics.update(qc_df)
+
+    pd.testing.assert_series_equal(statistics.mean, qc_df.mean(), check_names=False)
+
+
+def test_feature_statistics_merge_other_features(qc_df):
+    with pytest.raises(ValueError):
+        FeatureStatistics(list(qc_df.columns)).merge(
+            FeatureStatistics(list(qc_df.columns[:1]))
+        )
@@ -0,0 +1,132 @@
+"""
+This script compares the runtime of the shared sliding window projection (see projection.py) with the loop that
+the segmentation scripts used before, which appends every projected z-slice to a growing array with `np.append`.
+The projections of both are checked to be identical before timing.
+
+Example:
+    python benchmark_projection.py --z_slices 40 --size 1024 --repeats 3
+"""
+
+import argparse
+import time
+
+import numpy as np
+from projection import sliding_window_projection
+
+
+def append_projection(zstack: np.ndarray, window_size: int = 3) -> np.ndarray:
+    """
+    This function builds the max projection of every sliding window with the loop the segmentation scripts used
+    before (reallocating and copying the growing projection for every z-slice).
+
+    Args:
+        zstack (np.ndarray): z-stack with shape (z-slices, height, width)
+        window_size (int, optional): number of z-slices in each window. Defaults to 3.
+
+    Returns:
+        np.ndarray: projection with shape (z-slices - window_size + 1, height, width)
+    """
+    image_stack_2_5D = np.empty(
+        (0, zstack.shape[1], zstack.shape[2]), dtype=zstack.dtype
+    )
+    for image_index in range(zstack.shape[0]):
+        image_stack_window = zstack[image_index : image_index + window_size]
+        if not image_stack_window.shape[0] == window_size:
+            break
+        image_stack_2_5D = np.append(
+            image_stack_2_5D,
+            np.max(image_stack_window, axis=0)[np.newaxis, :, :],
+            axis=0,
+        )
+    return image_stack_2_5D
+
+
+def best_time(function, repeats: int) -> float:
+    """
+    This function times a function a number of times.
+
+    Args:
+        function (Callable[[], object]): function to time
+        repeats (int): number of runs
+
+    Returns:
+        float: fastest runtime in seconds
+    """
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the sliding window projection of a z-stack"
+    )
+    parser.add_argument(
+        "--z_slices", type=int, default=40, help="Number of z-slices (default: 40)"
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=1024,
+        help="Height and width of each z-slice (default: 1024)",
+    )
+    parser.add_argument(
+        "--window_size",
+        type=int,
+        default=3,
+        help="Size of the sliding window (default: 3)",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="Number of runs of each method (default: 3)",
+    )
+    args = parser.parse_args()
+
+    # float64 like the z-stacks after adaptive histogram equalization in the segmentation scripts
+    zstack = np.random.default_rng(0).random((args.z_slices, args.size, args.size))
+    output = np.empty(
+        (args.z_slices - args.window_size + 1, args.size, args.size), dtype=zstack.dtype
+    )
+    assert np.array_equal(
+        append_projection(zstack, args.window_size),
+        sliding_window_projection(zstack, args.window_size),
+    )
+
+    timings = {
+        "np.append loop": best_time(
+            lambda: append_projection(zstack, args.window_size), args.repeats
+        ),
+        "max": best_time(
+            lambda: sliding_window_projection(zstack, args.window_size), args.repeats
+        ),
+        "max (preallocated)": best_time(
+            lambda: sliding_window_projection(zstack, args.window_size, out=output),
+            args.repeats,
+        ),
+        "max (float32)": best_time(
+            lambda: sliding_window_projection(
+                zstack, args.window_size, dtype=np.float32
+            ),
+            args.repeats,
+        ),
+        "mean": best_time(
+            lambda: sliding_window_projection(zstack, args.window_size, reducer="mean"),
+            args.repeats,
+        ),
+        "percentile (median)": best_time(
+            lambda: sliding_window_projection(
+                zstack, args.window_size, reducer="percentile"
+            ),
+            args.repeats,
+        ),
+    }
+    print(f"Z-stack: {zstack.shape} {zstack.dtype}, window size {args.window_size}")
+    for method, seconds in timings.items():
+        print(
+            f"{method:>20}: {seconds * 1000:9.1f} ms ({timings['np.append loop'] / seconds:5.1f}x the np.append loop)"
+        )
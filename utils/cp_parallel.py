@@ -1,72 +1,820 @@
 """
-This collection of functions runs CellProfiler in parallel and can convert the results into log files
-for each process.
+This collection of functions runs CellProfiler in parallel and streams the output of each process into a log file.
+Runs are queued and started as soon as a worker slot and enough memory are free, so any number of plates
+can be run on any size of machine.
+Plates can be split into shards of wells that run as separate CellProfiler processes, and the shard outputs are
+merged back into one output per plate.
+The processes are supervised with asyncio: their output is written to the logs line by line while they run,
+progress is printed for each run, and runs that stop printing output are reported as stalled.
+Each run that completes writes a marker with a fingerprint of its inputs into its output directory, so a rerun
+skips the runs that are already done and only repeats the ones that failed or whose inputs changed.
+Failed runs are retried with a backoff and the outcome of every run is saved in a JSON run summary.
+The wall time, CPU time, peak memory and I/O of each CellProfiler process are sampled from procfs and appended
+to a run metrics Parquet file, so resource requests can be sized from earlier runs.
+Pipelines with a LoadData module get a LoadData CSV for each plate or shard, written from one fast directory
+scan with the metadata regular expressions of the image catalog, so CellProfiler does not list the image
+directories and extract the metadata of every file again at the start of each run.
+Each run can have a wall-clock timeout, a resident memory limit (enforced by the sampler) and an address space
+limit (set with `setrlimit` before CellProfiler starts). A run that exceeds its limits is killed with its whole
+process group and reported as failed, so one bad plate can not take down the other runs on the node.
 """
 
-import logging
+import asyncio
+import datetime
+import functools
+import hashlib
+import json
 import multiprocessing
 import os
 import pathlib
+import re
+import resource
+import shutil
+import signal
 import subprocess
-from concurrent.futures import ProcessPoolExecutor, Future
-from typing import List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 
-from errors.exceptions import MaxWorkerError
+import pandas as pd
+from image_catalog import CHANNEL_NAMES, parse_metadata, scan_directory
 
+# memory reserved for each CellProfiler run when no estimate is given for a plate (4 GiB)
+MEMORY_PER_RUN = 4 * 1024**3
 
-def results_to_log(
-    results: List[subprocess.CompletedProcess], log_dir: pathlib.Path, run_name: str
+# CellProfiler prints a line with the image set number for each module that it runs (e.g., "Image # 12, module ...")
+PROGRESS_REGEX = re.compile(r"Image # (\d+)")
+
+# seconds between progress updates and seconds without output before a run is reported as stalled
+PROGRESS_INTERVAL = 60
+STALL_TIMEOUT = 600
+
+# name of the marker file written into the output directory of each run that completed successfully
+COMPLETION_MARKER = ".cp_complete.json"
+
+# number of times a failed run is retried and seconds to wait before the first retry (doubled for each retry)
+MAX_RETRIES = 2
+RETRY_BACKOFF = 60
+
+# seconds between samples of the resource use of each CellProfiler process
+METRICS_INTERVAL = 1
+
+# metadata columns that identify an image set (one z-slice of a well-site) in a LoadData CSV
+LOAD_DATA_KEYS = ["Metadata_Plate", "Metadata_Well", "Metadata_Site", "Metadata_Zslice"]
+
+# seconds a killed CellProfiler process gets to exit after SIGTERM before it is sent SIGKILL
+KILL_GRACE_PERIOD = 10
+
+
+def available_memory() -> int:
+    """
+    This function reads the memory that is available for new processes on the machine.
+
+    Returns:
+        int: available memory in bytes
+    """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+class MemoryBudget:
+    """
+    This class keeps track of the memory reserved by the running CellProfiler processes, so a new run only starts
+    when its memory estimate fits in the budget. One run is always allowed so a large estimate can not block the queue.
+
+    Args:
+        budget (int): total memory in bytes that the runs can reserve
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.reserved = 0
+        self._condition = asyncio.Condition()
+
+    async def reserve(self, amount: int) -> None:
+        """
+        This function waits until the amount of memory fits in the budget and reserves it.
+
+        Args:
+            amount (int): memory in bytes to reserve
+        """
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self.reserved == 0 or self.reserved + amount <= self.budget
+            )
+            self.reserved += amount
+
+    async def release(self, amount: int) -> None:
+        """
+        This function releases reserved memory and wakes up the runs waiting for memory.
+
+        Args:
+            amount (int): memory in bytes to release
+        """
+        async with self._condition:
+            self.reserved -= amount
+            self._condition.notify_all()
+
+
+def uses_load_data(path_to_pipeline: pathlib.Path) -> bool:
+    """
+    This function checks if a CellProfiler pipeline loads its images with the LoadData module.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler pipeline
+
+    Returns:
+        bool: True if the pipeline has an enabled LoadData module
+    """
+    with open(path_to_pipeline) as pipeline_file:
+        return any(
+            line.startswith("LoadData:") and "enabled:True" in line
+            for line in pipeline_file
+        )
+
+
+def write_load_data(image_paths: List[str], load_data_path: pathlib.Path) -> int:
+    """
+    This function writes a LoadData CSV with one row per image set (z-slice of a well-site) and the file and
+    path name of each channel, so CellProfiler can load the images without listing the directories and extracting
+    the metadata itself. The metadata is parsed from the paths with the regular expressions of the image catalog
+    (the same as in the Metadata module of `whole_image_qc.cppipe`), and the channels get the names that are
+    assigned in NamesAndTypes (e.g., `FileName_DNA` and `PathName_DNA` for 405).
+    Image sets without an image for every channel are left out.
+
+    Args:
+        image_paths (List[str]): absolute paths to the images
+        load_data_path (pathlib.Path): path to write the LoadData CSV to
+
+    Returns:
+        int: number of image sets in the LoadData CSV
+    """
+    images = pd.DataFrame({"path": sorted(image_paths)})
+    images = images.join(parse_metadata(images["path"])).dropna(
+        subset=LOAD_DATA_KEYS + ["Metadata_ChannelName"]
+    )
+    images["FileName"] = images["path"].map(os.path.basename)
+    images["PathName"] = images["path"].map(os.path.dirname)
+
+    # one column per channel for the file and path names of each image set
+    load_data = (
+        images.drop_duplicates(LOAD_DATA_KEYS + ["Metadata_ChannelName"])
+        .set_index(LOAD_DATA_KEYS + ["Metadata_ChannelName"])[["FileName", "PathName"]]
+        .unstack("Metadata_ChannelName")
+    )
+    channel_columns = [
+        (field, channel_name)
+        for channel_name in CHANNEL_NAMES.values()
+        for field in ("FileName", "PathName")
+    ]
+    load_data = load_data.reindex(columns=channel_columns)
+    load_data.columns = [
+        f"{field}_{channel_name}" for field, channel_name in channel_columns
+    ]
+
+    incomplete = load_data.isna().any(axis=1)
+    if incomplete.any():
+        print(
+            f"Leaving {int(incomplete.sum())} image sets without all channels out of {pathlib.Path(load_data_path).name}"
+        )
+    load_data = load_data[~incomplete].sort_index().reset_index()
+    load_data.to_csv(load_data_path, index=False)
+    return len(load_data)
+
+
+def shard_plate(
+    path_to_images: pathlib.Path,
+    num_shards: int,
+    shard_dir: pathlib.Path,
+    load_data: bool = False,
+) -> List[pathlib.Path]:
+    """
+    This function splits the images of a plate into shards of whole wells with about the same number of images
+    and writes a file list for each shard that can be passed to CellProfiler with `--file-list`
+    (or a LoadData CSV that can be passed with `--data-file`).
+
+    Args:
+        path_to_images (pathlib.Path): plate directory with one folder of images per well-site (e.g., `C4-2`)
+        num_shards (int): number of shards to split the plate into (fewer if the plate has fewer wells)
+        shard_dir (pathlib.Path): directory to write the file lists to
+        load_data (bool, optional): write a LoadData CSV instead of a file list for each shard. Defaults to False.
+
+    Returns:
+        List[pathlib.Path]: path to the file list (or LoadData CSV) of each shard
+    """
+    # group the images by well (all sites of a well are kept in the same shard)
+    wells: Dict[str, List[str]] = {}
+    with os.scandir(path_to_images) as well_site_entries:
+        for well_site_entry in well_site_entries:
+            if not well_site_entry.is_dir():
+                continue
+            with os.scandir(well_site_entry.path) as image_entries:
+                wells.setdefault(well_site_entry.name.split("-")[0], []).extend(
+                    image_entry.path
+                    for image_entry in image_entries
+                    if image_entry.is_file()
+                )
+
+    # assign the largest wells first to the shard with the fewest images
+    shards: List[List[str]] = [[] for _ in range(min(num_shards, len(wells)))]
+    for well in sorted(wells, key=lambda well: (-len(wells[well]), well)):
+        min(shards, key=len).extend(sorted(wells[well]))
+
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    file_lists = []
+    for shard_index, shard in enumerate(shards):
+        if load_data:
+            file_list = shard_dir / f"shard{shard_index:02d}_load_data.csv"
+            write_load_data(shard, file_list)
+        else:
+            file_list = shard_dir / f"shard{shard_index:02d}_file_list.txt"
+            file_list.write_text("\n".join(shard) + "\n")
+        file_lists.append(file_list)
+    return file_lists
+
+
+def merge_shard_outputs(
+    shard_output_dirs: List[pathlib.Path], path_to_output: pathlib.Path
 ) -> None:
     """
-    This function will take the list of subprocess.results from a CellProfiler parallelization run and
-    convert into a log file for each process.
+    This function merges the CSV outputs of the shards of a plate into one output per plate.
+    The ImageNumber of each shard is offset by the number of image sets in the previous shards, so the merged
+    tables are numbered the same as a single CellProfiler run over the whole plate.
+    Tables without an ImageNumber column (e.g., Experiment.csv) are taken from the first shard.
 
     Args:
-        results (List[subprocess.CompletedProcess]): the outputs from a subprocess.run
-        log_dir (pathlib.Path): directory for log files
-        run_name (str): a given name for the type of CellProfiler run being done on the plates (example: whole image features)
+        shard_output_dirs (List[pathlib.Path]): output directories of the shards, in shard order
+        path_to_output (pathlib.Path): output directory for the plate
     """
-    # Access the command (args) and stderr (output) for each CompletedProcess object
-    for result in results:
-        # assign plate name and decode the CellProfiler output to use in log file
-        plate_name = result.args[6].name
-        output_string = result.stderr.decode("utf-8")
+    # number of image sets in each shard comes from the image table
+    offsets = [0]
+    for shard_output_dir in shard_output_dirs[:-1]:
+        image_numbers = pd.read_csv(
+            shard_output_dir / "Image.csv", usecols=["ImageNumber"]
+        )
+        offsets.append(offsets[-1] + int(image_numbers["ImageNumber"].max()))
+
+    for table_name in sorted(
+        {path.name for path in shard_output_dirs[0].glob("*.csv")}
+    ):
+        tables = []
+        for shard_output_dir, offset in zip(shard_output_dirs, offsets):
+            table = pd.read_csv(shard_output_dir / table_name)
+            if "ImageNumber" not in table.columns:
+                break
+            table["ImageNumber"] += offset
+            # without grouping, the group index of an image set is its image number
+            if "Group_Index" in table.columns and (
+                "Group_Number" not in table.columns
+                or (table["Group_Number"] == 1).all()
+            ):
+                table["Group_Index"] += offset
+            tables.append(table)
+        if len(tables) == len(shard_output_dirs):
+            pd.concat(tables, ignore_index=True).to_csv(
+                path_to_output / table_name, index=False
+            )
+        else:
+            shutil.copy2(shard_output_dirs[0] / table_name, path_to_output / table_name)
+
+
+def input_fingerprint(command: List[str]) -> str:
+    """
+    This function computes a fingerprint of the inputs of a CellProfiler run from the pipeline file, the command
+    and the path, size and modification time of each input image (from the LoadData CSV or file list of the run,
+    or the image directory of a plate). The fingerprint changes when the pipeline or any of the images change.
+
+    Args:
+        command (List[str]): CellProfiler command
+
+    Returns:
+        str: SHA-256 hex digest of the inputs
+    """
+    command = [str(arg) for arg in command]
+    digest = hashlib.sha256()
+    digest.update(pathlib.Path(command[4]).read_bytes())
+    digest.update("\0".join(command).encode())
+
+    if "--data-file" in command:
+        load_data = pd.read_csv(command[command.index("--data-file") + 1], dtype=str)
+        image_paths = [
+            os.path.join(path_name, file_name)
+            for column in load_data.columns
+            if column.startswith("FileName_")
+            for path_name, file_name in zip(
+                load_data[column.replace("FileName_", "PathName_", 1)],
+                load_data[column],
+            )
+        ]
+    elif "--file-list" in command:
+        file_list = pathlib.Path(command[command.index("--file-list") + 1])
+        image_paths = [line for line in file_list.read_text().splitlines() if line]
+    else:
+        image_paths = [
+            os.path.join(root, file_name)
+            for root, _, file_names in os.walk(command[command.index("-i") + 1])
+            for file_name in file_names
+        ]
+    for image_path in sorted(image_paths):
+        stat = os.stat(image_path)
+        digest.update(f"{image_path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def read_completion_marker(output_dir: pathlib.Path) -> Optional[dict]:
+    """
+    This function reads the completion marker of a run.
+
+    Args:
+        output_dir (pathlib.Path): output directory of the run
+
+    Returns:
+        Optional[dict]: contents of the marker (None if the run has not completed)
+    """
+    marker_path = pathlib.Path(output_dir) / COMPLETION_MARKER
+    if not marker_path.exists():
+        return None
+    with open(marker_path) as marker_file:
+        return json.load(marker_file)
+
 
-        # set log file name as plate name from command
-        log_file_path = pathlib.Path(f"{log_dir}/{plate_name}_{run_name}_run.log")
-        # print output to a log file for each plate to view after the run
-        # set up logging configuration
-        log_format = "[%(asctime)s] [Process ID: %(process)d] %(message)s"
-        logger = logging.getLogger(plate_name)
-        handler = logging.FileHandler(log_file_path)
-        handler.setFormatter(logging.Formatter(log_format))
-        logger.addHandler(handler)
-        logger.setLevel(logging.INFO)
+def write_completion_marker(output_dir: pathlib.Path, marker: dict) -> None:
+    """
+    This function writes the completion marker of a run, through a temporary file so an interrupted write never
+    leaves a partial marker behind.
+
+    Args:
+        output_dir (pathlib.Path): output directory of the run
+        marker (dict): contents of the marker (at least the input fingerprint of the run)
+    """
+    marker_path = pathlib.Path(output_dir) / COMPLETION_MARKER
+    temp_path = marker_path.with_name(f"{COMPLETION_MARKER}.partial")
+    with open(temp_path, "w") as marker_file:
+        json.dump(marker, marker_file, indent=4)
+    os.replace(temp_path, marker_path)
 
-        # log plate name and output string
-        logger.info(f"Plate Name: {plate_name}")
-        logger.info(f"Output String: {output_string}")
 
-        # remove handler after logging to avoid duplicate logs
-        logger.removeHandler(handler)
+def is_complete(output_dir: pathlib.Path, fingerprint: str) -> bool:
+    """
+    This function checks if a run already completed with the same inputs.
+
+    Args:
+        output_dir (pathlib.Path): output directory of the run
+        fingerprint (str): input fingerprint of the run (see input_fingerprint)
+
+    Returns:
+        bool: True if the completion marker of the run has the same fingerprint
+    """
+    marker = read_completion_marker(output_dir)
+    return marker is not None and marker.get("fingerprint") == fingerprint
+
+
+def read_process_metrics(pid: int) -> Optional[dict]:
+    """
+    This function reads the resource use of a running process from procfs.
+    The CPU time includes the children of the process that it has waited for, and the peak memory is the high
+    water mark of the resident set size. The I/O bytes are only available for processes of the same user.
+
+    Args:
+        pid (int): process ID
+
+    Returns:
+        Optional[dict]: CPU time in seconds, current and peak resident memory in bytes and the bytes read from and
+            written to storage (None if the process does not exist anymore)
+    """
+    proc_dir = pathlib.Path(f"/proc/{pid}")
+    metrics = {}
+    try:
+        # the fields after the command name (in parentheses) start with the state (field 3 of proc_pid_stat)
+        stat_fields = (proc_dir / "stat").read_text().rsplit(")", 1)[1].split()
+        clock_ticks = os.sysconf("SC_CLK_TCK")
+        metrics["user_cpu_seconds"] = (
+            int(stat_fields[11]) + int(stat_fields[13])
+        ) / clock_ticks
+        metrics["system_cpu_seconds"] = (
+            int(stat_fields[12]) + int(stat_fields[14])
+        ) / clock_ticks
+
+        # the memory lines are missing once the process has exited and is waiting to be reaped
+        for line in (proc_dir / "status").read_text().splitlines():
+            key, _, value = line.partition(":")
+            if key == "VmHWM":
+                metrics["peak_rss_bytes"] = int(value.split()[0]) * 1024
+            elif key == "VmRSS":
+                metrics["rss_bytes"] = int(value.split()[0]) * 1024
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    try:
+        for line in (proc_dir / "io").read_text().splitlines():
+            key, _, value = line.partition(":")
+            if key in ("read_bytes", "write_bytes"):
+                metrics[key] = int(value)
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        pass
+    return metrics
+
+
+def limit_address_space(address_space_limit: int) -> None:
+    """
+    This function limits the virtual memory of the current process (used in the child process before CellProfiler
+    starts), so allocations above the limit fail instead of taking memory from the other runs.
+    Java reserves much more virtual memory than it uses, so the limit needs to be well above the heap size.
+
+    Args:
+        address_space_limit (int): maximum virtual memory in bytes
+    """
+    resource.setrlimit(resource.RLIMIT_AS, (address_space_limit, address_space_limit))
+
+
+async def terminate_process_group(
+    pid: int, grace_period: float = KILL_GRACE_PERIOD
+) -> None:
+    """
+    This function stops a process and all processes that it started (e.g., the JVM), first with SIGTERM and then
+    with SIGKILL if the process group is still there after the grace period.
+    The process must have been started in a new session so its process group ID is its process ID.
+
+    Args:
+        pid (int): process ID of the process group leader
+        grace_period (float, optional): seconds to wait for the processes to exit. Defaults to KILL_GRACE_PERIOD.
+    """
+    try:
+        os.killpg(pid, signal.SIGTERM)
+        await asyncio.sleep(grace_period)
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def watch_process(
+    pid: int,
+    metrics: dict,
+    interval: float = METRICS_INTERVAL,
+    timeout: Optional[float] = None,
+    memory_limit: Optional[int] = None,
+) -> None:
+    """
+    This function samples the resource use of a process until it exits or the watch is cancelled, and kills the
+    process group when the process runs longer than the timeout or its resident memory goes over the limit.
+    The cumulative values (CPU time and I/O bytes) are taken from the last sample and the peak memory is the
+    highest of all samples. The reason for killing the process is saved as "killed" in the metrics.
+
+    Args:
+        pid (int): process ID
+        metrics (dict): resource use of the process, updated with each sample
+        interval (float, optional): seconds between samples. Defaults to METRICS_INTERVAL.
+        timeout (Optional[float], optional): maximum wall time in seconds. Defaults to None (no limit).
+        memory_limit (Optional[int], optional): maximum resident memory in bytes. Defaults to None (no limit).
+    """
+    start_time = time.monotonic()
+    while (sample := read_process_metrics(pid)) is not None:
+        rss = sample.pop("rss_bytes", 0)
+        sample["peak_rss_bytes"] = max(
+            sample.get("peak_rss_bytes", 0), metrics.get("peak_rss_bytes", 0)
+        )
+        metrics.update(sample)
+
+        if "killed" not in metrics:
+            if timeout is not None and time.monotonic() - start_time > timeout:
+                metrics["killed"] = f"timeout of {timeout:g} seconds"
+            elif memory_limit is not None and rss > memory_limit:
+                metrics["killed"] = f"memory limit of {memory_limit / 1024**3:.1f} GiB"
+            if "killed" in metrics:
+                await terminate_process_group(pid)
+        await asyncio.sleep(interval)
+
+
+def append_run_metrics(rows: List[dict], metrics_path: pathlib.Path) -> None:
+    """
+    This function appends the resource use of CellProfiler runs to the run metrics Parquet file.
+    The file is rewritten through a temporary file so an interrupted write never corrupts the earlier metrics.
+
+    Args:
+        rows (List[dict]): resource use of each run attempt
+        metrics_path (pathlib.Path): path to the run metrics Parquet file
+    """
+    if not rows:
+        return
+    metrics = pd.DataFrame(rows)
+    if metrics_path.exists():
+        metrics = pd.concat([pd.read_parquet(metrics_path), metrics], ignore_index=True)
+    temp_path = metrics_path.with_name(f".{metrics_path.name}.partial")
+    metrics.to_parquet(temp_path, index=False)
+    os.replace(temp_path, metrics_path)
+
+
+async def supervise_run(
+    name: str,
+    command: List[str],
+    output_dir: pathlib.Path,
+    log_path: pathlib.Path,
+    memory_estimate: int,
+    fingerprint: str,
+    slots: asyncio.Semaphore,
+    budget: MemoryBudget,
+    progress: Dict[str, dict],
+    max_retries: int = MAX_RETRIES,
+    retry_backoff: float = RETRY_BACKOFF,
+    timeout: Optional[float] = None,
+    memory_limit: Optional[int] = None,
+    address_space_limit: Optional[int] = None,
+) -> subprocess.CompletedProcess:
+    """
+    This function runs one CellProfiler process once a worker slot and its memory are free.
+    The output (stdout and stderr) is written to the log file line by line, so memory use does not grow with the
+    length of the run, and the image set number of each progress line is recorded in the progress dictionary.
+    A failed run is retried up to `max_retries` times, waiting `retry_backoff` seconds before the first retry and
+    twice as long before each following retry (the worker slot and memory are free while waiting).
+    When the run completes, a completion marker with the input fingerprint is written into its output directory.
+    The resource use of each attempt is added to the "metrics" list of the run in the progress dictionary.
+    CellProfiler is started in a new session so it can be killed with all of its child processes when it goes over
+    the timeout or memory limit. A killed run is not retried, because it would hit the same limit again.
+
+    Args:
+        name (str): name of the run (the name of the output directory)
+        command (List[str]): CellProfiler command
+        output_dir (pathlib.Path): output directory of the run (where the completion marker is written)
+        log_path (pathlib.Path): path to the log file for the run
+        memory_estimate (int): memory in bytes to reserve for the run
+        fingerprint (str): input fingerprint of the run (see input_fingerprint)
+        slots (asyncio.Semaphore): worker slots shared by all runs
+        budget (MemoryBudget): memory budget shared by all runs
+        progress (Dict[str, dict]): progress of each run, updated while the run is going
+        max_retries (int, optional): number of times a failed run is retried. Defaults to MAX_RETRIES.
+        retry_backoff (float, optional): seconds to wait before the first retry. Defaults to RETRY_BACKOFF.
+        timeout (Optional[float], optional): maximum wall time in seconds of each attempt. Defaults to None (no limit).
+        memory_limit (Optional[int], optional): maximum resident memory in bytes. Defaults to None (no limit).
+        address_space_limit (Optional[int], optional): maximum virtual memory in bytes. Defaults to None (no limit).
+
+    Returns:
+        subprocess.CompletedProcess: the command and return code of the last attempt (the output is in the log file)
+    """
+    # remove the marker of an earlier run with other inputs, so an interrupted run is never seen as complete
+    (output_dir / COMPLETION_MARKER).unlink(missing_ok=True)
+
+    for attempt in range(1, max_retries + 2):
+        if attempt > 1:
+            progress[name]["status"] = "retrying"
+            await asyncio.sleep(retry_backoff * 2 ** (attempt - 2))
+        async with slots:
+            await budget.reserve(memory_estimate)
+            try:
+                progress[name].update(
+                    status="running", attempts=attempt, last_output=time.monotonic()
+                )
+                start_time = time.monotonic()
+                process = await asyncio.create_subprocess_exec(
+                    *[str(arg) for arg in command],
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT,
+                    limit=2**20,
+                    start_new_session=True,
+                    preexec_fn=(
+                        functools.partial(limit_address_space, address_space_limit)
+                        if address_space_limit is not None
+                        else None
+                    ),
+                )
+                attempt_metrics = {
+                    "attempt": attempt,
+                    "started": datetime.datetime.now().isoformat(),
+                }
+                watcher = asyncio.create_task(
+                    watch_process(
+                        process.pid,
+                        attempt_metrics,
+                        timeout=timeout,
+                        memory_limit=memory_limit,
+                    )
+                )
+                # the output of all attempts is kept in the same log file
+                with open(log_path, "w" if attempt == 1 else "a") as log_file:
+                    log_file.write(f"[{datetime.datetime.now()}] Plate Name: {name}\n")
+                    log_file.write(f"[{datetime.datetime.now()}] Attempt: {attempt}\n")
+                    log_file.write(
+                        f"[{datetime.datetime.now()}] Command: {' '.join(str(arg) for arg in command)}\n"
+                    )
+                    while line := await process.stdout.readline():
+                        text = line.decode("utf-8", errors="replace")
+                        log_file.write(text)
+                        log_file.flush()
+                        progress[name]["last_output"] = time.monotonic()
+                        match = PROGRESS_REGEX.search(text)
+                        if match:
+                            progress[name]["image_set"] = int(match[1])
+                    returncode = await process.wait()
+                    end_time = time.monotonic()
+                    if "killed" in attempt_metrics:
+                        log_file.write(
+                            f"[{datetime.datetime.now()}] Killed: {attempt_metrics['killed']}\n"
+                        )
+                    log_file.write(
+                        f"[{datetime.datetime.now()}] Return code: {returncode}\n"
+                    )
+                if "killed" in attempt_metrics:
+                    # the watcher sends SIGKILL to what is left of the process group after the grace period
+                    await watcher
+                else:
+                    watcher.cancel()
+                attempt_metrics.update(
+                    returncode=returncode,
+                    wall_seconds=end_time - start_time,
+                    image_sets=progress[name]["image_set"],
+                )
+                progress[name]["metrics"].append(attempt_metrics)
+                progress[name]["duration"] += end_time - start_time
+            finally:
+                await budget.release(memory_estimate)
+        progress[name]["returncode"] = returncode
+        if "killed" in attempt_metrics:
+            # a killed run failed even if CellProfiler exited cleanly on SIGTERM
+            returncode = returncode or -signal.SIGTERM
+            progress[name].update(
+                killed=attempt_metrics["killed"], returncode=returncode
+            )
+            break
+        if returncode == 0:
+            break
+
+    if returncode == 0:
+        write_completion_marker(
+            output_dir,
+            {
+                "name": name,
+                "fingerprint": fingerprint,
+                "command": [str(arg) for arg in command],
+                "completed": datetime.datetime.now().isoformat(),
+                "attempts": attempt,
+            },
+        )
+    progress[name]["status"] = "completed" if returncode == 0 else "failed"
+    return subprocess.CompletedProcess(args=command, returncode=returncode)
+
+
+async def report_progress(
+    progress: Dict[str, dict], interval: float, stall_timeout: float
+) -> None:
+    """
+    This function prints the progress of each run at a fixed interval and reports the runs that have not written
+    any output for longer than the stall timeout. It runs until it is cancelled.
+
+    Args:
+        progress (Dict[str, dict]): progress of each run
+        interval (float): seconds between progress updates
+        stall_timeout (float): seconds without output before a run is reported as stalled
+    """
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        lines = []
+        for name, run_progress in progress.items():
+            line = f"{name}: {run_progress['status']}"
+            if run_progress["status"] == "running":
+                idle = now - run_progress["last_output"]
+                line += f", image set {run_progress['image_set']}, last output {idle:.0f}s ago"
+                if idle > stall_timeout:
+                    line += " (STALLED)"
+            lines.append(line)
+        print(f"[{datetime.datetime.now():%H:%M:%S}] " + "; ".join(lines), flush=True)
+
+
+async def supervise_runs(
+    runs: List[dict],
+    progress: Dict[str, dict],
+    max_workers: int,
+    memory_budget: int,
+    progress_interval: float,
+    stall_timeout: float,
+    max_retries: int = MAX_RETRIES,
+    retry_backoff: float = RETRY_BACKOFF,
+) -> List[subprocess.CompletedProcess]:
+    """
+    This function runs all CellProfiler processes with a bounded number of worker slots and a memory budget,
+    while reporting the progress of the runs.
+
+    Args:
+        runs (List[dict]): name, command, output directory, log path, memory estimate, input fingerprint and limits
+            of each run
+        progress (Dict[str, dict]): progress of each run, updated while the runs are going
+        max_workers (int): maximum number of CellProfiler processes at once
+        memory_budget (int): memory in bytes for all running processes
+        progress_interval (float): seconds between progress updates
+        stall_timeout (float): seconds without output before a run is reported as stalled
+        max_retries (int, optional): number of times a failed run is retried. Defaults to MAX_RETRIES.
+        retry_backoff (float, optional): seconds to wait before the first retry. Defaults to RETRY_BACKOFF.
+
+    Returns:
+        List[subprocess.CompletedProcess]: the command and return code of each run, in the order of the runs
+    """
+    slots = asyncio.Semaphore(max_workers)
+    budget = MemoryBudget(memory_budget)
+    reporter = asyncio.create_task(
+        report_progress(progress, progress_interval, stall_timeout)
+    )
+    try:
+        return await asyncio.gather(
+            *[
+                supervise_run(
+                    run["name"],
+                    run["command"],
+                    run["output_dir"],
+                    run["log_path"],
+                    run["memory_estimate"],
+                    run["fingerprint"],
+                    slots,
+                    budget,
+                    progress,
+                    max_retries,
+                    retry_backoff,
+                    run["timeout"],
+                    run["memory_limit"],
+                    run["address_space_limit"],
+                )
+                for run in runs
+            ]
+        )
+    finally:
+        reporter.cancel()
 
 
 def run_cellprofiler_parallel(
     plate_info_dictionary: dict,
     run_name: str,
-) -> None:
+    max_workers: Optional[int] = None,
+    memory_budget: Optional[int] = None,
+    memory_per_run: int = MEMORY_PER_RUN,
+    shards_per_plate: Optional[int] = 1,
+    progress_interval: float = PROGRESS_INTERVAL,
+    stall_timeout: float = STALL_TIMEOUT,
+    max_retries: int = MAX_RETRIES,
+    retry_backoff: float = RETRY_BACKOFF,
+    force: bool = False,
+    metrics_path: Optional[pathlib.Path] = None,
+    timeout: Optional[float] = None,
+    memory_limit: Optional[int] = None,
+    address_space_limit: Optional[int] = None,
+) -> List[subprocess.CompletedProcess]:
     """
-    This function utilizes multi-processing to run CellProfiler pipelines in parallel.
+    This function runs CellProfiler pipelines in parallel with a bounded work queue.
+    At most `max_workers` CellProfiler processes run at the same time, and a plate only starts when its memory
+    estimate fits in the memory budget. The other plates wait in the queue and start as soon as a run finishes.
+    Plates can be split into shards of wells to use more cores than there are plates; the shard outputs are
+    merged into the plate output directory once all shards of the plate have completed.
+    The output of each run is streamed into `logs/<output name>_<run name>_run.log` while it runs.
+    When the pipeline has a LoadData module, a LoadData CSV is written for each plate (or shard) and passed to
+    CellProfiler with `--data-file` instead of the image directory.
+    Runs (plates or shards) that already completed with the same inputs are skipped, failed runs are retried with
+    a backoff, and the outcome of each run is written to `logs/<run name>_run_summary.json`.
+    The resource use of each run attempt (wall time, CPU time, peak memory and I/O bytes) is appended to the run
+    metrics Parquet file with the plate, run name and pipeline hash.
+    Runs that go over their timeout or memory limit are killed and reported as failed, while the other runs continue.
 
     Args:
         plate_info_dictionary (dict): dictionary with all paths for CellProfiler to run a pipeline
+            (optionally with a "memory_per_run" estimate in bytes, a number of "shards", a "timeout" in seconds and
+            a "memory_limit" and "address_space_limit" in bytes for a plate)
         run_name (str): a given name for the type of CellProfiler run being done on the plates (example: whole image features)
+        max_workers (Optional[int], optional): maximum number of CellProfiler processes at once, capped at the number of CPUs. Defaults to None (number of CPUs).
+        memory_budget (Optional[int], optional): memory in bytes for all running processes. Defaults to None (memory available on the machine).
+        memory_per_run (int, optional): memory in bytes reserved for each run without its own estimate. Defaults to MEMORY_PER_RUN.
+        shards_per_plate (Optional[int], optional): number of shards (CellProfiler processes) per plate without its own number,
+            or None to split the plates into enough shards to use all workers. Defaults to 1.
+        progress_interval (float, optional): seconds between progress updates. Defaults to PROGRESS_INTERVAL.
+        stall_timeout (float, optional): seconds without output before a run is reported as stalled. Defaults to STALL_TIMEOUT.
+        max_retries (int, optional): number of times a failed run is retried. Defaults to MAX_RETRIES.
+        retry_backoff (float, optional): seconds to wait before the first retry (doubled for each retry). Defaults to RETRY_BACKOFF.
+        force (bool, optional): rerun the runs that already completed with the same inputs. Defaults to False.
+        metrics_path (Optional[pathlib.Path], optional): path to the run metrics Parquet file. Defaults to None (`logs/run_metrics.parquet`).
+        timeout (Optional[float], optional): maximum wall time in seconds of each run attempt without its own timeout. Defaults to None (no limit).
+        memory_limit (Optional[int], optional): maximum resident memory in bytes of each run without its own limit. Defaults to None (no limit).
+        address_space_limit (Optional[int], optional): maximum virtual memory in bytes of each run without its own limit
+            (Java reserves much more virtual memory than it uses, so prefer `memory_limit`). Defaults to None (no limit).
 
     Raises:
         FileNotFoundError: if paths to pipeline and images do not exist
+
+    Returns:
+        List[subprocess.CompletedProcess]: the command and return code of each CellProfiler run
     """
     # create a list of commands for each plate with their respective log file
     commands = []
+    memory_estimates = []
+    plate_names = []
+    run_limits = []
+    # output directories of the shards for each sharded plate
+    plate_shards: Dict[pathlib.Path, List[pathlib.Path]] = {}
+
+    # run at most one CellProfiler process per CPU of the machine
+    if max_workers is None or max_workers > multiprocessing.cpu_count():
+        max_workers = multiprocessing.cpu_count()
+    if shards_per_plate is None:
+        shards_per_plate = max(max_workers // len(plate_info_dictionary), 1)
 
     # make logs directory
     log_dir = pathlib.Path("./logs")
@@ -91,6 +839,49 @@ def run_cellprofiler_parallel(
         # make output directory if it is not already created
         pathlib.Path(path_to_output).mkdir(exist_ok=True)
 
+        # limits of each run of the plate
+        limits = {
+            "timeout": info.get("timeout", timeout),
+            "memory_limit": info.get("memory_limit", memory_limit),
+            "address_space_limit": info.get("address_space_limit", address_space_limit),
+        }
+
+        # pipelines with LoadData get their images from a LoadData CSV instead of the image directory
+        load_data = uses_load_data(path_to_pipeline)
+
+        num_shards = info.get("shards", shards_per_plate)
+        if num_shards > 1:
+            # creates a command for each shard of the plate that only runs the images in the shard file list
+            shard_dir = pathlib.Path(path_to_output) / "shards"
+            file_lists = shard_plate(
+                pathlib.Path(path_to_images).resolve(), num_shards, shard_dir, load_data
+            )
+            plate_shards[pathlib.Path(path_to_output)] = []
+            for file_list in file_lists:
+                shard_output = (
+                    shard_dir
+                    / f"{pathlib.Path(path_to_output).name}_{file_list.name.split('_')[0]}"
+                )
+                shard_output.mkdir(exist_ok=True)
+                plate_shards[pathlib.Path(path_to_output)].append(shard_output)
+                commands.append(
+                    [
+                        "cellprofiler",
+                        "-c",
+                        "-r",
+                        "-p",
+                        path_to_pipeline,
+                        "-o",
+                        shard_output,
+                        "--data-file" if load_data else "--file-list",
+                        file_list,
+                    ]
+                )
+                memory_estimates.append(info.get("memory_per_run", memory_per_run))
+                plate_names.append(pathlib.Path(path_to_output).name)
+                run_limits.append(limits)
+            continue
+
         # creates a command for each plate in the list
         command = [
             "cellprofiler",
@@ -103,45 +894,202 @@ def run_cellprofiler_parallel(
             "-i",
             path_to_images,
         ]
+        if load_data:
+            load_data_path = (
+                pathlib.Path(path_to_output)
+                / f"{pathlib.Path(path_to_output).name}_load_data.csv"
+            )
+            write_load_data(
+                [path for path, _, _ in scan_directory(path_to_images)], load_data_path
+            )
+            command[7:9] = ["--data-file", load_data_path]
         # creates a list of commands
         commands.append(command)
+        memory_estimates.append(info.get("memory_per_run", memory_per_run))
+        plate_names.append(pathlib.Path(path_to_output).name)
+        run_limits.append(limits)
 
-    # set the number of CPUs/workers as the number of commands
-    num_processes = len(commands)
-
-    # make sure that the number of workers does not exceed the maximum number of workers for the machine
-    if num_processes > multiprocessing.cpu_count():
-        raise MaxWorkerError(
-            "Exception occurred: The number of commands exceeds the number of CPUs/workers. Please reduce the number of commands."
+    runs = [
+        {
+            "name": pathlib.Path(command[6]).name,
+            "command": command,
+            "output_dir": pathlib.Path(command[6]),
+            "log_path": log_dir / f"{pathlib.Path(command[6]).name}_{run_name}_run.log",
+            "memory_estimate": memory_estimate,
+            "fingerprint": input_fingerprint(command),
+            "plate": plate_name,
+            "pipeline_hash": hashlib.sha256(
+                pathlib.Path(command[4]).read_bytes()
+            ).hexdigest(),
+            **limits,
+        }
+        for command, memory_estimate, plate_name, limits in zip(
+            commands, memory_estimates, plate_names, run_limits
         )
-
-    # set parallelization executer to the number of commands
-    executor = ProcessPoolExecutor(max_workers=num_processes)
-
-    # creates a list of futures that are each CellProfiler process for each plate
-    futures: List[Future] = [
-        executor.submit(
-            subprocess.run,
-            args=command,
-            capture_output=True,
-        )
-        for command in commands
     ]
+    progress = {
+        run["name"]: {
+            "status": "queued",
+            "image_set": 0,
+            "last_output": time.monotonic(),
+            "attempts": 0,
+            "duration": 0.0,
+            "returncode": None,
+            "metrics": [],
+        }
+        for run in runs
+    }
 
-    # the list of CompletedProcesses holds all the information from the CellProfiler run
-    results: List[subprocess.CompletedProcess] = [future.result() for future in futures]
+    # skip the runs that already completed with the same inputs
+    pending_runs = []
+    for run in runs:
+        if not force and is_complete(run["output_dir"], run["fingerprint"]):
+            print(
+                f"Skipping {run['name']} because it already completed with the same inputs."
+            )
+            progress[run["name"]].update(status="skipped", returncode=0)
+        else:
+            pending_runs.append(run)
+
+    start_time = datetime.datetime.now()
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    supervisor = supervise_runs(
+        pending_runs,
+        progress,
+        max_workers,
+        available_memory() if memory_budget is None else memory_budget,
+        progress_interval,
+        stall_timeout,
+        max_retries,
+        retry_backoff,
+    )
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        asyncio.run(supervisor)
+    else:
+        # an event loop is already running in Jupyter, so the runs are supervised from a separate thread
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(asyncio.run, supervisor).result()
 
     print("All processes have been completed!")
 
-    # for each process, confirm that the process completed successfully and return a log file
+    # save the resource use of each run attempt (keyed by plate, run name and pipeline hash)
+    append_run_metrics(
+        [
+            {
+                "plate": run["plate"],
+                "run": run["name"],
+                "run_name": run_name,
+                "pipeline_hash": run["pipeline_hash"],
+                "fingerprint": run["fingerprint"],
+                **attempt_metrics,
+            }
+            for run in runs
+            for attempt_metrics in progress[run["name"]]["metrics"]
+        ],
+        log_dir / "run_metrics.parquet"
+        if metrics_path is None
+        else pathlib.Path(metrics_path),
+    )
+    # the resource use of all CellProfiler processes together, as counted by the kernel when they are reaped
+    end_children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    # the results of the skipped runs have a return code of 0
+    results = [
+        subprocess.CompletedProcess(
+            args=run["command"], returncode=progress[run["name"]]["returncode"]
+        )
+        for run in runs
+    ]
+
+    # for each process, confirm that the process completed successfully (the output is in the log file)
     for result in results:
-        plate_name = result.args[6].name
-        # convert the results into log files
-        results_to_log(results=results, log_dir=log_dir, run_name=run_name)
-        if result.returncode == 1:
+        plate_name = pathlib.Path(result.args[6]).name
+        if result.returncode != 0:
             print(
-                f"A return code of {result.returncode} was returned for {plate_name}, which means there was an error in the CellProfiler run."
+                f"A return code of {result.returncode} was returned for {plate_name} after {progress[plate_name]['attempts']} attempts, which means there was an error in the CellProfiler run."
             )
+        if "killed" in progress[plate_name]:
+            print(
+                f"{plate_name} was killed because it went over its {progress[plate_name]['killed']}."
+            )
+
+    # merge the shard outputs of each sharded plate where all shards completed successfully
+    # (a plate is only merged again if one of its shards ran again)
+    failed_outputs = {result.args[6] for result in results if result.returncode != 0}
+    merged_plates = {}
+    for path_to_output, shard_outputs in plate_shards.items():
+        if failed_outputs.intersection(shard_outputs):
+            print(
+                f"Not merging the shards of {path_to_output.name} because at least one shard failed."
+            )
+            merged_plates[path_to_output.name] = "failed"
+            continue
+        plate_fingerprint = hashlib.sha256(
+            "".join(
+                read_completion_marker(shard_output)["fingerprint"]
+                for shard_output in shard_outputs
+            ).encode()
+        ).hexdigest()
+        if not force and is_complete(path_to_output, plate_fingerprint):
+            merged_plates[path_to_output.name] = "skipped"
+            continue
+        (path_to_output / COMPLETION_MARKER).unlink(missing_ok=True)
+        merge_shard_outputs(shard_outputs, path_to_output)
+        write_completion_marker(
+            path_to_output,
+            {
+                "name": path_to_output.name,
+                "fingerprint": plate_fingerprint,
+                "shards": [str(shard_output) for shard_output in shard_outputs],
+                "completed": datetime.datetime.now().isoformat(),
+            },
+        )
+        merged_plates[path_to_output.name] = "merged"
+        print(f"Merged {len(shard_outputs)} shards into {path_to_output.name}")
+
+    # write a machine-readable summary of the outcome of each run
+    summary = {
+        "run_name": run_name,
+        "started": start_time.isoformat(),
+        "finished": datetime.datetime.now().isoformat(),
+        "runs": [
+            {
+                "name": run["name"],
+                "output": str(run["output_dir"]),
+                "log": str(run["log_path"]),
+                "status": progress[run["name"]]["status"],
+                "returncode": progress[run["name"]]["returncode"],
+                "attempts": progress[run["name"]]["attempts"],
+                "killed": progress[run["name"]].get("killed"),
+                "duration_seconds": round(progress[run["name"]]["duration"], 1),
+                "peak_rss_bytes": max(
+                    (
+                        metrics.get("peak_rss_bytes", 0)
+                        for metrics in progress[run["name"]]["metrics"]
+                    ),
+                    default=None,
+                ),
+                "fingerprint": run["fingerprint"],
+            }
+            for run in runs
+        ],
+        "merged_plates": merged_plates,
+        "children_usage": {
+            "user_cpu_seconds": round(
+                end_children_usage.ru_utime - children_usage.ru_utime, 1
+            ),
+            "system_cpu_seconds": round(
+                end_children_usage.ru_stime - children_usage.ru_stime, 1
+            ),
+            # ru_maxrss is in KiB on Linux and is the peak of the largest child
+            "max_peak_rss_bytes": end_children_usage.ru_maxrss * 1024,
+        },
+    }
+    summary_path = log_dir / f"{run_name}_run_summary.json"
+    with open(summary_path, "w") as summary_file:
+        json.dump(summary, summary_file, indent=4)
+    print(f"Run summary saved to {summary_path}")
 
-    # to avoid having multiple print statements due to for loop, confirmation that logs are converted is printed here
-    print("All results have been converted to log files!")
+    return results
@@ -0,0 +1,396 @@
+"""
+This collection of functions builds and queries a persistent catalog of all images (raw z-slices and z-stacks).
+Each plate directory is walked one time with os.scandir and the metadata (plate, well, site, channel and z-slice)
+is parsed from the folder and file names with the same regular expressions as the CellProfiler pipeline.
+The catalog is saved as a Parquet file so that each step of the pipeline can look up its input files
+without listing directories on the network filesystem again.
+"""
+
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+import tifffile
+
+# regular expressions from `whole_image_qc.cppipe` (the folder expression also matches the z-stack directories)
+FOLDER_REGEX = r"(?P<Plate>NF[0-9]{4})_(?P<Kind>raw|zstack)_images/(?P<Well>[A-P][0-9]{1,2})-(?P<Site>[0-9]+)"
+FILE_REGEX = r"(?P<Channel>[0-9]{3}|TRANS)(?:_(?P<Zslice>ZS[0-9]{3}))?\.tiff?$"
+
+# channel names assigned to each wavelength in the CellProfiler pipeline
+CHANNEL_NAMES = {
+    "405": "DNA",
+    "488": "ER",
+    "555": "AGP",
+    "640": "Mito",
+    "TRANS": "Brightfield",
+}
+
+# metadata columns that identify an image set (one z-slice of a well-site) in the CellProfiler outputs
+IMAGE_SET_KEYS = ["Metadata_Plate", "Metadata_Well", "Metadata_Site", "Metadata_Zslice"]
+
+# image extensions that are included in the catalog
+IMAGE_EXTENSIONS = {".tif", ".tiff"}
+
+CATALOG_COLUMNS = [
+    "path",
+    "size",
+    "mtime_ns",
+    "Metadata_Kind",
+    "Metadata_Plate",
+    "Metadata_Well",
+    "Metadata_Site",
+    "Metadata_WellSite",
+    "Metadata_Channel",
+    "Metadata_ChannelName",
+    "Metadata_Zslice",
+    "shape",
+    "dtype",
+]
+
+
+def scan_directory(root_dir: pathlib.Path) -> List[Tuple[str, int, int]]:
+    """
+    This function walks a directory tree one time with os.scandir and collects every image file.
+
+    Args:
+        root_dir (pathlib.Path): path to the directory to walk (e.g., a plate directory)
+
+    Returns:
+        List[Tuple[str, int, int]]: list of (absolute path, size in bytes, modification time in ns) per image
+    """
+    images = []
+    stack = [str(pathlib.Path(root_dir).resolve())]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # OME-Zarr stores hold thousands of chunk files and no TIFFs, so they are not walked
+                    if not entry.name.endswith(".zarr"):
+                        stack.append(entry.path)
+                elif (
+                    entry.is_file()
+                    and not entry.name.startswith(".")
+                    and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+                ):
+                    stat = entry.stat()
+                    images.append((entry.path, stat.st_size, stat.st_mtime_ns))
+    return images
+
+
+def parse_metadata(paths: pd.Series) -> pd.DataFrame:
+    """
+    This function parses the metadata from the image paths with vectorized regular expressions.
+
+    Args:
+        paths (pd.Series): absolute paths to the images
+
+    Returns:
+        pd.DataFrame: metadata columns (Metadata_*) for each path, with NaN where the path does not match
+    """
+    folders = paths.str.extract(FOLDER_REGEX)
+    files = paths.str.extract(FILE_REGEX)
+    metadata = pd.DataFrame(
+        {
+            "Metadata_Kind": folders["Kind"],
+            "Metadata_Plate": folders["Plate"],
+            "Metadata_Well": folders["Well"],
+            "Metadata_Site": pd.to_numeric(folders["Site"]).astype("Int64"),
+            "Metadata_WellSite": folders["Well"] + "-" + folders["Site"],
+            "Metadata_Channel": files["Channel"],
+            "Metadata_ChannelName": files["Channel"].map(CHANNEL_NAMES),
+            "Metadata_Zslice": files["Zslice"],
+        },
+        index=paths.index,
+    )
+    return metadata
+
+
+def read_tiff_header(path: str) -> Tuple[Optional[List[int]], Optional[str]]:
+    """
+    This function reads the shape and data type of an image from its TIFF header without decoding the pixels.
+
+    Args:
+        path (str): path to the image
+
+    Returns:
+        Tuple[Optional[List[int]], Optional[str]]: shape and data type of the image (None if the header can not be read)
+    """
+    try:
+        with tifffile.TiffFile(path) as tif:
+            series = tif.series[0]
+            return list(series.shape), str(series.dtype)
+    except (OSError, ValueError, IndexError, tifffile.TiffFileError):
+        return None, None
+
+
+def build_catalog(
+    root_dirs: Iterable[pathlib.Path],
+    catalog_path: pathlib.Path,
+    read_headers: bool = True,
+    max_workers: int = 16,
+) -> pd.DataFrame:
+    """
+    This function builds (or updates) the image catalog for the given directories and saves it as a Parquet file.
+    Rows for other directories already in the catalog are kept, and header information is reused for files
+    that have not changed since the last build.
+
+    Args:
+        root_dirs (Iterable[pathlib.Path]): directories to catalog (e.g., `data/NF0014_raw_images`)
+        catalog_path (pathlib.Path): path to the Parquet catalog
+        read_headers (bool, optional): read the shape and data type from each TIFF header. Defaults to True.
+        max_workers (int, optional): number of threads used to walk directories and read headers. Defaults to 16.
+
+    Returns:
+        pd.DataFrame: the full catalog
+    """
+    root_dirs = [
+        str(pathlib.Path(root_dir).resolve(strict=True)) for root_dir in root_dirs
+    ]
+
+    # walk each directory one time (in parallel across directories)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        scans = list(executor.map(scan_directory, root_dirs))
+    catalog = pd.DataFrame(
+        [image for scan in scans for image in scan],
+        columns=["path", "size", "mtime_ns"],
+    )
+    catalog = pd.concat([catalog, parse_metadata(catalog["path"])], axis=1)
+    catalog["shape"] = None
+    catalog["dtype"] = None
+
+    # keep rows from other directories and reuse headers for files that did not change
+    existing = (
+        load_catalog(catalog_path) if pathlib.Path(catalog_path).exists() else None
+    )
+    if existing is not None:
+        in_roots = existing["path"].apply(
+            lambda path: any(path.startswith(root + os.sep) for root in root_dirs)
+        )
+        previous = existing[in_roots].set_index("path")
+        unchanged = catalog["path"].isin(previous.index)
+        unchanged[unchanged] = (
+            previous.loc[catalog.loc[unchanged, "path"], ["size", "mtime_ns"]].values
+            == catalog.loc[unchanged, ["size", "mtime_ns"]].values
+        ).all(axis=1)
+        catalog.loc[unchanged, "shape"] = previous.loc[
+            catalog.loc[unchanged, "path"], "shape"
+        ].values
+        catalog.loc[unchanged, "dtype"] = previous.loc[
+            catalog.loc[unchanged, "path"], "dtype"
+        ].values
+        catalog = pd.concat([existing[~in_roots], catalog], ignore_index=True)
+
+    if read_headers:
+        missing = catalog["dtype"].isna()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            headers = list(executor.map(read_tiff_header, catalog.loc[missing, "path"]))
+        catalog.loc[missing, "shape"] = pd.Series(
+            [shape for shape, _ in headers], index=catalog.index[missing], dtype=object
+        )
+        catalog.loc[missing, "dtype"] = [dtype for _, dtype in headers]
+
+    catalog = catalog[CATALOG_COLUMNS].sort_values("path", ignore_index=True)
+    pathlib.Path(catalog_path).parent.mkdir(parents=True, exist_ok=True)
+    catalog.to_parquet(catalog_path, index=False)
+    return catalog
+
+
+def load_catalog(catalog_path: pathlib.Path) -> pd.DataFrame:
+    """
+    This function loads the image catalog from a Parquet file.
+
+    Args:
+        catalog_path (pathlib.Path): path to the Parquet catalog
+
+    Returns:
+        pd.DataFrame: the catalog
+    """
+    catalog = pd.read_parquet(catalog_path)
+    catalog["shape"] = catalog["shape"].apply(
+        lambda shape: None if shape is None else [int(x) for x in shape]
+    )
+    return catalog
+
+
+class ImageCatalog:
+    """
+    This class provides a small query API on top of the image catalog.
+    """
+
+    def __init__(
+        self, catalog: pd.DataFrame, catalog_path: Optional[pathlib.Path] = None
+    ):
+        self.catalog = catalog
+        self.catalog_path = catalog_path
+
+    @classmethod
+    def load(cls, catalog_path: pathlib.Path) -> "ImageCatalog":
+        """
+        Load the catalog from a Parquet file.
+
+        Args:
+            catalog_path (pathlib.Path): path to the Parquet catalog
+
+        Returns:
+            ImageCatalog: the loaded catalog
+        """
+        return cls(load_catalog(catalog_path), catalog_path)
+
+    @classmethod
+    def build(
+        cls, root_dirs: Iterable[pathlib.Path], catalog_path: pathlib.Path, **kwargs
+    ) -> "ImageCatalog":
+        """
+        Build (or update) the catalog for the given directories (see `build_catalog`).
+
+        Args:
+            root_dirs (Iterable[pathlib.Path]): directories to catalog
+            catalog_path (pathlib.Path): path to the Parquet catalog
+
+        Returns:
+            ImageCatalog: the built catalog
+        """
+        return cls(build_catalog(root_dirs, catalog_path, **kwargs), catalog_path)
+
+    def query(
+        self,
+        kind: Optional[str] = None,
+        plate: Optional[str] = None,
+        well_site: Optional[str] = None,
+        channel: Optional[str] = None,
+        zslice: Optional[str] = None,
+        directory: Optional[pathlib.Path] = None,
+    ) -> pd.DataFrame:
+        """
+        Select the images that match all of the given metadata values.
+
+        Args:
+            kind (Optional[str], optional): "raw" or "zstack". Defaults to None.
+            plate (Optional[str], optional): plate name (e.g., "NF0014"). Defaults to None.
+            well_site (Optional[str], optional): well-site name (e.g., "C4-2"). Defaults to None.
+            channel (Optional[str], optional): channel wavelength (e.g., "405") or name (e.g., "DNA"). Defaults to None.
+            zslice (Optional[str], optional): z-slice (e.g., "ZS000"). Defaults to None.
+            directory (Optional[pathlib.Path], optional): only images directly within this directory. Defaults to None.
+
+        Returns:
+            pd.DataFrame: matching rows of the catalog, sorted by path
+        """
+        mask = pd.Series(True, index=self.catalog.index)
+        if kind is not None:
+            mask &= self.catalog["Metadata_Kind"] == kind
+        if plate is not None:
+            mask &= self.catalog["Metadata_Plate"] == plate
+        if well_site is not None:
+            mask &= self.catalog["Metadata_WellSite"] == well_site
+        if channel is not None:
+            mask &= (self.catalog["Metadata_Channel"] == channel) | (
+                self.catalog["Metadata_ChannelName"] == channel
+            )
+        if zslice is not None:
+            mask &= self.catalog["Metadata_Zslice"] == zslice
+        if directory is not None:
+            directory = str(pathlib.Path(directory).resolve())
+            mask &= self.catalog["path"].str.rsplit(os.sep, n=1).str[0] == directory
+        return self.catalog[mask]
+
+    def plates(self, kind: str = "raw") -> List[str]:
+        """
+        List the plates in the catalog.
+
+        Args:
+            kind (str, optional): "raw" or "zstack". Defaults to "raw".
+
+        Returns:
+            List[str]: sorted plate names
+        """
+        return sorted(self.query(kind=kind)["Metadata_Plate"].dropna().unique())
+
+    def plate_directory(self, plate: str, kind: str = "raw") -> pathlib.Path:
+        """
+        Find the directory that holds the well-site folders of a plate.
+
+        Args:
+            plate (str): plate name (e.g., "NF0014")
+            kind (str, optional): "raw" or "zstack". Defaults to "raw".
+
+        Returns:
+            pathlib.Path: path to the plate directory
+        """
+        path = pathlib.Path(self.query(kind=kind, plate=plate)["path"].iloc[0])
+        return path.parent.parent
+
+    def well_sites(self, plate: str, kind: str = "raw") -> List[str]:
+        """
+        List the well-sites of a plate.
+
+        Args:
+            plate (str): plate name (e.g., "NF0014")
+            kind (str, optional): "raw" or "zstack". Defaults to "raw".
+
+        Returns:
+            List[str]: sorted well-site names
+        """
+        return sorted(
+            self.query(kind=kind, plate=plate)["Metadata_WellSite"].dropna().unique()
+        )
+
+    def channel_files(
+        self, plate: str, well_site: str, kind: str = "raw"
+    ) -> Dict[str, List[pathlib.Path]]:
+        """
+        Group the images of a well-site by channel, sorted by z-slice.
+
+        Args:
+            plate (str): plate name (e.g., "NF0014")
+            well_site (str): well-site name (e.g., "C4-2")
+            kind (str, optional): "raw" or "zstack". Defaults to "raw".
+
+        Returns:
+            Dict[str, List[pathlib.Path]]: image paths per channel wavelength
+        """
+        images = self.query(kind=kind, plate=plate, well_site=well_site).dropna(
+            subset=["Metadata_Channel"]
+        )
+        images = images.sort_values(["Metadata_Channel", "Metadata_Zslice", "path"])
+        return {
+            channel: [pathlib.Path(path) for path in group["path"]]
+            for channel, group in images.groupby("Metadata_Channel", sort=True)
+        }
+
+
+def get_channel_paths(
+    input_dir: pathlib.Path, catalog_path: Optional[pathlib.Path] = None
+) -> Dict[str, pathlib.Path]:
+    """
+    This function finds the image for each channel within a directory (e.g., the z-stacks of one well-site).
+    The catalog is used if it exists and lists the directory, otherwise the directory is listed one time and the
+    file names are parsed with the same regular expression.
+
+    Args:
+        input_dir (pathlib.Path): directory containing one image per channel
+        catalog_path (Optional[pathlib.Path], optional): path to the Parquet catalog. Defaults to None.
+
+    Returns:
+        Dict[str, pathlib.Path]: image path per channel wavelength (e.g., {"405": ...})
+    """
+    paths = None
+    if catalog_path is not None and pathlib.Path(catalog_path).exists():
+        images = ImageCatalog.load(catalog_path).query(directory=input_dir)
+        if not images.empty:
+            paths = images["path"]
+    if paths is None:
+        paths = pd.Series(
+            [path for path, _, _ in scan_directory(input_dir)], dtype=object
+        )
+        paths = paths[
+            paths.str.rsplit(os.sep, n=1).str[0]
+            == str(pathlib.Path(input_dir).resolve())
+        ]
+    channels = paths.str.extract(FILE_REGEX)["Channel"]
+    return {
+        channel: pathlib.Path(path)
+        for path, channel in sorted(zip(paths, channels))
+        if isinstance(channel, str)
+    }
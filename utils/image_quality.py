@@ -0,0 +1,517 @@
+"""
+This collection of functions measures the whole image quality metrics of the CellProfiler MeasureImageQuality
+module (PowerLogLogSlope for blur and PercentMaximal/PercentMinimal for saturation) with NumPy and SciPy.
+The z-slices of each well-site are measured in batches with one batched FFT per batch, well-sites are measured
+in parallel with a process pool, and the results are saved as Parquet with the same columns as `Image.csv`
+from the whole image QC pipeline, so QC does not need a CellProfiler environment.
+The same metrics (with basic intensity statistics) can be measured while the z-stacks are built with
+QualityAccumulator, which is fed the z-slices that are already in memory, so the raw images are only read once.
+"""
+
+import functools
+import os
+import pathlib
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.fft
+import tqdm
+from image_catalog import CHANNEL_NAMES, FILE_REGEX, IMAGE_SET_KEYS, ImageCatalog
+from zstack_io import read_zslices
+
+# number of z-slices measured together (one batched FFT per batch)
+BATCH_SIZE = 8
+
+# metrics of MeasureImageQuality that are measured for each channel
+QUALITY_METRICS = ["PowerLogLogSlope", "PercentMaximal", "PercentMinimal"]
+
+# intensity statistics that are measured for each channel while the z-stacks are built (in raw pixel values,
+# not rescaled to 0-1 like in CellProfiler)
+INTENSITY_METRICS = ["MeanIntensity", "StdIntensity", "MinIntensity", "MaxIntensity"]
+
+
+@functools.lru_cache(maxsize=8)
+def radial_bins(shape: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    This function finds the pixels of the power spectrum that are summed for each radius, the same way as the
+    radial power spectrum (`centrosome.radial_power_spectrum.rps`) used by MeasureImageQuality.
+    The radii stop at 1/8 of the smallest image dimension to avoid edge effects and the first radius (the DC
+    component) is skipped.
+
+    Args:
+        shape (Tuple[int, int]): height and width of the images
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: radius of each bin, flat pixel indices sorted by radius and
+            the position in the sorted indices where each bin starts
+    """
+    height, width = shape
+    radii2 = np.arange(height).reshape((height, 1)) ** 2 + np.arange(width) ** 2
+    radii2 = np.minimum(radii2, np.flipud(radii2))
+    radii2 = np.minimum(radii2, np.fliplr(radii2))
+    radii = (np.floor(np.sqrt(radii2)).astype(np.int64) + 1).ravel()
+    labels = np.arange(2, np.floor(min(height, width) / 8.0)).astype(np.int64)
+    if len(labels) == 0:
+        return labels, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    pixel_index = np.flatnonzero((radii >= labels[0]) & (radii <= labels[-1]))
+    pixel_index = pixel_index[np.argsort(radii[pixel_index], kind="stable")]
+    starts = np.searchsorted(radii[pixel_index], labels)
+    return labels, pixel_index, starts
+
+
+def power_log_log_slope(images: np.ndarray, workers: int = 1) -> np.ndarray:
+    """
+    This function computes the slope of the radial power spectrum on a log-log scale of each image
+    (MeasureImageQuality PowerLogLogSlope). Blurry images lose high frequencies, so their slope is more negative.
+    The slope does not depend on the intensity scale of the images, so the raw pixel values can be used.
+
+    Args:
+        images (np.ndarray): images with shape (images, height, width)
+        workers (int, optional): number of threads used for the FFT. Defaults to 1.
+
+    Returns:
+        np.ndarray: slope of each image (0 for images without contrast, like in CellProfiler)
+    """
+    images = np.asarray(images, dtype=np.float64)
+    labels, pixel_index, starts = radial_bins(images.shape[1:])
+    slopes = np.zeros(len(images))
+    if len(labels) < 2:
+        return slopes
+
+    centered = images - images.mean(axis=(1, 2), keepdims=True)
+    magnitude = np.abs(scipy.fft.fft2(centered, workers=workers))
+    magnitude = magnitude.reshape(len(images), -1)[:, pixel_index]
+    magnitude_sum = np.add.reduceat(magnitude, starts, axis=1)
+    power_sum = np.add.reduceat(magnitude**2, starts, axis=1)
+
+    # least squares fit of log(power) against log(radius) over the radii with power (per image)
+    with np.errstate(divide="ignore"):
+        log_power = np.log(power_sum)
+    valid = (magnitude_sum > 0) & np.isfinite(log_power)
+    log_radii = np.broadcast_to(np.log(labels), log_power.shape)
+    counts = valid.sum(axis=1)
+    mean_x = np.where(valid, log_radii, 0).sum(axis=1) / np.maximum(counts, 1)
+    mean_y = np.where(valid, log_power, 0).sum(axis=1) / np.maximum(counts, 1)
+    dx = np.where(valid, log_radii - mean_x[:, None], 0)
+    dy = np.where(valid, log_power - mean_y[:, None], 0)
+    variance = (dx**2).sum(axis=1)
+
+    has_contrast = np.ptp(images.reshape(len(images), -1), axis=1) > 0
+    fit = has_contrast & (counts > 1) & (variance > 0)
+    slopes[fit] = (dx * dy).sum(axis=1)[fit] / variance[fit]
+    return slopes
+
+
+def percent_extreme(images: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function computes the percent of pixels of each image that have the maximum and the minimum value of the
+    image (MeasureImageQuality PercentMaximal and PercentMinimal).
+
+    Args:
+        images (np.ndarray): images with shape (images, height, width)
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: percent of maximal and percent of minimal pixels of each image
+    """
+    pixels = np.asarray(images).reshape(len(images), -1)
+    percent_maximal = (
+        100.0
+        * (pixels == pixels.max(axis=1, keepdims=True)).sum(axis=1)
+        / pixels.shape[1]
+    )
+    percent_minimal = (
+        100.0
+        * (pixels == pixels.min(axis=1, keepdims=True)).sum(axis=1)
+        / pixels.shape[1]
+    )
+    return percent_maximal, percent_minimal
+
+
+def intensity_statistics(images: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    This function computes basic intensity statistics of each image (in raw pixel values).
+
+    Args:
+        images (np.ndarray): images with shape (images, height, width)
+
+    Returns:
+        Dict[str, np.ndarray]: value of each statistic in INTENSITY_METRICS for each image
+    """
+    pixels = np.asarray(images).reshape(len(images), -1)
+    return {
+        "MeanIntensity": pixels.mean(axis=1, dtype=np.float64),
+        "StdIntensity": pixels.std(axis=1, dtype=np.float64),
+        "MinIntensity": pixels.min(axis=1).astype(np.float64),
+        "MaxIntensity": pixels.max(axis=1).astype(np.float64),
+    }
+
+
+def measure_image_quality(
+    images: np.ndarray, workers: int = 1
+) -> Dict[str, np.ndarray]:
+    """
+    This function measures the whole image quality metrics of a batch of images.
+
+    Args:
+        images (np.ndarray): images with shape (images, height, width)
+        workers (int, optional): number of threads used for the FFT. Defaults to 1.
+
+    Returns:
+        Dict[str, np.ndarray]: value of each metric in QUALITY_METRICS for each image
+    """
+    percent_maximal, percent_minimal = percent_extreme(images)
+    return {
+        "PowerLogLogSlope": power_log_log_slope(images, workers),
+        "PercentMaximal": percent_maximal,
+        "PercentMinimal": percent_minimal,
+    }
+
+
+def measure_zslices(
+    slice_paths: List[pathlib.Path], batch_size: int = BATCH_SIZE, max_threads: int = 4
+) -> Dict[str, np.ndarray]:
+    """
+    This function measures the whole image quality metrics of the z-slices of one channel, reading and measuring
+    `batch_size` z-slices at a time so memory use does not depend on the depth of the z-stack.
+
+    Args:
+        slice_paths (List[pathlib.Path]): paths to the z-slice images
+        batch_size (int, optional): number of z-slices measured together. Defaults to BATCH_SIZE.
+        max_threads (int, optional): number of threads used to read the z-slices and for the FFT. Defaults to 4.
+
+    Returns:
+        Dict[str, np.ndarray]: value of each metric in QUALITY_METRICS for each z-slice
+    """
+    batches = []
+    for start in range(0, len(slice_paths), batch_size):
+        images = read_zslices(slice_paths[start : start + batch_size], max_threads)
+        batches.append(measure_image_quality(images, max_threads))
+    return {
+        metric: np.concatenate([batch[metric] for batch in batches])
+        for metric in QUALITY_METRICS
+    }
+
+
+def quality_table(
+    plate: str,
+    well_site: str,
+    channel_files: Dict[str, List[pathlib.Path]],
+    channel_metrics: Dict[str, Dict[str, np.ndarray]],
+) -> pd.DataFrame:
+    """
+    This function puts the metrics of every z-slice of a well-site into one table with the columns of the QC
+    pipeline `Image.csv`. Like in the LoadData CSV of the QC pipeline, only the z-slices with an image for every
+    channel are kept.
+
+    Args:
+        plate (str): plate name (e.g., "NF0014")
+        well_site (str): well-site name (e.g., "C4-2")
+        channel_files (Dict[str, List[pathlib.Path]]): z-slice paths per channel wavelength
+        channel_metrics (Dict[str, Dict[str, np.ndarray]]): value of each metric for each z-slice per channel wavelength
+
+    Returns:
+        pd.DataFrame: one row per z-slice with the metadata, file and path names and metrics of each channel
+    """
+    channel_tables = []
+    for channel, metrics in sorted(channel_metrics.items()):
+        if channel not in CHANNEL_NAMES:
+            continue
+        channel_name = CHANNEL_NAMES[channel]
+        slice_paths = [pathlib.Path(path) for path in channel_files[channel]]
+        table = pd.DataFrame(
+            {
+                f"FileName_{channel_name}": [path.name for path in slice_paths],
+                f"PathName_{channel_name}": [str(path.parent) for path in slice_paths],
+                **{
+                    f"ImageQuality_{metric}_{channel_name}": values
+                    for metric, values in metrics.items()
+                },
+            },
+            index=pd.Index(
+                [re.search(FILE_REGEX, path.name)["Zslice"] for path in slice_paths],
+                name="Metadata_Zslice",
+            ),
+        )
+        channel_tables.append(table)
+
+    well, site = well_site.split("-")
+    well_site_table = pd.concat(channel_tables, axis=1, join="inner").reset_index()
+    well_site_table.insert(0, "Metadata_Plate", plate)
+    well_site_table.insert(1, "Metadata_Well", well)
+    well_site_table.insert(2, "Metadata_Site", int(site))
+    return well_site_table
+
+
+class QualityAccumulator:
+    """
+    This class measures the QC metrics of z-slices that are passed to it one at a time (e.g., while they are read
+    for stacking), in batches of `batch_size` z-slices per channel, so the images do not need to be read again.
+    Besides the MeasureImageQuality metrics, basic intensity statistics are measured (see intensity_statistics).
+
+    Args:
+        batch_size (int, optional): number of z-slices measured together. Defaults to BATCH_SIZE.
+        workers (int, optional): number of threads used for the FFT. Defaults to 1.
+    """
+
+    def __init__(self, batch_size: int = BATCH_SIZE, workers: int = 1):
+        self.batch_size = batch_size
+        self.workers = workers
+        self._batches: Dict[str, List[np.ndarray]] = {}
+        self._metrics: Dict[str, List[Dict[str, np.ndarray]]] = {}
+
+    def add(self, channel: str, image: np.ndarray) -> None:
+        """
+        This function adds the next z-slice of a channel and measures the batch once it is full.
+
+        Args:
+            channel (str): channel wavelength (e.g., "405")
+            image (np.ndarray): pixels of the z-slice
+        """
+        batch = self._batches.setdefault(channel, [])
+        batch.append(image)
+        if len(batch) == self.batch_size:
+            self._measure(channel)
+
+    def _measure(self, channel: str) -> None:
+        batch = self._batches.pop(channel, [])
+        if batch:
+            images = np.stack(batch)
+            self._metrics.setdefault(channel, []).append(
+                {
+                    **measure_image_quality(images, self.workers),
+                    **intensity_statistics(images),
+                }
+            )
+
+    def metrics(self) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        This function measures the remaining z-slices and returns the metrics of all z-slices that were added.
+
+        Returns:
+            Dict[str, Dict[str, np.ndarray]]: value of each metric for each z-slice per channel wavelength
+        """
+        for channel in list(self._batches):
+            self._measure(channel)
+        return {
+            channel: {
+                metric: np.concatenate([batch[metric] for batch in batches])
+                for metric in batches[0]
+            }
+            for channel, batches in self._metrics.items()
+        }
+
+    def table(
+        self, plate: str, well_site: str, channel_files: Dict[str, List[pathlib.Path]]
+    ) -> pd.DataFrame:
+        """
+        This function puts the metrics of all z-slices that were added into one table (see quality_table).
+
+        Args:
+            plate (str): plate name (e.g., "NF0014")
+            well_site (str): well-site name (e.g., "C4-2")
+            channel_files (Dict[str, List[pathlib.Path]]): z-slice paths per channel wavelength, in the order they were added
+
+        Returns:
+            pd.DataFrame: one row per z-slice with the metadata, file and path names and metrics of each channel
+        """
+        return quality_table(plate, well_site, channel_files, self.metrics())
+
+
+def write_quality_table(
+    tables: List[pd.DataFrame], output_path: pathlib.Path
+) -> pd.DataFrame:
+    """
+    This function combines the QC tables of the well-sites of a plate, numbers the image sets in order and saves
+    them as Parquet, through a temporary file so an interrupted run never leaves a partial file behind.
+
+    Args:
+        tables (List[pd.DataFrame]): QC tables of the well-sites (see quality_table)
+        output_path (pathlib.Path): path to the Parquet file to write
+
+    Returns:
+        pd.DataFrame: QC metrics of every z-slice of the plate
+    """
+    plate_table = (
+        pd.concat(tables, ignore_index=True)
+        .drop(columns="ImageNumber", errors="ignore")
+        .sort_values(IMAGE_SET_KEYS)
+        .reset_index(drop=True)
+    )
+    plate_table.insert(0, "ImageNumber", np.arange(1, len(plate_table) + 1))
+
+    output_path = pathlib.Path(output_path)
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+    temp_path = output_path.with_name(f".{output_path.name}.partial")
+    plate_table.to_parquet(temp_path, index=False)
+    os.replace(temp_path, output_path)
+    return plate_table
+
+
+def quality_well_sites(output_path: pathlib.Path) -> Set[str]:
+    """
+    This function lists the well-sites that are already in a QC Parquet file.
+
+    Args:
+        output_path (pathlib.Path): path to the QC Parquet file
+
+    Returns:
+        Set[str]: well-site names (e.g., "C4-2"), empty if the file does not exist
+    """
+    if not pathlib.Path(output_path).exists():
+        return set()
+    table = pd.read_parquet(output_path, columns=["Metadata_Well", "Metadata_Site"])
+    return set(
+        table["Metadata_Well"] + "-" + table["Metadata_Site"].astype(int).astype(str)
+    )
+
+
+def update_quality_table(
+    tables: List[pd.DataFrame], output_path: pathlib.Path
+) -> Optional[pd.DataFrame]:
+    """
+    This function replaces the rows of the given well-sites in a QC Parquet file (and keeps the other well-sites).
+
+    Args:
+        tables (List[pd.DataFrame]): QC tables of the well-sites that were measured (see quality_table)
+        output_path (pathlib.Path): path to the QC Parquet file
+
+    Returns:
+        Optional[pd.DataFrame]: QC metrics of every z-slice in the file (None if there is nothing to write)
+    """
+    if not tables:
+        return (
+            pd.read_parquet(output_path) if pathlib.Path(output_path).exists() else None
+        )
+    if pathlib.Path(output_path).exists():
+        existing = pd.read_parquet(output_path)
+        measured = pd.concat(tables, ignore_index=True)[
+            ["Metadata_Well", "Metadata_Site"]
+        ].drop_duplicates()
+        existing = existing.merge(
+            measured, on=["Metadata_Well", "Metadata_Site"], how="left", indicator=True
+        )
+        existing = existing[existing["_merge"] == "left_only"].drop(columns="_merge")
+        tables = [existing] + tables
+    return write_quality_table(tables, output_path)
+
+
+def measure_well_site(
+    plate: str,
+    well_site: str,
+    channel_files: Dict[str, List[pathlib.Path]],
+    batch_size: int = BATCH_SIZE,
+    max_threads: int = 4,
+) -> pd.DataFrame:
+    """
+    This function measures the whole image quality metrics of every z-slice of a well-site in all channels.
+
+    Args:
+        plate (str): plate name (e.g., "NF0014")
+        well_site (str): well-site name (e.g., "C4-2")
+        channel_files (Dict[str, List[pathlib.Path]]): z-slice paths per channel wavelength (see ImageCatalog.channel_files)
+        batch_size (int, optional): number of z-slices measured together. Defaults to BATCH_SIZE.
+        max_threads (int, optional): number of threads used to read the z-slices and for the FFT. Defaults to 4.
+
+    Returns:
+        pd.DataFrame: one row per z-slice with the metadata, file and path names and metrics of each channel
+    """
+    channel_metrics = {
+        channel: measure_zslices(slice_paths, batch_size, max_threads)
+        for channel, slice_paths in channel_files.items()
+        if channel in CHANNEL_NAMES
+    }
+    return quality_table(plate, well_site, channel_files, channel_metrics)
+
+
+def measure_plate(
+    catalog: ImageCatalog,
+    plate: str,
+    output_path: pathlib.Path,
+    max_workers: int = 1,
+    batch_size: int = BATCH_SIZE,
+    max_threads: int = 1,
+) -> pd.DataFrame:
+    """
+    This function measures the whole image quality metrics of all raw z-slices of a plate, with one process per
+    well-site, and saves them as Parquet (one row per z-slice, with the columns of the QC pipeline `Image.csv`).
+
+    Args:
+        catalog (ImageCatalog): catalog of the images
+        plate (str): plate name (e.g., "NF0014")
+        output_path (pathlib.Path): path to the Parquet file to write
+        max_workers (int, optional): number of processes. Defaults to 1.
+        batch_size (int, optional): number of z-slices measured together. Defaults to BATCH_SIZE.
+        max_threads (int, optional): number of threads per process to read the z-slices and for the FFT. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: metrics of every z-slice of the plate
+    """
+    well_site_tables = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                measure_well_site,
+                plate,
+                well_site,
+                catalog.channel_files(plate, well_site, kind="raw"),
+                batch_size,
+                max_threads,
+            )
+            for well_site in catalog.well_sites(plate, kind="raw")
+        ]
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures), desc=plate):
+            well_site_tables.append(future.result())
+    return write_quality_table(well_site_tables, output_path)
+
+
+def compare_to_cellprofiler(
+    metrics: pd.DataFrame, image_csv_path: pathlib.Path
+) -> pd.DataFrame:
+    """
+    This function compares the metrics measured here with the `Image.csv` output of the CellProfiler QC pipeline
+    for the same images, to validate that the metrics match.
+
+    Args:
+        metrics (pd.DataFrame): metrics from measure_plate
+        image_csv_path (pathlib.Path): path to the `Image.csv` of the same plate
+
+    Returns:
+        pd.DataFrame: number of matched z-slices, maximum and mean absolute difference and correlation per metric column
+    """
+    metric_columns = [
+        column for column in metrics.columns if column.startswith("ImageQuality_")
+    ]
+    cellprofiler = pd.read_csv(
+        image_csv_path,
+        usecols=lambda column: column in IMAGE_SET_KEYS or column in metric_columns,
+    )
+    shared_columns = [
+        column for column in metric_columns if column in cellprofiler.columns
+    ]
+    metrics = metrics.astype({"Metadata_Site": int})
+    cellprofiler = cellprofiler.astype({"Metadata_Site": int})
+    merged = metrics[IMAGE_SET_KEYS + shared_columns].merge(
+        cellprofiler[IMAGE_SET_KEYS + shared_columns],
+        on=IMAGE_SET_KEYS,
+        suffixes=("_native", "_cellprofiler"),
+    )
+
+    rows = []
+    for column in shared_columns:
+        native = merged[f"{column}_native"]
+        reference = merged[f"{column}_cellprofiler"]
+        difference = (native - reference).abs()
+        rows.append(
+            {
+                "metric": column,
+                "image_sets": len(merged),
+                "max_abs_difference": difference.max(),
+                "mean_abs_difference": difference.mean(),
+                "correlation": native.corr(reference),
+            }
+        )
+    return pd.DataFrame(rows).set_index("metric")
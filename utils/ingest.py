@@ -0,0 +1,311 @@
+"""
+This collection of functions ingests the raw images from the nested acquisition folders into one flattened
+folder per plate. The acquisition tree is walked once, files are copied with a bounded thread pool, and a
+manifest is kept for each plate so that re-runs only copy new or changed files.
+Images can also be staged with hardlinks, reflinks or symlinks instead of copies (see staging.py).
+"""
+
+import csv
+import hashlib
+import os
+import pathlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+import tqdm
+from staging import stage_file
+
+# name of the manifest file written inside of each plate destination directory
+MANIFEST_NAME = ".ingest_manifest.csv"
+MANIFEST_COLUMNS = ["relative_path", "destination", "size", "mtime_ns", "hash"]
+
+# image extensions that we are looking to copy
+IMAGE_EXTENSIONS = {".tif", ".tiff"}
+
+# read files in 8 MiB chunks when hashing during the copy
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def scan_acquisition_tree(
+    parent_dir: pathlib.Path, image_extensions: Set[str] = IMAGE_EXTENSIONS
+) -> List[Tuple[str, str, int, int]]:
+    """
+    This function walks the nested acquisition tree one time with os.scandir and collects every image file.
+    The well-site folder for each image is the grandparent directory of the file (e.g., `<well folder>/<well-site>/<acquisition>/image.tif`),
+    which matches the layout of the raw data from the microscope.
+
+    Args:
+        parent_dir (pathlib.Path): path to the top of the acquisition tree for one plate
+        image_extensions (Set[str], optional): file extensions to include. Defaults to IMAGE_EXTENSIONS.
+
+    Returns:
+        List[Tuple[str, str, int, int]]: list of (relative path, well-site name, size in bytes, modification time in ns) per image
+    """
+    images = []
+    # iterative depth-first walk so the tree is only listed once
+    stack = [(str(parent_dir), ())]
+    while stack:
+        current_dir, parts = stack.pop()
+        with os.scandir(current_dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, parts + (entry.name,)))
+                elif (
+                    entry.is_file()
+                    and os.path.splitext(entry.name)[1].lower() in image_extensions
+                    # images must be at least two folders below the well-site folder
+                    and len(parts) >= 3
+                ):
+                    stat = entry.stat()
+                    images.append(
+                        (
+                            "/".join(parts + (entry.name,)),
+                            parts[-2],
+                            stat.st_size,
+                            stat.st_mtime_ns,
+                        )
+                    )
+    images.sort()
+    return images
+
+
+def read_manifest(manifest_path: pathlib.Path) -> Dict[str, dict]:
+    """
+    This function reads in the ingest manifest for a plate.
+
+    Args:
+        manifest_path (pathlib.Path): path to the manifest CSV file
+
+    Returns:
+        Dict[str, dict]: manifest records keyed by the relative path of the source image (empty if no manifest exists)
+    """
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, newline="") as manifest_file:
+        return {
+            row["relative_path"]: {
+                "destination": row["destination"],
+                "size": int(row["size"]),
+                "mtime_ns": int(row["mtime_ns"]),
+                "hash": row["hash"] or None,
+            }
+            for row in csv.DictReader(manifest_file)
+        }
+
+
+def write_manifest(manifest_path: pathlib.Path, records: Dict[str, dict]) -> None:
+    """
+    This function writes the ingest manifest for a plate. The file is written to a temporary path first and then
+    moved in place so an interrupted run never leaves a partial manifest behind.
+
+    Args:
+        manifest_path (pathlib.Path): path to the manifest CSV file
+        records (Dict[str, dict]): manifest records keyed by the relative path of the source image
+    """
+    temp_path = manifest_path.with_name(f"{manifest_path.name}.tmp")
+    with open(temp_path, "w", newline="") as manifest_file:
+        writer = csv.DictWriter(manifest_file, fieldnames=MANIFEST_COLUMNS)
+        writer.writeheader()
+        for relative_path in sorted(records):
+            record = records[relative_path]
+            writer.writerow(
+                {
+                    "relative_path": relative_path,
+                    "destination": record["destination"],
+                    "size": record["size"],
+                    "mtime_ns": record["mtime_ns"],
+                    "hash": record["hash"] or "",
+                }
+            )
+    os.replace(temp_path, manifest_path)
+
+
+def hash_file(path: pathlib.Path) -> str:
+    """
+    This function computes a fast BLAKE2b hash of a file.
+
+    Args:
+        path (pathlib.Path): path to the file to hash
+
+    Returns:
+        str: hex digest of the file contents
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_image(
+    source: pathlib.Path, destination: pathlib.Path, compute_hash: bool = False
+) -> Optional[str]:
+    """
+    This function copies one image (preserving metadata) into a temporary file next to the destination and moves it
+    in place once complete. When a hash is requested, it is computed from the same bytes that are written so the
+    source is only read once.
+
+    Args:
+        source (pathlib.Path): path to the source image
+        destination (pathlib.Path): path to copy the image to
+        compute_hash (bool, optional): compute a BLAKE2b hash during the copy. Defaults to False.
+
+    Returns:
+        Optional[str]: hex digest of the image if a hash was computed, otherwise None
+    """
+    temp_destination = destination.with_name(f".{destination.name}.partial")
+    file_hash = None
+    if compute_hash:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(source, "rb") as source_file, open(
+            temp_destination, "wb"
+        ) as destination_file:
+            while chunk := source_file.read(CHUNK_SIZE):
+                digest.update(chunk)
+                destination_file.write(chunk)
+        shutil.copystat(source, temp_destination)
+        file_hash = digest.hexdigest()
+    else:
+        shutil.copy2(source, temp_destination)
+    os.replace(temp_destination, destination)
+    return file_hash
+
+
+def _is_current(
+    record: Optional[dict], destination: pathlib.Path, size: int, mtime_ns: int
+) -> bool:
+    """
+    This function checks with one stat call if the destination image is already up to date with the source image.
+
+    Args:
+        record (Optional[dict]): manifest record for the image, if any
+        destination (pathlib.Path): path where the image is copied to
+        size (int): size of the source image in bytes
+        mtime_ns (int): modification time of the source image in ns
+
+    Returns:
+        bool: True if the destination does not need to be copied again
+    """
+    try:
+        destination_stat = destination.stat()
+    except FileNotFoundError:
+        return False
+    if destination_stat.st_size != size:
+        return False
+    if record is not None:
+        return record["size"] == size and record["mtime_ns"] == mtime_ns
+    # copies from an interrupted run keep the source mtime (copy2), so they can be reused
+    return destination_stat.st_mtime_ns == mtime_ns
+
+
+def ingest_plate(
+    parent_dir: pathlib.Path,
+    destination_dir: pathlib.Path,
+    max_workers: int = 8,
+    compute_hash: bool = False,
+    image_extensions: Set[str] = IMAGE_EXTENSIONS,
+    mode: str = "copy",
+) -> Dict[str, int]:
+    """
+    This function copies all images for a plate from the nested acquisition tree into one folder per well-site.
+    Only images that are new or have changed since the last run (based on the plate manifest) are copied.
+
+    Args:
+        parent_dir (pathlib.Path): path to the top of the acquisition tree for the plate
+        destination_dir (pathlib.Path): path to the flattened plate directory (one folder per well-site)
+        max_workers (int, optional): number of threads used to copy files. Defaults to 8.
+        compute_hash (bool, optional): compute and store a hash for each copied image (only used when copying). Defaults to False.
+        image_extensions (Set[str], optional): file extensions to include. Defaults to IMAGE_EXTENSIONS.
+        mode (str, optional): how images are staged, either "copy" or one of the link modes in staging.STAGING_MODES. Defaults to "copy".
+
+    Returns:
+        Dict[str, int]: number of images that were copied and skipped
+    """
+    destination_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = destination_dir / MANIFEST_NAME
+    records = read_manifest(manifest_path)
+
+    # find the images that need to be copied with a single walk of the tree
+    to_copy = []
+    skipped = 0
+    current_images = set()
+    for relative_path, well_site, size, mtime_ns in scan_acquisition_tree(
+        parent_dir, image_extensions
+    ):
+        destination = destination_dir / well_site / pathlib.Path(relative_path).name
+        current_images.add(relative_path)
+        record = records.get(relative_path)
+        if _is_current(record, destination, size, mtime_ns):
+            if record is None:
+                records[relative_path] = {
+                    "destination": str(destination.relative_to(destination_dir)),
+                    "size": size,
+                    "mtime_ns": mtime_ns,
+                    "hash": None,
+                }
+            skipped += 1
+            continue
+        to_copy.append((relative_path, destination, size, mtime_ns))
+
+    # drop records for images that no longer exist in the source tree
+    for relative_path in set(records) - current_images:
+        del records[relative_path]
+
+    # create the well-site directories once before copying
+    for destination in {destination.parent for _, destination, _, _ in to_copy}:
+        destination.mkdir(parents=True, exist_ok=True)
+
+    def _copy(item: Tuple[str, pathlib.Path, int, int]) -> Tuple[str, Optional[str]]:
+        relative_path, destination, _, _ = item
+        if mode != "copy":
+            stage_file(parent_dir / relative_path, destination, mode)
+            return relative_path, None
+        return relative_path, copy_image(
+            parent_dir / relative_path, destination, compute_hash
+        )
+
+    copied = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for (relative_path, file_hash), (_, destination, size, mtime_ns) in zip(
+                tqdm.tqdm(executor.map(_copy, to_copy), total=len(to_copy)), to_copy
+            ):
+                # confirm the transfer from the file size instead of reading the copy back
+                if destination.stat().st_size != size:
+                    raise OSError(
+                        f"Copied file '{destination}' does not match the size of the source image"
+                    )
+                records[relative_path] = {
+                    "destination": str(destination.relative_to(destination_dir)),
+                    "size": size,
+                    "mtime_ns": mtime_ns,
+                    "hash": file_hash,
+                }
+                copied += 1
+    finally:
+        # always save progress so an interrupted run can pick up where it left off
+        write_manifest(manifest_path, records)
+
+    return {"copied": copied, "skipped": skipped}
+
+
+def verify_plate(destination_dir: pathlib.Path) -> List[str]:
+    """
+    This function checks the copied images for a plate against the hashes stored in the manifest.
+    Only images that were copied with a hash are checked.
+
+    Args:
+        destination_dir (pathlib.Path): path to the flattened plate directory
+
+    Returns:
+        List[str]: relative paths (in the source tree) of images that are missing or do not match their hash
+    """
+    mismatched = []
+    for relative_path, record in read_manifest(destination_dir / MANIFEST_NAME).items():
+        if record["hash"] is None:
+            continue
+        destination = destination_dir / record["destination"]
+        if not destination.exists() or hash_file(destination) != record["hash"]:
+            mismatched.append(relative_path)
+    return mismatched
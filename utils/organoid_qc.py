@@ -0,0 +1,273 @@
+"""
+This collection of functions turns the z-slice QC flags into an organoid-level verdict before segmentation.
+An organoid (well-site) fails QC if more than a given number of its z-slices are flagged for any condition in any
+channel. The failed organoids are saved in a skip list (CSV) that the segmentation scripts check before loading any
+images. Each segmentation step also saves its runtime per well-site in a runtime directory (outside of the mask directories, so the file counts checked
+before feature extraction do not change), which is used to estimate how much compute the skip list saved.
+Organoids that pass can still have single flagged z-slices, which the segmentation scripts leave out of the
+sliding window projection and Cellpose input (see flagged_zslices and zrange.kept_zslices).
+"""
+
+import json
+import os
+import pathlib
+import re
+import warnings
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+from image_catalog import FOLDER_REGEX
+from qc_flags import read_qc_dataset
+
+# organoids with more than this number of flagged z-slices (for any condition in any channel) are skipped
+MAX_FAILED_ZSLICES = 1
+
+# columns that identify an organoid
+ORGANOID_KEYS = ["Metadata_Plate", "Metadata_Well", "Metadata_Site"]
+
+# suffix of the runtime file each segmentation step writes per well-site (e.g., `NF0014_C4-2_nuclei_runtime.json`)
+RUNTIME_SUFFIX = "_runtime.json"
+
+
+def organoid_verdicts(
+    qc_flags_df: pd.DataFrame, max_failed_zslices: int = MAX_FAILED_ZSLICES
+) -> pd.DataFrame:
+    """
+    This function decides for every organoid if it fails QC, based on the number of its z-slices that are flagged
+    for any condition in any channel.
+
+    Args:
+        qc_flags_df (pd.DataFrame): long format flags with one row per z-slice, condition and channel (see qc_flags.read_qc_dataset)
+        max_failed_zslices (int, optional): maximum number of flagged z-slices of an organoid that passes. Defaults to MAX_FAILED_ZSLICES.
+
+    Returns:
+        pd.DataFrame: one row per organoid with the number of z-slices, the number of flagged z-slices and if it is skipped
+    """
+    zslices = (
+        qc_flags_df.astype({"Metadata_Well": str, "Metadata_Zslice": str})
+        .groupby(ORGANOID_KEYS + ["Metadata_Zslice"], observed=True)["Failed"]
+        .any()
+        .reset_index()
+    )
+    verdicts = (
+        zslices.groupby(ORGANOID_KEYS, observed=True)["Failed"]
+        .agg(total_zslices="size", failed_zslices="sum")
+        .reset_index()
+    )
+    verdicts["Metadata_Site"] = verdicts["Metadata_Site"].astype(int)
+    verdicts["Skip"] = verdicts["failed_zslices"] > max_failed_zslices
+    return verdicts
+
+
+def write_skip_list(
+    verdicts: pd.DataFrame, skip_list_path: pathlib.Path
+) -> pd.DataFrame:
+    """
+    This function saves the organoids that failed QC as a CSV with one row per organoid, through a temporary file
+    so an interrupted run never leaves a partial skip list behind.
+
+    Args:
+        verdicts (pd.DataFrame): verdict of every organoid (see organoid_verdicts)
+        skip_list_path (pathlib.Path): path to the CSV file to write
+
+    Returns:
+        pd.DataFrame: skipped organoids with their well-site name (e.g., "C4-2")
+    """
+    skip_list = verdicts.loc[
+        verdicts["Skip"], ORGANOID_KEYS + ["total_zslices", "failed_zslices"]
+    ]
+    skip_list.insert(
+        3,
+        "Metadata_WellSite",
+        skip_list["Metadata_Well"] + "-" + skip_list["Metadata_Site"].astype(str),
+    )
+
+    skip_list_path = pathlib.Path(skip_list_path)
+    temp_path = skip_list_path.with_name(f".{skip_list_path.name}.partial")
+    skip_list.to_csv(temp_path, index=False)
+    os.replace(temp_path, skip_list_path)
+    return skip_list
+
+
+def read_skip_list(skip_list_path: pathlib.Path) -> Set[Tuple[str, str]]:
+    """
+    This function reads the organoids that are in a skip list.
+
+    Args:
+        skip_list_path (pathlib.Path): path to the skip list CSV
+
+    Returns:
+        Set[Tuple[str, str]]: plate and well-site name of each skipped organoid (empty if there is no skip list)
+    """
+    if not pathlib.Path(skip_list_path).exists():
+        return set()
+    skip_list = pd.read_csv(
+        skip_list_path, usecols=["Metadata_Plate", "Metadata_WellSite"], dtype=str
+    )
+    return set(zip(skip_list["Metadata_Plate"], skip_list["Metadata_WellSite"]))
+
+
+def organoid_key(input_dir: pathlib.Path) -> Optional[Tuple[str, str]]:
+    """
+    This function gets the plate and well-site name of a well-site directory from its path
+    (e.g., `data/NF0014_zstack_images/C4-2`).
+
+    Args:
+        input_dir (pathlib.Path): path to the well-site directory
+
+    Returns:
+        Optional[Tuple[str, str]]: plate and well-site name (None if the path does not contain the plate)
+    """
+    match = re.search(FOLDER_REGEX, pathlib.Path(input_dir).resolve().as_posix())
+    if match is None:
+        return None
+    return match["Plate"], f"{match['Well']}-{match['Site']}"
+
+
+def _warn_unknown_organoid(input_dir: pathlib.Path) -> None:
+    warnings.warn(
+        f"Could not find the plate and well-site of {input_dir} (expected a path like "
+        "`data/NF0014_zstack_images/C4-2`), so it is not checked against the QC results"
+    )
+
+
+def is_skipped(input_dir: pathlib.Path, skip_list_path: pathlib.Path) -> bool:
+    """
+    This function checks if the organoid of a well-site directory is in the skip list.
+
+    Args:
+        input_dir (pathlib.Path): path to the well-site directory
+        skip_list_path (pathlib.Path): path to the skip list CSV
+
+    Returns:
+        bool: True if the organoid failed QC
+    """
+    key = organoid_key(input_dir)
+    if key is None:
+        _warn_unknown_organoid(input_dir)
+        return False
+    return key in read_skip_list(skip_list_path)
+
+
+def flagged_zslices(
+    input_dir: pathlib.Path, qc_dataset_path: pathlib.Path, z_count: int
+) -> List[int]:
+    """
+    This function finds the z-slices of the z-stack of a well-site that are flagged for any condition in any
+    channel. The z-slices of the well-site in the QC dataset are matched to the z-stack in sorted order, so nothing
+    is flagged (with a warning) if the number of z-slices does not match the depth of the z-stack.
+
+    Args:
+        input_dir (pathlib.Path): path to the well-site directory
+        qc_dataset_path (pathlib.Path): path to the QC dataset directory (see qc_flags.write_qc_dataset)
+        z_count (int): number of z-slices in the z-stack of the well-site
+
+    Returns:
+        List[int]: indices of the flagged z-slices in the z-stack (empty if the well-site has no QC flags)
+    """
+    key = organoid_key(input_dir)
+    if key is None:
+        _warn_unknown_organoid(input_dir)
+        return []
+    if not pathlib.Path(qc_dataset_path).exists():
+        return []
+    plate, well_site = key
+    well, site = well_site.rsplit("-", 1)
+
+    flags = read_qc_dataset(qc_dataset_path, plates=[plate])
+    flags = flags[
+        (flags["Metadata_Well"].astype(str) == well)
+        & (flags["Metadata_Site"] == int(site))
+    ]
+    if flags.empty:
+        return []
+    failed = (
+        flags.groupby(flags["Metadata_Zslice"].astype(str))["Failed"].any().sort_index()
+    )
+    if len(failed) != z_count:
+        warnings.warn(
+            f"{plate} {well_site} has {len(failed)} z-slices in the QC dataset but {z_count} in its z-stack, "
+            "no z-slices are left out"
+        )
+        return []
+    return np.flatnonzero(failed.to_numpy()).tolist()
+
+
+def record_runtime(
+    runtime_dir: pathlib.Path,
+    input_dir: pathlib.Path,
+    step: str,
+    seconds: float,
+    zslices: int,
+) -> None:
+    """
+    This function saves the runtime of a segmentation step for a well-site in the runtime directory.
+    The file is named after the plate and well-site (e.g., `NF0014_C4-2_nuclei_runtime.json`), so the runtimes of
+    the same well-site on different plates are kept apart. Directories without a plate in their path are named
+    after the directory.
+
+    Args:
+        runtime_dir (pathlib.Path): path to the directory with the runtimes of all well-sites
+        input_dir (pathlib.Path): path to the well-site directory
+        step (str): name of the segmentation step (e.g., "nuclei")
+        seconds (float): runtime of the step in seconds
+        zslices (int): number of z-slices that were segmented
+    """
+    runtime_dir = pathlib.Path(runtime_dir)
+    runtime_dir.mkdir(exist_ok=True, parents=True)
+    key = organoid_key(input_dir)
+    name = "_".join(key) if key is not None else pathlib.Path(input_dir).name
+    output_path = runtime_dir / f"{name}_{step}{RUNTIME_SUFFIX}"
+    temp_path = output_path.with_name(f".{output_path.name}.partial")
+    with open(temp_path, "w") as runtime_file:
+        json.dump(
+            {"step": step, "seconds": seconds, "zslices": zslices},
+            runtime_file,
+            indent=4,
+        )
+    os.replace(temp_path, output_path)
+
+
+def compute_saved(
+    verdicts: pd.DataFrame, runtime_dir: pathlib.Path
+) -> Dict[str, object]:
+    """
+    This function estimates the segmentation compute the skip list saves.
+    The runtime per z-slice of each segmentation step is averaged over the runtimes that were recorded so far, and
+    multiplied by the number of z-slices of the skipped organoids.
+
+    Args:
+        verdicts (pd.DataFrame): verdict of every organoid (see organoid_verdicts)
+        runtime_dir (pathlib.Path): path to the directory with the runtimes of the well-sites (see record_runtime)
+
+    Returns:
+        Dict[str, object]: number of skipped organoids and z-slices, seconds per z-slice of each step and the
+            estimated seconds saved (None if no runtimes were recorded yet)
+    """
+    step_totals: Dict[str, List[float]] = {}
+    for runtime_path in pathlib.Path(runtime_dir).glob(f"*{RUNTIME_SUFFIX}"):
+        with open(runtime_path) as runtime_file:
+            runtime = json.load(runtime_file)
+        totals = step_totals.setdefault(runtime["step"], [0.0, 0])
+        totals[0] += runtime["seconds"]
+        totals[1] += runtime["zslices"]
+
+    seconds_per_zslice = {
+        step: seconds / zslices
+        for step, (seconds, zslices) in step_totals.items()
+        if zslices
+    }
+    skipped = verdicts[verdicts["Skip"]]
+    skipped_zslices = int(skipped["total_zslices"].sum())
+    return {
+        "organoids": len(verdicts),
+        "skipped_organoids": len(skipped),
+        "skipped_zslices": skipped_zslices,
+        "seconds_per_zslice": seconds_per_zslice,
+        "saved_seconds": (
+            sum(seconds_per_zslice.values()) * skipped_zslices
+            if seconds_per_zslice
+            else None
+        ),
+    }
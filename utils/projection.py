@@ -0,0 +1,180 @@
+"""
+This collection of functions builds the 2.5D projections that the segmentation steps give to Cellpose.
+Each z-slice of the projection reduces a sliding window of `window_size` z-slices (the first window starts at the
+first z-slice and only full windows are kept). The projection is written into one preallocated array: the max and
+mean are computed with one vectorized pass per offset in the window. Percentiles of small windows sort the z-slices
+at each offset with a network of element-wise minimum/maximum passes and interpolate between the two closest ranks
+like np.percentile, in chunks of windows so the memory stays bounded (larger windows use np.percentile on a strided
+sliding window view).
+"""
+
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# reducers that can be used to project each window
+REDUCERS = ("max", "mean", "percentile")
+
+# number of windows reduced at once for percentiles
+CHUNK_SIZE = 2
+
+# largest window that is sorted with minimum/maximum passes for percentiles (the number of passes grows with the
+# square of the window size, so larger windows use np.percentile)
+MAX_NETWORK_WINDOW_SIZE = 16
+
+
+def projection_dtype(zstack_dtype: np.dtype, reducer: str = "max") -> np.dtype:
+    """
+    This function gets the default dtype of a projection: the dtype of the z-stack for the max, and at least float32
+    for the mean and percentiles.
+
+    Args:
+        zstack_dtype (np.dtype): dtype of the z-stack
+        reducer (str, optional): "max", "mean" or "percentile". Defaults to "max".
+
+    Returns:
+        np.dtype: dtype of the projection
+    """
+    if reducer == "max":
+        return np.dtype(zstack_dtype)
+    return np.result_type(zstack_dtype, np.float32)
+
+
+def percentile_ranks(window_size: int, q: float) -> Tuple[int, int, float]:
+    """
+    This function finds the two ranks in a sorted window that a percentile interpolates between, with the same
+    arithmetic as the default ("linear") method of np.percentile.
+
+    Args:
+        window_size (int): number of z-slices in each window
+        q (float): percentile between 0 and 100
+
+    Returns:
+        Tuple[int, int, float]: lower rank, upper rank and the weight of the upper rank
+    """
+    quantile = np.true_divide(q, 100)
+    virtual_index = (window_size - 1) * quantile
+    lower = int(np.clip(np.floor(virtual_index), 0, window_size - 1))
+    upper = min(lower + 1, window_size - 1)
+    return lower, upper, float(virtual_index - np.floor(virtual_index))
+
+
+def sort_windows(layers: List[np.ndarray]) -> List[np.ndarray]:
+    """
+    This function sorts the z-slices at each offset of a chunk of windows element-wise, with an odd-even
+    transposition network of minimum/maximum passes (the arrays are sorted in place).
+
+    Args:
+        layers (List[np.ndarray]): z-slices at each offset of the windows, each with shape (windows, height, width)
+
+    Returns:
+        List[np.ndarray]: the element-wise sorted z-slices, from the smallest to the largest
+    """
+    for network_pass in range(len(layers)):
+        for index in range(network_pass % 2, len(layers) - 1, 2):
+            smaller = np.minimum(layers[index], layers[index + 1])
+            np.maximum(layers[index], layers[index + 1], out=layers[index + 1])
+            layers[index] = smaller
+    return layers
+
+
+def sliding_window_projection(
+    zstack: np.ndarray,
+    window_size: int = 3,
+    reducer: str = "max",
+    q: float = 50,
+    dtype: Optional[np.dtype] = None,
+    out: Optional[np.ndarray] = None,
+    window_function: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> np.ndarray:
+    """
+    This function projects every sliding window of z-slices of a z-stack into one z-slice.
+
+    Args:
+        zstack (np.ndarray): z-stack with shape (z-slices, height, width)
+        window_size (int, optional): number of z-slices in each window. Defaults to 3.
+        reducer (str, optional): "max", "mean" or "percentile". Defaults to "max".
+        q (float, optional): percentile between 0 and 100 (only used with the "percentile" reducer). Defaults to 50.
+        dtype (Optional[np.dtype], optional): dtype of the projection (e.g., np.float32). Defaults to None (see projection_dtype).
+        out (Optional[np.ndarray], optional): preallocated array to write the projection into. Defaults to None.
+        window_function (Optional[Callable[[np.ndarray], np.ndarray]], optional): function applied to each window before
+            it is reduced (e.g., a 3D gaussian blur), which projects the windows one at a time. Defaults to None.
+        chunk_size (int, optional): number of windows reduced at once for percentiles. Defaults to CHUNK_SIZE.
+
+    Returns:
+        np.ndarray: projection with shape (z-slices - window_size + 1, height, width), empty if the z-stack has
+            fewer z-slices than the window
+    """
+    if reducer not in REDUCERS:
+        raise ValueError(f"Unknown reducer {reducer!r}, expected one of {REDUCERS}")
+    zstack = np.asarray(zstack)
+    count = max(len(zstack) - window_size + 1, 0)
+    shape = (count,) + zstack.shape[1:]
+    if out is None:
+        out = np.empty(
+            shape,
+            dtype=dtype
+            if dtype is not None
+            else projection_dtype(zstack.dtype, reducer),
+        )
+    elif out.shape != shape:
+        raise ValueError(f"The output array has shape {out.shape}, expected {shape}")
+    if reducer == "mean" and not np.issubdtype(out.dtype, np.floating):
+        raise ValueError(f"The mean needs a floating point output, not {out.dtype}")
+    if count == 0:
+        return out
+
+    # project the windows one at a time when each window is transformed first
+    if window_function is not None:
+        reduce = {
+            "max": lambda window: np.max(window, axis=0),
+            "mean": lambda window: np.mean(window, axis=0),
+            "percentile": lambda window: np.percentile(window, q, axis=0),
+        }[reducer]
+        for index in range(count):
+            out[index] = reduce(window_function(zstack[index : index + window_size]))
+        return out
+
+    if reducer == "percentile" and window_size <= MAX_NETWORK_WINDOW_SIZE:
+        lower, upper, weight = percentile_ranks(window_size, q)
+        # interpolate in the precision np.percentile uses (float64 for integer z-stacks)
+        interpolation_dtype = (
+            zstack.dtype
+            if np.issubdtype(zstack.dtype, np.floating)
+            else np.dtype(np.float64)
+        )
+        for start in range(0, count, chunk_size):
+            stop = min(start + chunk_size, count)
+            layers = sort_windows(
+                [
+                    zstack[start + offset : stop + offset].copy()
+                    for offset in range(window_size)
+                ]
+            )
+            below = layers[lower].astype(interpolation_dtype)
+            difference = layers[upper] - below
+            if weight >= 0.5:
+                out[start:stop] = layers[upper] - difference * (1 - weight)
+            else:
+                out[start:stop] = below + difference * weight
+        return out
+
+    if reducer == "percentile":
+        for start in range(0, count, chunk_size):
+            stop = min(start + chunk_size, count)
+            windows = sliding_window_view(
+                zstack[start : stop + window_size - 1], window_size, axis=0
+            )
+            out[start:stop] = np.percentile(windows, q, axis=-1)
+        return out
+
+    # the max and mean combine the z-slice at each offset of the windows with one vectorized pass per offset
+    out[...] = zstack[:count]
+    combine = np.maximum if reducer == "max" else np.add
+    for offset in range(1, window_size):
+        combine(out, zstack[offset : offset + count], out=out, casting="unsafe")
+    if reducer == "mean":
+        out /= window_size
+    return out
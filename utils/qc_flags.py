@@ -0,0 +1,314 @@
+"""
+This collection of functions flags z-slices that fail whole image quality control.
+Which metrics are checked in which channels (and with which z-score thresholds) is set in a config, and the
+z-scores of all metrics and channels are computed in one vectorized pass over the QC results of all plates (or,
+with the mean and standard deviation of each feature from a streaming pass over the plates, one plate at a time, see
+qc_statistics.feature_statistics).
+Like coSMicQC, a positive threshold flags values above the mean and a negative threshold flags values below it.
+Adding a metric only means adding an entry to the config.
+The flags are stored as a Hive-partitioned Parquet dataset (one partition per plate and condition) in long format
+with one row per z-slice and channel, sorted by well, site and z-slice and with dictionary-encoded metadata.
+Writing the flags of a new plate or condition only adds partitions, and readers (e.g., the QC report) can load
+only the plates and conditions they need.
+"""
+
+import os
+import pathlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset
+import pyarrow.parquet as pq
+from image_catalog import IMAGE_SET_KEYS
+
+# partition columns of the QC dataset (in the order of the directory levels)
+PARTITION_COLUMNS = ["Metadata_Plate", "Condition"]
+
+# name of the Parquet file in each partition of the QC dataset
+PARTITION_FILE = "part-0.parquet"
+
+# columns of each partition of the QC dataset (the metadata is dictionary-encoded)
+QC_DATASET_SCHEMA = pa.schema(
+    [
+        ("Metadata_Well", pa.dictionary(pa.int16(), pa.string())),
+        ("Metadata_Site", pa.int16()),
+        ("Metadata_Zslice", pa.dictionary(pa.int16(), pa.string())),
+        ("Channel", pa.dictionary(pa.int16(), pa.string())),
+        ("Failed", pa.bool_()),
+    ]
+)
+
+# z-score thresholds per channel for each condition (the threshold is the number of standard deviations from the
+# mean of all plates), found by evaluating the example images in 1.evaluate_blur_qc and 2.evaluate_saturation_qc
+QC_CONFIG = {
+    "Blurry": {
+        "metric": "PowerLogLogSlope",
+        "thresholds": {
+            "DNA": -2,
+            "Mito": -3,
+            "AGP": -2.25,
+            "Brightfield": -3,
+            "ER": -2,
+        },
+    },
+    "Saturated": {
+        "metric": "PercentMaximal",
+        "thresholds": {"DNA": 8, "Mito": 6, "AGP": 4, "Brightfield": 10, "ER": 2},
+    },
+}
+
+
+def feature_thresholds(config: Optional[dict] = None) -> Dict[str, Tuple[str, float]]:
+    """
+    This function lists the feature and threshold of each flag in a QC config.
+
+    Args:
+        config (Optional[dict], optional): conditions with their metric and thresholds per channel. Defaults to QC_CONFIG.
+
+    Returns:
+        Dict[str, Tuple[str, float]]: feature (e.g., "ImageQuality_PowerLogLogSlope_DNA") and z-score threshold of
+            each flag column (e.g., "Blurry_DNA")
+    """
+    config = QC_CONFIG if config is None else config
+    return {
+        f"{condition}_{channel}": (
+            f"ImageQuality_{settings['metric']}_{channel}",
+            threshold,
+        )
+        for condition, settings in config.items()
+        for channel, threshold in settings["thresholds"].items()
+    }
+
+
+def qc_prefixes(config: Optional[dict] = None) -> Tuple[str, ...]:
+    """
+    This function gets the prefixes of the columns of the QC results that are needed to flag the z-slices and to
+    display them (see qc_results.read_image_qc).
+
+    Args:
+        config (Optional[dict], optional): conditions with their metric and thresholds per channel. Defaults to QC_CONFIG.
+
+    Returns:
+        Tuple[str, ...]: column prefixes
+    """
+    config = QC_CONFIG if config is None else config
+    return ("Metadata", "FileName", "PathName") + tuple(
+        dict.fromkeys(
+            f"ImageQuality_{settings['metric']}" for settings in config.values()
+        )
+    )
+
+
+def label_outliers(
+    qc_df: pd.DataFrame,
+    config: Optional[dict] = None,
+    statistics: Optional[pd.DataFrame] = None,
+) -> pd.DataFrame:
+    """
+    This function flags the outliers of every feature in a QC config in one pass.
+    Each feature is z-scored over all rows that have a value (missing values are never flagged), or with the given
+    mean and standard deviation (e.g., of all plates while flagging one plate).
+
+    Args:
+        qc_df (pd.DataFrame): QC results with one row per z-slice (all channels)
+        config (Optional[dict], optional): conditions with their metric and thresholds per channel. Defaults to QC_CONFIG.
+        statistics (Optional[pd.DataFrame], optional): "mean" and "std" of each feature (index), see
+            qc_statistics.FeatureStatistics.summary. Defaults to None (computed from qc_df).
+
+    Returns:
+        pd.DataFrame: one boolean column per flag (e.g., "Blurry_DNA") with the index of the QC results
+    """
+    flags = feature_thresholds(config)
+    features = qc_df[[feature for feature, _ in flags.values()]].to_numpy(
+        dtype=np.float64
+    )
+    thresholds = np.array(
+        [threshold for _, threshold in flags.values()], dtype=np.float64
+    )
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if statistics is None:
+            mean, std = np.nanmean(features, axis=0), np.nanstd(features, axis=0)
+        else:
+            feature_names = [feature for feature, _ in flags.values()]
+            mean = statistics.loc[feature_names, "mean"].to_numpy(dtype=np.float64)
+            std = statistics.loc[feature_names, "std"].to_numpy(dtype=np.float64)
+        zscores = (features - mean) / std
+        outliers = np.where(thresholds > 0, zscores > thresholds, zscores < thresholds)
+    return pd.DataFrame(outliers, index=qc_df.index, columns=list(flags))
+
+
+def outliers(
+    qc_df: pd.DataFrame, labels: pd.DataFrame, flag: str, config: Optional[dict] = None
+) -> pd.DataFrame:
+    """
+    This function gets the rows of the QC results that were flagged for one condition and channel, with the
+    feature and the metadata columns (like `cosmicqc.find_outliers`).
+
+    Args:
+        qc_df (pd.DataFrame): QC results with one row per z-slice (all channels)
+        labels (pd.DataFrame): flags of the QC results (see label_outliers)
+        flag (str): flag column (e.g., "Blurry_DNA")
+        config (Optional[dict], optional): conditions with their metric and thresholds per channel. Defaults to QC_CONFIG.
+
+    Returns:
+        pd.DataFrame: flagged rows
+    """
+    feature, _ = feature_thresholds(config)[flag]
+    metadata_columns = [
+        column for column in qc_df.columns if not column.startswith("ImageQuality")
+    ]
+    return qc_df.loc[labels[flag], [feature] + metadata_columns]
+
+
+def flag_zslices(
+    qc_df: pd.DataFrame,
+    config: Optional[dict] = None,
+    statistics: Optional[pd.DataFrame] = None,
+) -> pd.DataFrame:
+    """
+    This function flags every z-slice for every condition and channel in a QC config.
+    A z-slice that is in the QC results more than once is flagged if any of its rows is an outlier.
+
+    Args:
+        qc_df (pd.DataFrame): QC results with one row per z-slice (all channels)
+        config (Optional[dict], optional): conditions with their metric and thresholds per channel. Defaults to QC_CONFIG.
+        statistics (Optional[pd.DataFrame], optional): "mean" and "std" of each feature (index). Defaults to None
+            (computed from qc_df).
+
+    Returns:
+        pd.DataFrame: one row per z-slice with the metadata and one boolean column per flag
+    """
+    labels = label_outliers(qc_df, config, statistics)
+    return (
+        pd.concat([qc_df[IMAGE_SET_KEYS], labels], axis=1)
+        .groupby(IMAGE_SET_KEYS, sort=False, dropna=False)
+        .any()
+        .reset_index()
+    )
+
+
+def long_flags(flags: pd.DataFrame) -> pd.DataFrame:
+    """
+    This function reshapes the flags of every z-slice to one row per z-slice, condition and channel, with
+    categorical metadata, sorted by plate, condition, well, site, z-slice and channel.
+
+    Args:
+        flags (pd.DataFrame): flags of every z-slice (see flag_zslices)
+
+    Returns:
+        pd.DataFrame: long format flags with the columns of the QC dataset
+    """
+    long_df = flags.melt(id_vars=IMAGE_SET_KEYS, var_name="Flag", value_name="Failed")
+    long_df[["Condition", "Channel"]] = long_df.pop("Flag").str.split(
+        "_", n=1, expand=True
+    )
+    long_df["Metadata_Site"] = long_df["Metadata_Site"].astype("Int16")
+    long_df["Failed"] = long_df["Failed"].astype(bool)
+    for column in ["Metadata_Well", "Metadata_Zslice", "Channel"]:
+        long_df[column] = long_df[column].astype("category")
+    return long_df.sort_values(
+        PARTITION_COLUMNS
+        + ["Metadata_Well", "Metadata_Site", "Metadata_Zslice", "Channel"]
+    ).reset_index(drop=True)[
+        PARTITION_COLUMNS
+        + ["Metadata_Well", "Metadata_Site", "Metadata_Zslice", "Channel", "Failed"]
+    ]
+
+
+def partition_path(
+    dataset_path: pathlib.Path, plate: str, condition: str
+) -> pathlib.Path:
+    """
+    This function gets the path to the Parquet file of one partition of the QC dataset.
+
+    Args:
+        dataset_path (pathlib.Path): path to the QC dataset directory
+        plate (str): plate name (e.g., "NF0014")
+        condition (str): condition name (e.g., "Blurry")
+
+    Returns:
+        pathlib.Path: path to the Parquet file of the partition
+    """
+    return (
+        pathlib.Path(dataset_path)
+        / f"Metadata_Plate={plate}"
+        / f"Condition={condition}"
+        / PARTITION_FILE
+    )
+
+
+def write_qc_dataset(flags: pd.DataFrame, dataset_path: pathlib.Path) -> Dict[str, int]:
+    """
+    This function writes the flags of every z-slice to the partitions of the QC dataset of their plate and
+    condition. Partitions of other plates and conditions are left as they are, and partitions whose flags did not
+    change are not rewritten. Each partition is written through a temporary file so an interrupted run never leaves
+    a partial file behind.
+
+    Args:
+        flags (pd.DataFrame): flags of every z-slice (see flag_zslices)
+        dataset_path (pathlib.Path): path to the QC dataset directory
+
+    Returns:
+        Dict[str, int]: number of partitions that were written and that were already up to date
+    """
+    summary = {"written": 0, "unchanged": 0}
+    for (plate, condition), partition_df in long_flags(flags).groupby(
+        PARTITION_COLUMNS, sort=False, observed=True
+    ):
+        partition_df = partition_df.drop(columns=PARTITION_COLUMNS).reset_index(
+            drop=True
+        )
+        for column in ["Metadata_Well", "Metadata_Zslice", "Channel"]:
+            partition_df[column] = partition_df[column].cat.remove_unused_categories()
+        table = pa.Table.from_pandas(
+            partition_df, schema=QC_DATASET_SCHEMA, preserve_index=False
+        ).replace_schema_metadata()
+        output_path = partition_path(dataset_path, plate, condition)
+        # older versions of pyarrow read the dictionary indices back as int32 without the schema
+        if output_path.exists() and pq.read_table(
+            output_path, schema=QC_DATASET_SCHEMA
+        ).equals(table):
+            summary["unchanged"] += 1
+            continue
+
+        output_path.parent.mkdir(exist_ok=True, parents=True)
+        temp_path = output_path.with_name(f".{output_path.name}.partial")
+        pq.write_table(table, temp_path)
+        os.replace(temp_path, output_path)
+        summary["written"] += 1
+    return summary
+
+
+def read_qc_dataset(
+    dataset_path: pathlib.Path,
+    plates: Optional[List[str]] = None,
+    conditions: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """
+    This function reads the flags from the QC dataset, only reading the partitions of the given plates and
+    conditions.
+
+    Args:
+        dataset_path (pathlib.Path): path to the QC dataset directory
+        plates (Optional[List[str]], optional): plates to read. Defaults to None (all plates).
+        conditions (Optional[List[str]], optional): conditions to read. Defaults to None (all conditions).
+
+    Returns:
+        pd.DataFrame: long format flags with one row per z-slice, condition and channel
+    """
+    dataset = pyarrow.dataset.dataset(
+        dataset_path, format="parquet", partitioning="hive", exclude_invalid_files=True
+    )
+    partition_filter = None
+    for column, values in zip(PARTITION_COLUMNS, [plates, conditions]):
+        if values is not None:
+            expression = pyarrow.dataset.field(column).isin(values)
+            partition_filter = (
+                expression
+                if partition_filter is None
+                else partition_filter & expression
+            )
+    return dataset.to_table(filter=partition_filter).to_pandas()
@@ -0,0 +1,186 @@
+"""
+This collection of functions loads the `Image.csv` outputs of the whole image QC pipeline for evaluation.
+Each CSV is converted to Parquet once with the multithreaded CSV reader of pyarrow (plates are converted in
+parallel) and the Parquet file is cached next to the CSV. The size and modification time of the CSV are saved in
+the Parquet metadata, so the cache is only rebuilt when CellProfiler writes a new `Image.csv`. The evaluation
+notebooks then only read the columns they need.
+"""
+
+import functools
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.parquet as pq
+
+# keys of the Parquet metadata that identify the CSV the cache was converted from
+SOURCE_SIZE_KEY = b"source_size"
+SOURCE_MTIME_KEY = b"source_mtime_ns"
+
+# metadata columns that CellProfiler left empty for some image sets, with the values to fill in per plate
+# (the QC results of NF0018 have image sets without plate, well and site)
+MISSING_METADATA = {
+    "NF0018": {"Metadata_Plate": "NF0018", "Metadata_Well": "E5", "Metadata_Site": 3},
+}
+
+
+def cache_path(csv_path: pathlib.Path) -> pathlib.Path:
+    """
+    This function gets the path to the cached Parquet file of an `Image.csv` (e.g., `Image.parquet`).
+
+    Args:
+        csv_path (pathlib.Path): path to the CSV file
+
+    Returns:
+        pathlib.Path: path to the Parquet file next to the CSV
+    """
+    return pathlib.Path(csv_path).with_suffix(".parquet")
+
+
+def _source_metadata(csv_path: pathlib.Path) -> dict:
+    stat = pathlib.Path(csv_path).stat()
+    return {
+        SOURCE_SIZE_KEY: str(stat.st_size).encode(),
+        SOURCE_MTIME_KEY: str(stat.st_mtime_ns).encode(),
+    }
+
+
+def is_cached(csv_path: pathlib.Path) -> bool:
+    """
+    This function checks if the cached Parquet file of a CSV was converted from the current version of the CSV.
+
+    Args:
+        csv_path (pathlib.Path): path to the CSV file
+
+    Returns:
+        bool: True if the cache exists and matches the size and modification time of the CSV
+    """
+    try:
+        metadata = pq.read_schema(cache_path(csv_path)).metadata or {}
+    except (FileNotFoundError, pa.ArrowInvalid):
+        return False
+    source = _source_metadata(csv_path)
+    return all(metadata.get(key) == value for key, value in source.items())
+
+
+def convert_image_csv(csv_path: pathlib.Path, overwrite: bool = False) -> pathlib.Path:
+    """
+    This function converts a CSV output of CellProfiler to Parquet (unless the cache is up to date).
+    Columns without any values are stored as floats, like pandas reads them from the CSV.
+
+    Args:
+        csv_path (pathlib.Path): path to the CSV file
+        overwrite (bool, optional): convert the CSV even if the cache is up to date. Defaults to False.
+
+    Returns:
+        pathlib.Path: path to the Parquet file
+    """
+    output_path = cache_path(csv_path)
+    if not overwrite and is_cached(csv_path):
+        return output_path
+
+    # get the size and modification time before reading so a CSV that changes during the conversion is reconverted
+    source = _source_metadata(csv_path)
+    table = pyarrow.csv.read_csv(
+        csv_path, read_options=pyarrow.csv.ReadOptions(use_threads=True)
+    )
+    table = table.cast(
+        pa.schema(
+            [
+                field.with_type(pa.float64()) if pa.types.is_null(field.type) else field
+                for field in table.schema
+            ]
+        )
+    )
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **source})
+
+    # write to a temporary file first so an interrupted run never leaves a partial cache behind
+    temp_path = output_path.with_name(f".{output_path.name}.partial")
+    pq.write_table(table, temp_path)
+    os.replace(temp_path, output_path)
+    return output_path
+
+
+def convert_image_csvs(
+    csv_paths: Iterable[pathlib.Path],
+    max_workers: Optional[int] = None,
+    overwrite: bool = False,
+) -> List[pathlib.Path]:
+    """
+    This function converts the CSV outputs of many plates to Parquet in parallel with a thread pool (pyarrow
+    releases the GIL while parsing).
+
+    Args:
+        csv_paths (Iterable[pathlib.Path]): paths to the CSV files
+        max_workers (Optional[int], optional): number of threads. Defaults to None (one per CPU, see ThreadPoolExecutor).
+        overwrite (bool, optional): convert the CSVs even if the caches are up to date. Defaults to False.
+
+    Returns:
+        List[pathlib.Path]: paths to the Parquet files, in the (sorted) order of the CSV files
+    """
+    csv_paths = sorted(pathlib.Path(path) for path in csv_paths)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(
+            executor.map(
+                functools.partial(convert_image_csv, overwrite=overwrite), csv_paths
+            )
+        )
+
+
+def read_image_qc(
+    parquet_path: pathlib.Path, prefixes: Tuple[str, ...]
+) -> pd.DataFrame:
+    """
+    This function reads only the columns that start with one of the given prefixes from a converted CSV output.
+    When the plate, well and site metadata are read, the values that are known to be missing are filled in
+    (see fill_missing_metadata).
+
+    Args:
+        parquet_path (pathlib.Path): path to the Parquet file (see convert_image_csv)
+        prefixes (Tuple[str, ...]): prefixes of the columns to read (e.g., ("Metadata", "ImageQuality_PercentMaximal"))
+
+    Returns:
+        pd.DataFrame: selected columns of the CSV output
+    """
+    columns = [
+        name for name in pq.read_schema(parquet_path).names if name.startswith(prefixes)
+    ]
+    return fill_missing_metadata(
+        pd.read_parquet(parquet_path, columns=columns), parquet_path
+    )
+
+
+def fill_missing_metadata(
+    plate_df: pd.DataFrame, parquet_path: pathlib.Path
+) -> pd.DataFrame:
+    """
+    This function reports image sets without plate, well or site metadata and fills in the values that are known
+    for the plate (see MISSING_METADATA). The plate is taken from the QC results directory of the file
+    (e.g., `NF0018_qc_results/Image.parquet`).
+
+    Args:
+        plate_df (pd.DataFrame): QC results of one plate
+        parquet_path (pathlib.Path): path to the Parquet file the QC results were read from
+
+    Returns:
+        pd.DataFrame: QC results with the known missing metadata filled in
+    """
+    columns = [
+        column
+        for column in ["Metadata_Plate", "Metadata_Well", "Metadata_Site"]
+        if column in plate_df.columns
+    ]
+    if not plate_df[columns].isna().any().any():
+        return plate_df
+    print(
+        f"NaNs detected in {parquet_path} in Metadata_Plate, Metadata_Well, or Metadata_Site columns"
+    )
+    plate = pathlib.Path(parquet_path).parent.name.split("_qc_results")[0]
+    fill_values = MISSING_METADATA.get(plate, {})
+    return plate_df.fillna(
+        {column: fill_values[column] for column in columns if column in fill_values}
+    )
@@ -0,0 +1,252 @@
+"""
+This collection of functions computes the statistics of the QC features of all plates in a streaming pass, so the
+z-slices can be flagged without holding the QC results of all plates in memory at once.
+The mean and variance of each feature are updated plate by plate with Welford's algorithm (the statistics of each
+plate are merged with the parallel form of the update), and the quantiles are estimated with a mergeable sketch
+with a bounded relative error (like DDSketch). The memory only depends on the number of features and the range of
+their values, not on the number of plates or z-slices.
+"""
+
+import math
+import pathlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from qc_flags import feature_thresholds
+from qc_results import read_image_qc
+
+# relative error of the quantiles estimated by the sketches
+RELATIVE_ACCURACY = 0.01
+
+# quantiles in the summary of the statistics
+SUMMARY_QUANTILES = (0.01, 0.05, 0.5, 0.95, 0.99)
+
+
+class QuantileSketch:
+    """
+    This class estimates the quantiles of a stream of values with a relative error of at most `relative_accuracy`.
+    Values are counted in buckets whose bounds grow geometrically, so sketches of different plates can be merged
+    exactly by adding their bucket counts. Values closer to zero than `min_value` are counted as zero.
+
+    Args:
+        relative_accuracy (float, optional): relative error of the estimated quantiles. Defaults to RELATIVE_ACCURACY.
+        min_value (float, optional): smallest absolute value that is not counted as zero. Defaults to 1e-9.
+    """
+
+    def __init__(
+        self, relative_accuracy: float = RELATIVE_ACCURACY, min_value: float = 1e-9
+    ):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive: Dict[int, int] = {}
+        self.negative: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def _add_buckets(self, buckets: Dict[int, int], magnitudes: np.ndarray) -> None:
+        indices, counts = np.unique(
+            np.ceil(np.log(magnitudes) / self._log_gamma).astype(np.int64),
+            return_counts=True,
+        )
+        for index, count in zip(indices.tolist(), counts.tolist()):
+            buckets[index] = buckets.get(index, 0) + count
+
+    def add(self, values: np.ndarray) -> None:
+        """
+        This function adds values to the sketch (missing values are ignored).
+
+        Args:
+            values (np.ndarray): values to add
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        self._add_buckets(self.positive, values[values >= self.min_value])
+        self._add_buckets(self.negative, -values[values <= -self.min_value])
+        self.zero_count += int((np.abs(values) < self.min_value).sum())
+        self.count += len(values)
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """
+        This function adds the values of another sketch with the same relative accuracy to this sketch.
+
+        Args:
+            other (QuantileSketch): sketch to merge
+        """
+        if other.gamma != self.gamma:
+            raise ValueError(
+                "Only sketches with the same relative accuracy can be merged"
+            )
+        for buckets, other_buckets in [
+            (self.positive, other.positive),
+            (self.negative, other.negative),
+        ]:
+            for index, count in other_buckets.items():
+                buckets[index] = buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q: float) -> float:
+        """
+        This function estimates a quantile of the values that were added.
+
+        Args:
+            q (float): quantile between 0 and 1
+
+        Returns:
+            float: estimated quantile (NaN if no values were added)
+        """
+        if self.count == 0:
+            return np.nan
+        rank = q * (self.count - 1)
+        # buckets from the smallest to the largest value (the most negative values are in the highest buckets)
+        buckets = (
+            [
+                (-self._value(index), count)
+                for index, count in sorted(self.negative.items(), reverse=True)
+            ]
+            + [(0.0, self.zero_count)]
+            + [
+                (self._value(index), count)
+                for index, count in sorted(self.positive.items())
+            ]
+        )
+        cumulative = 0
+        for value, count in buckets:
+            cumulative += count
+            if cumulative > rank:
+                return value
+        return buckets[-1][0]
+
+    def _value(self, index: int) -> float:
+        # value in the middle (in relative terms) of the bounds of a bucket
+        return 2 * self.gamma**index / (self.gamma + 1)
+
+
+class FeatureStatistics:
+    """
+    This class computes the count, mean, variance and quantiles of QC features from batches of QC results (e.g.,
+    one plate at a time). Missing values are ignored, like `np.nanmean` and `np.nanstd`.
+
+    Args:
+        features (List[str]): feature columns (e.g., "ImageQuality_PowerLogLogSlope_DNA")
+        relative_accuracy (float, optional): relative error of the estimated quantiles. Defaults to RELATIVE_ACCURACY.
+    """
+
+    def __init__(
+        self, features: List[str], relative_accuracy: float = RELATIVE_ACCURACY
+    ):
+        self.features = list(features)
+        self.count = np.zeros(len(self.features), dtype=np.int64)
+        self._mean = np.zeros(len(self.features), dtype=np.float64)
+        self._m2 = np.zeros(len(self.features), dtype=np.float64)
+        self.sketches = {
+            feature: QuantileSketch(relative_accuracy) for feature in self.features
+        }
+
+    def _merge_moments(
+        self, count: np.ndarray, mean: np.ndarray, m2: np.ndarray
+    ) -> None:
+        total = self.count + count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = mean - self._mean
+            self._mean = np.where(total > 0, self._mean + delta * count / total, 0.0)
+            self._m2 = np.where(
+                total > 0, self._m2 + m2 + delta**2 * self.count * count / total, 0.0
+            )
+        self.count = total
+
+    def update(self, qc_df: pd.DataFrame) -> None:
+        """
+        This function adds a batch of QC results to the statistics.
+
+        Args:
+            qc_df (pd.DataFrame): QC results with a column for every feature
+        """
+        values = qc_df[self.features].to_numpy(dtype=np.float64)
+        count = (~np.isnan(values)).sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(count > 0, np.nansum(values, axis=0) / count, 0.0)
+        m2 = np.nansum((values - mean) ** 2, axis=0)
+        self._merge_moments(count, mean, m2)
+        for feature, column in zip(self.features, values.T):
+            self.sketches[feature].add(column)
+
+    def merge(self, other: "FeatureStatistics") -> None:
+        """
+        This function adds the statistics of the same features computed from other QC results (e.g., by another
+        process) to these statistics.
+
+        Args:
+            other (FeatureStatistics): statistics to merge
+        """
+        if other.features != self.features:
+            raise ValueError("Only statistics of the same features can be merged")
+        self._merge_moments(other.count, other._mean, other._m2)
+        for feature in self.features:
+            self.sketches[feature].merge(other.sketches[feature])
+
+    @property
+    def mean(self) -> pd.Series:
+        """
+        pd.Series: mean of each feature (NaN if the feature has no values)
+        """
+        return pd.Series(
+            np.where(self.count > 0, self._mean, np.nan), index=self.features
+        )
+
+    @property
+    def std(self) -> pd.Series:
+        """
+        pd.Series: population standard deviation of each feature (NaN if the feature has no values)
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return pd.Series(np.sqrt(self._m2 / self.count), index=self.features)
+
+    def summary(self, quantiles: Tuple[float, ...] = SUMMARY_QUANTILES) -> pd.DataFrame:
+        """
+        This function summarizes the statistics of every feature.
+
+        Args:
+            quantiles (Tuple[float, ...], optional): quantiles to estimate. Defaults to SUMMARY_QUANTILES.
+
+        Returns:
+            pd.DataFrame: count, mean, standard deviation and quantiles (e.g., "q0.5") with one row per feature
+        """
+        summary = pd.DataFrame(
+            {"count": self.count, "mean": self.mean, "std": self.std},
+            index=self.features,
+        )
+        for q in quantiles:
+            summary[f"q{q:g}"] = [
+                self.sketches[feature].quantile(q) for feature in self.features
+            ]
+        return summary
+
+
+def feature_statistics(
+    parquet_paths: Iterable[pathlib.Path],
+    config: Optional[dict] = None,
+    relative_accuracy: float = RELATIVE_ACCURACY,
+) -> FeatureStatistics:
+    """
+    This function computes the statistics of every feature in a QC config over the QC results of all plates,
+    reading one plate at a time and only the feature columns.
+
+    Args:
+        parquet_paths (Iterable[pathlib.Path]): paths to the converted QC results of each plate (see qc_results.convert_image_csvs)
+        config (Optional[dict], optional): conditions with their metric and thresholds per channel. Defaults to QC_CONFIG.
+        relative_accuracy (float, optional): relative error of the estimated quantiles. Defaults to RELATIVE_ACCURACY.
+
+    Returns:
+        FeatureStatistics: statistics of every feature
+    """
+    features = list(
+        dict.fromkeys(feature for feature, _ in feature_thresholds(config).values())
+    )
+    statistics = FeatureStatistics(features, relative_accuracy)
+    for path in parquet_paths:
+        statistics.update(read_image_qc(path, tuple(features)))
+    return statistics
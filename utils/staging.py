@@ -0,0 +1,163 @@
+"""
+This collection of functions stages files into flattened directory layouts with links instead of physical copies.
+Hardlinks, reflinks (copy-on-write clones) or symlinks are chosen per filesystem, with a fallback to copying
+when the filesystem does not support any of them.
+
+Note: hardlinked files share their data with the source, so staged files must be treated as read-only.
+"""
+
+import errno
+import fcntl
+import os
+import pathlib
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple
+
+# modes that can be used to stage a file ("auto" picks the first mode that works for the filesystem)
+STAGING_MODES = ("auto", "hardlink", "reflink", "symlink", "copy")
+
+# order that modes are tried in when the mode is "auto"
+AUTO_MODE_ORDER = ("hardlink", "reflink", "symlink", "copy")
+
+# ioctl request code to clone a file on Linux (btrfs, XFS, etc.)
+FICLONE = 0x40049409
+
+# cache the mode that worked per (source device, destination device) so each filesystem is only probed once
+_mode_cache: Dict[Tuple[int, int], str] = {}
+_mode_cache_lock = threading.Lock()
+
+
+def reflink(source: pathlib.Path, destination: pathlib.Path) -> None:
+    """
+    This function creates a copy-on-write clone of a file, which takes no extra space until one of the files changes.
+
+    Args:
+        source (pathlib.Path): path to the source file
+        destination (pathlib.Path): path to the clone
+
+    Raises:
+        OSError: if the filesystem does not support reflinks
+    """
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            destination_file.close()
+            os.unlink(destination)
+            raise
+    shutil.copystat(source, destination)
+
+
+def _link(source: pathlib.Path, destination: pathlib.Path, mode: str) -> None:
+    """
+    This function stages one file with a given mode.
+
+    Args:
+        source (pathlib.Path): path to the source file
+        destination (pathlib.Path): path to stage the file at (must not exist)
+        mode (str): one of "hardlink", "reflink", "symlink" or "copy"
+    """
+    if mode == "hardlink":
+        os.link(source, destination)
+    elif mode == "reflink":
+        reflink(source, destination)
+    elif mode == "symlink":
+        os.symlink(pathlib.Path(source).resolve(), destination)
+    elif mode == "copy":
+        shutil.copy2(source, destination)
+    else:
+        raise ValueError(
+            f"Invalid staging mode '{mode}', please choose one of {STAGING_MODES}"
+        )
+
+
+def stage_file(
+    source: pathlib.Path, destination: pathlib.Path, mode: str = "auto"
+) -> str:
+    """
+    This function stages a file at the destination, replacing any file that is already there.
+    The link is created under a temporary name and moved in place so a staged file is never partially written.
+
+    Args:
+        source (pathlib.Path): path to the source file
+        destination (pathlib.Path): path to stage the file at
+        mode (str, optional): one of STAGING_MODES. Defaults to "auto".
+
+    Returns:
+        str: the mode that was used to stage the file
+    """
+    source = pathlib.Path(source)
+    destination = pathlib.Path(destination)
+    temp_destination = destination.with_name(f".{destination.name}.partial")
+    if os.path.lexists(temp_destination):
+        os.unlink(temp_destination)
+
+    if mode != "auto":
+        _link(source, temp_destination, mode)
+        os.replace(temp_destination, destination)
+        return mode
+
+    devices = (os.stat(source).st_dev, os.stat(destination.parent).st_dev)
+    cached_mode = _mode_cache.get(devices)
+    modes = (cached_mode,) if cached_mode else AUTO_MODE_ORDER
+    for candidate in modes + tuple(m for m in AUTO_MODE_ORDER if m not in modes):
+        # links across devices are not possible, so skip straight to the next mode
+        if candidate in ("hardlink", "reflink") and devices[0] != devices[1]:
+            continue
+        try:
+            _link(source, temp_destination, candidate)
+        except OSError as error:
+            if error.errno not in (
+                errno.EXDEV,
+                errno.EPERM,
+                errno.EACCES,
+                errno.EOPNOTSUPP,
+                errno.ENOTTY,
+                errno.EINVAL,
+                errno.EMLINK,
+            ):
+                raise
+            continue
+        os.replace(temp_destination, destination)
+        with _mode_cache_lock:
+            _mode_cache.setdefault(devices, candidate)
+        return candidate
+
+    raise OSError(f"Unable to stage '{source}' at '{destination}'")
+
+
+def stage_tree(
+    source_dir: pathlib.Path,
+    destination_dir: pathlib.Path,
+    mode: str = "auto",
+    max_workers: int = 8,
+) -> Dict[str, int]:
+    """
+    This function stages a directory tree (like shutil.copytree) where each file is linked instead of copied.
+    Directories are always created as real directories so other files can be added to them afterwards.
+
+    Args:
+        source_dir (pathlib.Path): path to the directory to stage
+        destination_dir (pathlib.Path): path to the staged directory
+        mode (str, optional): one of STAGING_MODES. Defaults to "auto".
+        max_workers (int, optional): number of threads used to stage files. Defaults to 8.
+
+    Returns:
+        Dict[str, int]: number of files that were staged with each mode
+    """
+    files = []
+    for root, _, file_names in os.walk(source_dir):
+        relative_root = pathlib.Path(root).relative_to(source_dir)
+        (destination_dir / relative_root).mkdir(parents=True, exist_ok=True)
+        files.extend(relative_root / file_name for file_name in file_names)
+
+    counts = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for used_mode in executor.map(
+            lambda file: stage_file(source_dir / file, destination_dir / file, mode),
+            files,
+        ):
+            counts[used_mode] = counts.get(used_mode, 0) + 1
+    return counts
@@ -0,0 +1,187 @@
+"""
+This collection of functions keeps a cache of thumbnails of the z-slice images for reviewing QC outliers.
+Each image is read once (during ingest or on first access) and downsampled into a pyramid of block-averaged levels
+(every 2x smaller down to the thumbnail size), which is saved as one compressed NPZ file in the cache directory.
+Cache files are keyed by the resolved path, size and modification time of the image, so a changed image gets new
+thumbnails and reviewing outliers only reads the small levels instead of the full resolution images.
+"""
+
+import hashlib
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+import tifffile
+import tqdm
+
+# downsampling factor of the largest level of the pyramid (each next level is 2x smaller)
+MIN_FACTOR = 4
+
+# the pyramid stops at the first level whose longest side is at most this many pixels
+THUMBNAIL_SIZE = 256
+
+
+def cache_key(image_path: pathlib.Path) -> str:
+    """
+    This function gets the key of the thumbnails of an image from its resolved path, size and modification time.
+
+    Args:
+        image_path (pathlib.Path): path to the image
+
+    Returns:
+        str: hex digest that identifies the current version of the image
+    """
+    image_path = pathlib.Path(image_path).resolve()
+    stat = image_path.stat()
+    return hashlib.blake2b(
+        f"{image_path}:{stat.st_size}:{stat.st_mtime_ns}".encode(), digest_size=16
+    ).hexdigest()
+
+
+def cache_path(image_path: pathlib.Path, cache_dir: pathlib.Path) -> pathlib.Path:
+    """
+    This function gets the path to the cached pyramid of an image (e.g., `<cache_dir>/3f/3f2a...npz`).
+
+    Args:
+        image_path (pathlib.Path): path to the image
+        cache_dir (pathlib.Path): path to the thumbnail cache directory
+
+    Returns:
+        pathlib.Path: path to the NPZ file of the pyramid
+    """
+    key = cache_key(image_path)
+    return pathlib.Path(cache_dir) / key[:2] / f"{key}.npz"
+
+
+def downsample(image: np.ndarray, factor: int = 2) -> np.ndarray:
+    """
+    This function downsamples an image by averaging blocks of pixels (the edges that do not fill a block are cropped).
+
+    Args:
+        image (np.ndarray): image with shape (height, width) or (height, width, channels)
+        factor (int, optional): size of the blocks. Defaults to 2.
+
+    Returns:
+        np.ndarray: downsampled image with the dtype of the input image
+    """
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    blocks = image[: height * factor, : width * factor].reshape(
+        (height, factor, width, factor) + image.shape[2:]
+    )
+    return blocks.mean(axis=(1, 3), dtype=np.float64).astype(image.dtype)
+
+
+def build_pyramid(
+    image: np.ndarray,
+    min_factor: int = MIN_FACTOR,
+    thumbnail_size: int = THUMBNAIL_SIZE,
+) -> Dict[int, np.ndarray]:
+    """
+    This function builds the downsampled levels of an image, from `min_factor` down to the thumbnail size.
+
+    Args:
+        image (np.ndarray): full resolution image
+        min_factor (int, optional): downsampling factor of the largest level. Defaults to MIN_FACTOR.
+        thumbnail_size (int, optional): longest side of the smallest level. Defaults to THUMBNAIL_SIZE.
+
+    Returns:
+        Dict[int, np.ndarray]: image at each downsampling factor
+    """
+    factor = 1
+    level = np.asarray(image)
+    pyramid = {}
+    while factor < min_factor or max(level.shape[:2]) > thumbnail_size:
+        if min(level.shape[:2]) < 2:
+            break
+        level = downsample(level)
+        factor *= 2
+        if factor >= min_factor:
+            pyramid[factor] = level
+    if not pyramid:
+        pyramid[factor] = level
+    return pyramid
+
+
+def write_thumbnails(
+    image_path: pathlib.Path, cache_dir: pathlib.Path, overwrite: bool = False
+) -> pathlib.Path:
+    """
+    This function reads an image and saves its pyramid in the cache (unless it is already cached).
+    The pyramid is written to a temporary file first so an interrupted run never leaves a partial cache file behind.
+
+    Args:
+        image_path (pathlib.Path): path to the image
+        cache_dir (pathlib.Path): path to the thumbnail cache directory
+        overwrite (bool, optional): rebuild the pyramid even if it is cached. Defaults to False.
+
+    Returns:
+        pathlib.Path: path to the NPZ file of the pyramid
+    """
+    output_path = cache_path(image_path, cache_dir)
+    if not overwrite and output_path.exists():
+        return output_path
+
+    pyramid = build_pyramid(tifffile.imread(image_path))
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+    temp_path = output_path.with_name(f".{output_path.stem}.partial.npz")
+    np.savez_compressed(
+        temp_path, **{f"factor_{factor}": level for factor, level in pyramid.items()}
+    )
+    os.replace(temp_path, output_path)
+    return output_path
+
+
+def build_thumbnails(
+    image_paths: Iterable[pathlib.Path], cache_dir: pathlib.Path, max_workers: int = 8
+) -> Dict[str, int]:
+    """
+    This function caches the pyramids of many images in parallel with a thread pool (e.g., during ingest).
+
+    Args:
+        image_paths (Iterable[pathlib.Path]): paths to the images
+        cache_dir (pathlib.Path): path to the thumbnail cache directory
+        max_workers (int, optional): number of threads. Defaults to 8.
+
+    Returns:
+        Dict[str, int]: number of images whose pyramid was written and that were already cached
+    """
+    image_paths = [pathlib.Path(path) for path in image_paths]
+    to_write = [
+        path for path in image_paths if not cache_path(path, cache_dir).exists()
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(
+            tqdm.tqdm(
+                executor.map(lambda path: write_thumbnails(path, cache_dir), to_write),
+                total=len(to_write),
+            )
+        )
+    return {"written": len(to_write), "skipped": len(image_paths) - len(to_write)}
+
+
+def read_thumbnail(
+    image_path: pathlib.Path, cache_dir: pathlib.Path, factor: Optional[int] = None
+) -> np.ndarray:
+    """
+    This function reads one level of the pyramid of an image from the cache, building the pyramid on first access.
+
+    Args:
+        image_path (pathlib.Path): path to the image
+        cache_dir (pathlib.Path): path to the thumbnail cache directory
+        factor (Optional[int], optional): downsampling factor of the level. Defaults to None (the thumbnail, which
+            is the smallest level).
+
+    Returns:
+        np.ndarray: downsampled image
+    """
+    with np.load(write_thumbnails(image_path, cache_dir)) as pyramid:
+        factors = sorted(int(name.split("_")[1]) for name in pyramid.files)
+        if factor is None:
+            factor = factors[-1]
+        if factor not in factors:
+            raise KeyError(
+                f"No level with factor {factor} in the pyramid of {image_path} (levels: {factors})"
+            )
+        return pyramid[f"factor_{factor}"]
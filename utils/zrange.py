@@ -0,0 +1,340 @@
+"""
+This collection of functions finds the useful z-range of each well-site before segmentation.
+Cheap per-slice signal and focus statistics are computed on a downsampled copy of each z-slice and the range of
+z-slices where the organoid is in focus is saved in a sidecar file next to the z-stacks. The segmentation steps
+then only segment that range (leaving out the z-slices flagged by QC) and restore their outputs to the full depth of
+the z-stack.
+"""
+
+import json
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import tqdm
+from zstack_io import read_zstack, zstack_mtime
+
+# suffix of the sidecar file written inside of each well-site directory (e.g., `C4-2/C4-2_zrange.json`)
+ZRANGE_SUFFIX = "_zrange.json"
+
+
+def slice_statistics(zstack: np.ndarray, downsample: int = 4) -> Dict[str, List[float]]:
+    """
+    This function computes signal and focus statistics for each z-slice of a z-stack.
+    The focus of a z-slice is the variance of its Laplacian, which is high when the z-slice has sharp edges.
+
+    Args:
+        zstack (np.ndarray): z-stack with shape (z-slices, height, width)
+        downsample (int, optional): step used to subsample the pixels of each z-slice. Defaults to 4.
+
+    Returns:
+        Dict[str, List[float]]: mean intensity, 99th percentile intensity and focus of each z-slice
+    """
+    images = np.asarray(zstack[:, ::downsample, ::downsample], dtype=np.float32)
+    laplacian = (
+        images[:, :-2, 1:-1]
+        + images[:, 2:, 1:-1]
+        + images[:, 1:-1, :-2]
+        + images[:, 1:-1, 2:]
+        - 4 * images[:, 1:-1, 1:-1]
+    )
+    return {
+        "mean": images.mean(axis=(1, 2)).tolist(),
+        "p99": np.percentile(images.reshape(len(images), -1), 99, axis=1).tolist(),
+        "focus": laplacian.var(axis=(1, 2)).tolist(),
+    }
+
+
+def find_zrange(
+    focus: List[float],
+    focus_fraction: float = 0.2,
+    margin: int = 2,
+    min_slices: int = 3,
+) -> Tuple[int, int]:
+    """
+    This function finds the range of z-slices that are in focus.
+    A z-slice is in focus if its focus is above the given fraction between the lowest and highest focus of the
+    z-stack. The range goes from the first to the last z-slice in focus, is widened by a margin on both sides and
+    is at least `min_slices` long (e.g., the size of the sliding window used for segmentation).
+
+    Args:
+        focus (List[float]): focus of each z-slice (see slice_statistics)
+        focus_fraction (float, optional): fraction of the focus range a z-slice needs to be in focus. Defaults to 0.2.
+        margin (int, optional): number of z-slices added on both sides of the range. Defaults to 2.
+        min_slices (int, optional): minimum number of z-slices in the range. Defaults to 3.
+
+    Returns:
+        Tuple[int, int]: start (inclusive) and stop (exclusive) index of the range
+    """
+    focus = np.asarray(focus, dtype=np.float64)
+    z_count = len(focus)
+    if z_count <= min_slices or np.ptp(focus) == 0:
+        return 0, z_count
+
+    in_focus = np.flatnonzero(focus >= focus.min() + focus_fraction * np.ptp(focus))
+    z_start = max(int(in_focus[0]) - margin, 0)
+    z_stop = min(int(in_focus[-1]) + 1 + margin, z_count)
+
+    # widen the range around its center until it holds enough z-slices
+    while z_stop - z_start < min_slices:
+        if z_start > 0:
+            z_start -= 1
+        if z_stop - z_start < min_slices and z_stop < z_count:
+            z_stop += 1
+    return z_start, z_stop
+
+
+def zrange_path(input_dir: pathlib.Path) -> pathlib.Path:
+    """
+    This function gets the path to the z-range sidecar file of a well-site.
+
+    Args:
+        input_dir (pathlib.Path): path to the well-site directory
+
+    Returns:
+        pathlib.Path: path to the sidecar file
+    """
+    input_dir = pathlib.Path(input_dir)
+    return input_dir / f"{input_dir.name}{ZRANGE_SUFFIX}"
+
+
+def compute_zrange(
+    input_dir: pathlib.Path,
+    channel: str = "405",
+    focus_fraction: float = 0.2,
+    margin: int = 2,
+    min_slices: int = 3,
+    catalog_path: Optional[pathlib.Path] = None,
+) -> dict:
+    """
+    This function computes the useful z-range of a well-site and saves it in the sidecar file of the well-site.
+
+    Args:
+        input_dir (pathlib.Path): path to the well-site directory (z-stacks or z-slice images)
+        channel (str, optional): channel used to find the z-range. Defaults to "405" (nuclei).
+        focus_fraction (float, optional): fraction of the focus range a z-slice needs to be in focus. Defaults to 0.2.
+        margin (int, optional): number of z-slices added on both sides of the range. Defaults to 2.
+        min_slices (int, optional): minimum number of z-slices in the range. Defaults to 3.
+        catalog_path (Optional[pathlib.Path], optional): path to the Parquet image catalog. Defaults to None.
+
+    Returns:
+        dict: z-range of the well-site with the per-slice statistics
+    """
+    zstack = read_zstack(input_dir, channel, catalog_path=catalog_path)
+    statistics = slice_statistics(zstack)
+    z_start, z_stop = find_zrange(
+        statistics["focus"], focus_fraction, margin, min_slices
+    )
+    zrange = {
+        "channel": channel,
+        "z_count": len(zstack),
+        "z_start": z_start,
+        "z_stop": z_stop,
+        "statistics": statistics,
+    }
+
+    # write to a temporary file first so an interrupted run never leaves a partial sidecar behind
+    output_path = zrange_path(input_dir)
+    temp_path = output_path.with_name(f".{output_path.name}.partial")
+    with open(temp_path, "w") as zrange_file:
+        json.dump(zrange, zrange_file, indent=4)
+    os.replace(temp_path, output_path)
+    return zrange
+
+
+def zrange_is_current(
+    input_dir: pathlib.Path,
+    channel: str = "405",
+    catalog_path: Optional[pathlib.Path] = None,
+) -> bool:
+    """
+    This function checks if the sidecar file of a well-site is up to date, i.e., it was computed from the same
+    channel and written after the z-stack was last modified.
+
+    Args:
+        input_dir (pathlib.Path): path to the well-site directory (z-stacks or z-slice images)
+        channel (str, optional): channel used to find the z-range. Defaults to "405" (nuclei).
+        catalog_path (Optional[pathlib.Path], optional): path to the Parquet image catalog. Defaults to None.
+
+    Returns:
+        bool: True if the z-range does not need to be computed again
+    """
+    path = zrange_path(input_dir)
+    if not path.exists():
+        return False
+    zrange = read_zrange(input_dir)
+    return zrange.get("channel") == channel and path.stat().st_mtime_ns >= zstack_mtime(
+        input_dir, channel, catalog_path
+    )
+
+
+def compute_zranges(
+    well_dirs: List[pathlib.Path],
+    channel: str = "405",
+    max_workers: int = 1,
+    overwrite: bool = False,
+    **kwargs,
+) -> Dict[str, dict]:
+    """
+    This function computes the useful z-range of many well-sites in parallel with a process pool.
+    Well-sites whose sidecar file is newer than their z-stack are read from the sidecar instead of computed again
+    (see zrange_is_current), so only new or rewritten z-stacks are read.
+
+    Args:
+        well_dirs (List[pathlib.Path]): paths to the well-site directories
+        channel (str, optional): channel used to find the z-range. Defaults to "405" (nuclei).
+        max_workers (int, optional): number of processes. Defaults to 1.
+        overwrite (bool, optional): compute the z-range of every well-site even if its sidecar is up to date. Defaults to False.
+        **kwargs: passed on to compute_zrange
+
+    Returns:
+        Dict[str, dict]: z-range of each well-site
+    """
+    zranges = {}
+    to_compute = []
+    for well_dir in well_dirs:
+        if not overwrite and zrange_is_current(
+            well_dir, channel, kwargs.get("catalog_path")
+        ):
+            zranges[pathlib.Path(well_dir).name] = read_zrange(well_dir)
+        else:
+            to_compute.append(well_dir)
+    print(
+        f"Computing the z-range of {len(to_compute)} well-sites ({len(zranges)} are up to date)"
+    )
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            pathlib.Path(well_dir).name: executor.submit(
+                compute_zrange, well_dir, channel, **kwargs
+            )
+            for well_dir in to_compute
+        }
+        for well_site, future in tqdm.tqdm(futures.items()):
+            zranges[well_site] = future.result()
+    return {
+        pathlib.Path(well_dir).name: zranges[pathlib.Path(well_dir).name]
+        for well_dir in well_dirs
+    }
+
+
+def read_zrange(input_dir: pathlib.Path) -> Optional[dict]:
+    """
+    This function reads the z-range sidecar file of a well-site.
+
+    Args:
+        input_dir (pathlib.Path): path to the well-site directory
+
+    Returns:
+        Optional[dict]: z-range of the well-site (None if the z-range was not computed)
+    """
+    path = zrange_path(input_dir)
+    if not path.exists():
+        return None
+    with open(path) as zrange_file:
+        return json.load(zrange_file)
+
+
+def kept_zslices(
+    z_start: int, z_stop: int, flagged: Iterable[int] = (), min_slices: int = 3
+) -> List[int]:
+    """
+    This function lists the z-slices of a z-range that are segmented, leaving out the z-slices flagged by QC.
+    If fewer than `min_slices` z-slices (e.g., the size of the sliding window used for segmentation) would be left,
+    all z-slices of the range are kept.
+
+    Args:
+        z_start (int): index of the first z-slice of the range in the full z-stack
+        z_stop (int): index after the last z-slice of the range in the full z-stack
+        flagged (Iterable[int], optional): indices of the flagged z-slices in the full z-stack. Defaults to ().
+        min_slices (int, optional): minimum number of z-slices that are kept. Defaults to 3.
+
+    Returns:
+        List[int]: indices of the kept z-slices in the full z-stack
+    """
+    flagged = set(flagged)
+    zslices = [index for index in range(z_start, z_stop) if index not in flagged]
+    if len(zslices) < min_slices:
+        return list(range(z_start, z_stop))
+    return zslices
+
+
+def _source_zslices(zslices: List[int], z_count: int, fill: str) -> Dict[int, int]:
+    # z-slice of the segmented z-slices that each z-slice of the full z-stack is filled from
+    if fill == "empty":
+        return {zslice: position for position, zslice in enumerate(zslices)}
+    if fill != "nearest":
+        raise ValueError(f"Unknown fill {fill!r}, expected 'empty' or 'nearest'")
+    kept = np.asarray(zslices)
+    return {
+        index: int(np.abs(kept - index).argmin())
+        for index in range(z_count)
+        if kept[0] <= index <= kept[-1]
+    }
+
+
+def restore_reconstruction_dict(
+    reconstruction_dict: Dict[int, List[np.ndarray]],
+    zslices: List[int],
+    z_count: int,
+    fill: str = "empty",
+    mask_shape: Optional[Tuple[int, ...]] = None,
+) -> Dict[int, List[np.ndarray]]:
+    """
+    This function moves the masks of the segmented z-slices back to their index in the full z-stack.
+    The z-slices outside of the useful z-range get an empty mask. The z-slices that were left out because they
+    were flagged by QC get an empty mask (`fill="empty"`) or the masks of the nearest segmented z-slice
+    (`fill="nearest"`). If no masks were segmented (e.g., fewer z-slices than the sliding window), every z-slice
+    gets an empty mask of `mask_shape`.
+
+    Args:
+        reconstruction_dict (Dict[int, List[np.ndarray]]): masks for each segmented z-slice (in segmentation order)
+        zslices (List[int]): index of each segmented z-slice in the full z-stack (see kept_zslices)
+        z_count (int): number of z-slices in the full z-stack
+        fill (str, optional): how flagged z-slices are filled, "empty" or "nearest". Defaults to "empty".
+        mask_shape (Optional[Tuple[int, ...]], optional): shape of the empty masks when no masks were segmented.
+            Defaults to None.
+
+    Returns:
+        Dict[int, List[np.ndarray]]: masks for each z-slice of the full z-stack
+    """
+    masks = next((masks[0] for masks in reconstruction_dict.values() if masks), None)
+    if masks is not None:
+        empty_mask = np.zeros_like(masks)
+    elif mask_shape is not None:
+        empty_mask = np.zeros(mask_shape, dtype=np.uint16)
+    else:
+        raise ValueError(
+            "No masks were segmented, pass `mask_shape` to fill the z-stack with empty masks"
+        )
+    sources = _source_zslices(zslices, z_count, fill)
+    return {
+        index: (reconstruction_dict.get(sources[index]) if index in sources else None)
+        or [empty_mask]
+        for index in range(z_count)
+    }
+
+
+def restore_zstack(
+    zstack: np.ndarray, zslices: List[int], z_count: int, fill: str = "empty"
+) -> np.ndarray:
+    """
+    This function moves the z-slices of a segmented z-stack back to their index in the full z-stack.
+    The z-slices outside of the useful z-range are empty. The z-slices that were left out because they were flagged
+    by QC are empty (`fill="empty"`) or a copy of the nearest segmented z-slice (`fill="nearest"`).
+
+    Args:
+        zstack (np.ndarray): z-stack of the segmented z-slices
+        zslices (List[int]): index of each segmented z-slice in the full z-stack (see kept_zslices)
+        z_count (int): number of z-slices in the full z-stack
+        fill (str, optional): how flagged z-slices are filled, "empty" or "nearest". Defaults to "empty".
+
+    Returns:
+        np.ndarray: z-stack with the depth of the full z-stack
+    """
+    restored = np.zeros((z_count,) + zstack.shape[1:], dtype=zstack.dtype)
+    for index, position in _source_zslices(zslices, z_count, fill).items():
+        restored[index] = zstack[position]
+    return restored
@@ -0,0 +1,377 @@
+"""
+This collection of functions builds the per-channel z-stack images for each well-site.
+Z-stacks can be built straight from the nested acquisition tree, so the z-slices are read one time and
+written one time without a flattened copy of the raw images in between.
+Well-sites are built in parallel (processes for well-sites, threads for reading z-slices) under a memory budget.
+Z-stacks are written as one TIFF per channel or as one chunked OME-Zarr store per well-site (see zstack_io.py).
+The whole image QC metrics of each z-slice can be measured while the z-slices are in memory for stacking, so QC
+does not need to read the raw images again (see image_quality.py).
+"""
+
+import functools
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import tifffile
+import tqdm
+from image_quality import QualityAccumulator, quality_well_sites, update_quality_table
+from ingest import scan_acquisition_tree
+from zstack_io import (
+    CHANNEL_NAMES,
+    ZSTACK_FORMATS,
+    group_zslices,
+    read_zslices,
+    write_ome_zarr,
+    zarr_path,
+)
+
+# default memory budget for holding z-stacks in memory (z-stacks above the budget are streamed slice by slice)
+MEMORY_BUDGET = 4 * 1024**3
+
+
+def zstack_nbytes(slice_paths: List[pathlib.Path]) -> int:
+    """
+    This function estimates the size in memory of a z-stack from the header of its first z-slice.
+
+    Args:
+        slice_paths (List[pathlib.Path]): paths to the z-slice images
+
+    Returns:
+        int: size of the z-stack in bytes
+    """
+    with tifffile.TiffFile(slice_paths[0]) as tif:
+        page = tif.pages[0]
+        return (
+            len(slice_paths) * int(np.prod(page.shape)) * np.dtype(page.dtype).itemsize
+        )
+
+
+def write_zstack(
+    slice_paths: List[pathlib.Path],
+    output_path: pathlib.Path,
+    max_threads: int = 4,
+    memory_budget: int = MEMORY_BUDGET,
+    on_slice: Optional[Callable[[np.ndarray], None]] = None,
+) -> None:
+    """
+    This function writes z-slices into one z-stack TIFF.
+    Z-stacks that fit in the memory budget are read in parallel into one preallocated array, larger z-stacks are
+    streamed into the TIFF so only one slice is held in memory at a time.
+
+    Args:
+        slice_paths (List[pathlib.Path]): paths to the z-slice images, sorted by z-slice
+        output_path (pathlib.Path): path to the z-stack image
+        max_threads (int, optional): number of threads used to read the z-slices. Defaults to 4.
+        memory_budget (int, optional): maximum size in bytes of a z-stack held in memory. Defaults to MEMORY_BUDGET.
+        on_slice (Optional[Callable[[np.ndarray], None]], optional): called with the pixels of each z-slice in order
+            (e.g., to measure QC metrics without reading the z-slice again). Defaults to None.
+    """
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+    temp_path = output_path.with_name(f".{output_path.name}.partial")
+    # minisblack keeps one page per z-slice (otherwise stacks of 3 or 4 z-slices are written as RGB(A) planes)
+    if zstack_nbytes(slice_paths) <= memory_budget:
+        zstack = read_zslices(slice_paths, max_threads)
+        tifffile.imwrite(temp_path, zstack, photometric="minisblack")
+        if on_slice is not None:
+            for image in zstack:
+                on_slice(image)
+    else:
+        with tifffile.TiffWriter(temp_path) as writer:
+            for slice_path in slice_paths:
+                image = tifffile.imread(slice_path)
+                writer.write(image, contiguous=True, photometric="minisblack")
+                if on_slice is not None:
+                    on_slice(image)
+    os.replace(temp_path, output_path)
+
+
+def _is_stale(output_path: pathlib.Path, slice_paths: List[pathlib.Path]) -> bool:
+    """
+    This function checks if a z-stack needs to be (re)built because it is missing or older than one of its z-slices.
+
+    Args:
+        output_path (pathlib.Path): path to the z-stack image
+        slice_paths (List[pathlib.Path]): paths to the z-slice images
+
+    Returns:
+        bool: True if the z-stack should be built
+    """
+    try:
+        output_mtime = output_path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return True
+    return any(path.stat().st_mtime_ns > output_mtime for path in slice_paths)
+
+
+def _build_well_site(
+    well_site: str,
+    channels: Dict[str, List[pathlib.Path]],
+    output_dir: pathlib.Path,
+    overwrite: bool,
+    max_threads: int,
+    memory_budget: int,
+    output_format: str = "tiff",
+    plate: Optional[str] = None,
+) -> Tuple[int, int, Optional[pd.DataFrame]]:
+    """
+    This function writes the z-stack images for all channels of one well-site (run in a worker process).
+    When a plate name is given, the QC metrics of every z-slice are measured while it is in memory. All channels
+    of the well-site are then rebuilt if any of them is out of date, so the QC table covers every channel.
+
+    Args:
+        well_site (str): well-site name (e.g., "C4-2")
+        channels (Dict[str, List[pathlib.Path]]): z-slice paths per channel
+        output_dir (pathlib.Path): path to the z-stack directory for the plate
+        overwrite (bool): rebuild z-stacks that are already up to date
+        max_threads (int): number of threads used to read the z-slices
+        memory_budget (int): maximum size in bytes of a z-stack held in memory
+        output_format (str, optional): one of ZSTACK_FORMATS. Defaults to "tiff".
+        plate (Optional[str], optional): plate name to measure the QC metrics for. Defaults to None (no QC).
+
+    Returns:
+        Tuple[int, int, Optional[pd.DataFrame]]: number of z-stacks that were written and skipped and the QC
+            metrics of each z-slice (None without QC or if the well-site was skipped)
+    """
+    accumulator = QualityAccumulator(workers=max_threads) if plate is not None else None
+
+    if output_format == "zarr":
+        # all channels of the well-site go into one store
+        output_path = zarr_path(output_dir, well_site)
+        slice_paths = [path for paths in channels.values() for path in paths]
+        if not overwrite and not _is_stale(output_path, slice_paths):
+            return 0, len(channels), None
+        write_ome_zarr(
+            channels,
+            output_path,
+            on_slice=accumulator.add if accumulator is not None else None,
+        )
+        written, skipped = len(channels), 0
+    else:
+        output_paths = {
+            channel_name: output_dir / well_site / f"{well_site}_{channel_name}.tif"
+            for channel_name in channels
+        }
+        if accumulator is not None and not overwrite:
+            # rebuild every channel (or none) so the QC metrics are measured for all channels
+            overwrite = any(
+                _is_stale(output_paths[channel_name], slice_paths)
+                for channel_name, slice_paths in channels.items()
+            )
+            if not overwrite:
+                return 0, len(channels), None
+
+        written = 0
+        skipped = 0
+        for channel_name, slice_paths in channels.items():
+            if not overwrite and not _is_stale(output_paths[channel_name], slice_paths):
+                skipped += 1
+                continue
+            write_zstack(
+                slice_paths,
+                output_paths[channel_name],
+                max_threads,
+                memory_budget,
+                on_slice=(
+                    functools.partial(accumulator.add, channel_name)
+                    if accumulator is not None
+                    else None
+                ),
+            )
+            written += 1
+
+    if accumulator is None:
+        return written, skipped, None
+    return written, skipped, accumulator.table(plate, well_site, channels)
+
+
+def build_zstacks(
+    groups: Dict[str, Dict[str, List[pathlib.Path]]],
+    output_dir: pathlib.Path,
+    overwrite: bool = False,
+    max_workers: int = 1,
+    max_threads: int = 4,
+    memory_budget: int = MEMORY_BUDGET,
+    output_format: str = "tiff",
+    quality_path: Optional[pathlib.Path] = None,
+    plate: Optional[str] = None,
+) -> Dict[str, int]:
+    """
+    This function writes a z-stack image for each channel of each well-site as
+    `<output_dir>/<well-site>/<well-site>_<channel>.tif` (or one `<well-site>.ome.zarr` store per well-site),
+    skipping z-stacks that are newer than all of their z-slices.
+    Well-sites are processed in parallel with a process pool, where the memory budget is split between the workers.
+    With a QC path, the QC metrics of every z-slice (see image_quality.py) are measured while the z-slices are in
+    memory and saved to the per-plate QC Parquet file. Well-sites that are not in the QC file yet are rebuilt.
+
+    Args:
+        groups (Dict[str, Dict[str, List[pathlib.Path]]]): z-slice paths per channel for each well-site (see group_zslices)
+        output_dir (pathlib.Path): path to the z-stack directory for the plate
+        overwrite (bool, optional): rebuild z-stacks that are already up to date. Defaults to False.
+        max_workers (int, optional): number of processes used to build well-sites. Defaults to 1.
+        max_threads (int, optional): number of threads per process used to read z-slices. Defaults to 4.
+        memory_budget (int, optional): total memory in bytes for z-stacks held in memory across all workers. Defaults to MEMORY_BUDGET.
+        output_format (str, optional): one of ZSTACK_FORMATS, "tiff" (one file per channel) or "zarr" (one OME-Zarr store per well-site). Defaults to "tiff".
+        quality_path (Optional[pathlib.Path], optional): path to the per-plate QC Parquet file. Defaults to None (no QC).
+        plate (Optional[str], optional): plate name for the QC metadata (required with `quality_path`). Defaults to None.
+
+    Raises:
+        ValueError: if the z-stack format is not one of ZSTACK_FORMATS or a QC path is given without a plate name
+
+    Returns:
+        Dict[str, int]: number of z-stacks that were written and skipped
+    """
+    if output_format not in ZSTACK_FORMATS:
+        raise ValueError(
+            f"Invalid z-stack format '{output_format}', please choose one of {ZSTACK_FORMATS}"
+        )
+    if quality_path is not None and plate is None:
+        raise ValueError("A plate name is needed to measure the QC metrics")
+
+    # well-sites without QC metrics are rebuilt so their z-slices are measured
+    measured_well_sites = (
+        quality_well_sites(quality_path) if quality_path is not None else set()
+    )
+    build_args = [
+        (
+            well_site,
+            channels,
+            output_dir,
+            overwrite
+            or (quality_path is not None and well_site not in measured_well_sites),
+            max_threads,
+            memory_budget // max_workers,
+            output_format,
+            plate if quality_path is not None else None,
+        )
+        for well_site, channels in groups.items()
+    ]
+
+    written = 0
+    skipped = 0
+    quality_tables = []
+    if max_workers == 1:
+        results = (_build_well_site(*args) for args in build_args)
+        for well_written, well_skipped, quality_table in tqdm.tqdm(
+            results, total=len(groups)
+        ):
+            written += well_written
+            skipped += well_skipped
+            if quality_table is not None:
+                quality_tables.append(quality_table)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_build_well_site, *args) for args in build_args]
+            for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+                well_written, well_skipped, quality_table = future.result()
+                written += well_written
+                skipped += well_skipped
+                if quality_table is not None:
+                    quality_tables.append(quality_table)
+
+    if quality_path is not None:
+        update_quality_table(quality_tables, quality_path)
+    return {"written": written, "skipped": skipped}
+
+
+def build_zstacks_from_acquisition_tree(
+    parent_dir: pathlib.Path,
+    output_dir: pathlib.Path,
+    channel_names: List[str] = CHANNEL_NAMES,
+    overwrite: bool = False,
+    max_workers: int = 1,
+    max_threads: int = 4,
+    memory_budget: int = MEMORY_BUDGET,
+    output_format: str = "tiff",
+    quality_path: Optional[pathlib.Path] = None,
+    plate: Optional[str] = None,
+) -> Dict[str, int]:
+    """
+    This function builds the z-stack images for a plate straight from the nested acquisition tree, so the raw
+    images do not need to be copied into a flattened folder first.
+    The tree is walked once and the z-slices are grouped by well-site (grandparent folder of each image) and channel.
+
+    Args:
+        parent_dir (pathlib.Path): path to the top of the acquisition tree for the plate
+        output_dir (pathlib.Path): path to the z-stack directory for the plate
+        channel_names (List[str], optional): channels to stack. Defaults to CHANNEL_NAMES.
+        overwrite (bool, optional): rebuild z-stacks that are already up to date. Defaults to False.
+        max_workers (int, optional): number of processes used to build well-sites. Defaults to 1.
+        max_threads (int, optional): number of threads per process used to read z-slices. Defaults to 4.
+        memory_budget (int, optional): total memory in bytes for z-stacks held in memory. Defaults to MEMORY_BUDGET.
+        output_format (str, optional): one of ZSTACK_FORMATS. Defaults to "tiff".
+        quality_path (Optional[pathlib.Path], optional): path to the per-plate QC Parquet file. Defaults to None (no QC).
+        plate (Optional[str], optional): plate name for the QC metadata (required with `quality_path`). Defaults to None.
+
+    Returns:
+        Dict[str, int]: number of z-stacks that were written and skipped
+    """
+    images = [
+        (parent_dir / relative_path, well_site)
+        for relative_path, well_site, _, _ in scan_acquisition_tree(parent_dir)
+    ]
+    return build_zstacks(
+        group_zslices(images, channel_names),
+        output_dir,
+        overwrite,
+        max_workers,
+        max_threads,
+        memory_budget,
+        output_format,
+        quality_path,
+        plate,
+    )
+
+
+def build_zstacks_from_catalog(
+    catalog,
+    plate: str,
+    output_dir: pathlib.Path,
+    channel_names: List[str] = CHANNEL_NAMES,
+    well_sites: Optional[List[str]] = None,
+    overwrite: bool = False,
+    max_workers: int = 1,
+    max_threads: int = 4,
+    memory_budget: int = MEMORY_BUDGET,
+    output_format: str = "tiff",
+    quality_path: Optional[pathlib.Path] = None,
+) -> Dict[str, int]:
+    """
+    This function builds the z-stack images for a plate from the flattened raw images listed in the image catalog.
+
+    Args:
+        catalog (ImageCatalog): image catalog that lists the raw images of the plate
+        plate (str): plate name (e.g., "NF0014")
+        output_dir (pathlib.Path): path to the z-stack directory for the plate
+        channel_names (List[str], optional): channels to stack. Defaults to CHANNEL_NAMES.
+        well_sites (Optional[List[str]], optional): only build these well-sites. Defaults to None (all well-sites).
+        overwrite (bool, optional): rebuild z-stacks that are already up to date. Defaults to False.
+        max_workers (int, optional): number of processes used to build well-sites. Defaults to 1.
+        max_threads (int, optional): number of threads per process used to read z-slices. Defaults to 4.
+        memory_budget (int, optional): total memory in bytes for z-stacks held in memory. Defaults to MEMORY_BUDGET.
+        output_format (str, optional): one of ZSTACK_FORMATS. Defaults to "tiff".
+        quality_path (Optional[pathlib.Path], optional): path to the per-plate QC Parquet file. Defaults to None (no QC).
+
+    Returns:
+        Dict[str, int]: number of z-stacks that were written and skipped
+    """
+    raw_images = catalog.query(kind="raw", plate=plate)
+    if well_sites is not None:
+        raw_images = raw_images[raw_images["Metadata_WellSite"].isin(well_sites)]
+    groups = group_zslices(
+        zip(raw_images["path"], raw_images["Metadata_WellSite"]), channel_names
+    )
+    return build_zstacks(
+        groups,
+        output_dir,
+        overwrite,
+        max_workers,
+        max_threads,
+        memory_budget,
+        output_format,
+        quality_path,
+        plate,
+    )
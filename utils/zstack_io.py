@@ -0,0 +1,423 @@
+"""
+This collection of functions writes and reads z-stack images.
+Besides one TIFF per channel, the z-stacks of a well-site can be written as one OME-Zarr store with one chunk per
+channel and z-slice (Blosc/zstd compressed), so reading a few z-slices or one channel only decodes those chunks.
+The reader works with both formats, so the pipeline scripts do not need to know how the z-stacks were written.
+Z-stacks can also be read lazily from the z-slice images (VirtualZStack), which skips the stacking step entirely.
+"""
+
+import os
+import pathlib
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import tifffile
+import zarr
+from image_catalog import FILE_REGEX, get_channel_paths
+from numcodecs import Blosc
+
+# channels (wavelengths) in the z-stack file names
+CHANNEL_NAMES = ["405", "488", "555", "640", "TRANS"]
+
+# formats that z-stacks can be written in
+ZSTACK_FORMATS = ("tiff", "zarr")
+
+# suffix of the OME-Zarr store written inside of each well-site directory (e.g., `C4-2/C4-2.ome.zarr`)
+ZARR_SUFFIX = ".ome.zarr"
+
+# name of the full resolution array in the OME-Zarr store
+ZARR_ARRAY_NAME = "0"
+
+
+def group_zslices(
+    images: Iterable[Tuple[pathlib.Path, str]],
+    channel_names: List[str] = CHANNEL_NAMES,
+    complete_zslices_only: bool = True,
+) -> Dict[str, Dict[str, List[pathlib.Path]]]:
+    """
+    This function groups z-slice images by well-site and channel, sorted by z-slice.
+
+    Args:
+        images (Iterable[Tuple[pathlib.Path, str]]): (path, well-site name) for each z-slice image
+        channel_names (List[str], optional): channels to include. Defaults to CHANNEL_NAMES.
+        complete_zslices_only (bool, optional): only keep z-slices that were imaged in every channel of the well-site
+            (e.g., ZS000 of NF0014 F11-3 is missing the 640 channel). Defaults to True.
+
+    Returns:
+        Dict[str, Dict[str, List[pathlib.Path]]]: z-slice paths per channel for each well-site
+    """
+    file_regex = re.compile(FILE_REGEX)
+    zslices = {}
+    for path, well_site in images:
+        match = file_regex.search(pathlib.Path(path).name)
+        if match is None or match["Zslice"] is None:
+            continue
+        if match["Channel"] not in channel_names:
+            continue
+        zslices.setdefault(well_site, {}).setdefault(match["Channel"], {})[
+            match["Zslice"]
+        ] = pathlib.Path(path)
+
+    groups = {}
+    for well_site, channels in sorted(zslices.items()):
+        if complete_zslices_only:
+            keep = set.intersection(*(set(slices) for slices in channels.values()))
+        else:
+            keep = set.union(*(set(slices) for slices in channels.values()))
+        groups[well_site] = {
+            channel: [slices[zslice] for zslice in sorted(keep) if zslice in slices]
+            for channel, slices in sorted(channels.items())
+        }
+    return groups
+
+
+def read_zslices(slice_paths: List[pathlib.Path], max_threads: int = 4) -> np.ndarray:
+    """
+    This function reads z-slices into one preallocated z-stack array.
+    Slices are read with a thread pool since tifffile releases the GIL while decoding.
+
+    Args:
+        slice_paths (List[pathlib.Path]): paths to the z-slice images, sorted by z-slice
+        max_threads (int, optional): number of threads used to read the z-slices. Defaults to 4.
+
+    Returns:
+        np.ndarray: z-stack with shape (z-slices, height, width)
+    """
+    with tifffile.TiffFile(slice_paths[0]) as tif:
+        page = tif.pages[0]
+        zstack = np.empty((len(slice_paths), *page.shape), dtype=page.dtype)
+
+    def _read(index: int) -> None:
+        zstack[index] = tifffile.imread(slice_paths[index])
+
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        # list() re-raises any error from reading a slice
+        list(executor.map(_read, range(len(slice_paths))))
+    return zstack
+
+
+def zarr_path(output_dir: pathlib.Path, well_site: str) -> pathlib.Path:
+    """
+    This function gets the path to the OME-Zarr store of a well-site.
+
+    Args:
+        output_dir (pathlib.Path): path to the z-stack directory for the plate
+        well_site (str): well-site name (e.g., "C4-2")
+
+    Returns:
+        pathlib.Path: path to the OME-Zarr store
+    """
+    return output_dir / well_site / f"{well_site}{ZARR_SUFFIX}"
+
+
+def write_ome_zarr(
+    channel_slices: Dict[str, List[pathlib.Path]],
+    output_path: pathlib.Path,
+    compression_level: int = 5,
+    on_slice: Optional[Callable[[str, np.ndarray], None]] = None,
+) -> None:
+    """
+    This function writes the z-slices of all channels of a well-site into one OME-Zarr store with axes (c, z, y, x).
+    Each z-slice of each channel is its own chunk, so z-slices are written one at a time and can be read back
+    on their own.
+
+    Args:
+        channel_slices (Dict[str, List[pathlib.Path]]): z-slice paths per channel, sorted by z-slice
+        output_path (pathlib.Path): path to the OME-Zarr store
+        compression_level (int, optional): zstd compression level. Defaults to 5.
+        on_slice (Optional[Callable[[str, np.ndarray], None]], optional): called with the channel and pixels of
+            each z-slice after it is read (e.g., to measure QC metrics without reading the z-slice again). Defaults to None.
+    """
+    channels = list(channel_slices)
+    with tifffile.TiffFile(channel_slices[channels[0]][0]) as tif:
+        page = tif.pages[0]
+        shape, dtype = page.shape, page.dtype
+    depth = max(len(slice_paths) for slice_paths in channel_slices.values())
+
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+    temp_path = output_path.with_name(f".{output_path.name}.partial")
+    if temp_path.exists():
+        shutil.rmtree(temp_path)
+
+    group = zarr.open_group(str(temp_path), mode="w")
+    array = group.create_dataset(
+        ZARR_ARRAY_NAME,
+        shape=(len(channels), depth, *shape),
+        chunks=(1, 1, *shape),
+        dtype=dtype,
+        compressor=Blosc(
+            cname="zstd", clevel=compression_level, shuffle=Blosc.BITSHUFFLE
+        ),
+        fill_value=0,
+    )
+    for channel_index, channel in enumerate(channels):
+        for zslice_index, slice_path in enumerate(channel_slices[channel]):
+            image = tifffile.imread(slice_path)
+            array[channel_index, zslice_index] = image
+            if on_slice is not None:
+                on_slice(channel, image)
+
+    # OME-NGFF metadata so the store can be opened with napari, Fiji, etc.
+    group.attrs["multiscales"] = [
+        {
+            "version": "0.4",
+            "axes": [
+                {"name": "c", "type": "channel"},
+                {"name": "z", "type": "space"},
+                {"name": "y", "type": "space"},
+                {"name": "x", "type": "space"},
+            ],
+            "datasets": [
+                {
+                    "path": ZARR_ARRAY_NAME,
+                    "coordinateTransformations": [
+                        {"type": "scale", "scale": [1.0, 1.0, 1.0, 1.0]}
+                    ],
+                }
+            ],
+        }
+    ]
+    group.attrs["omero"] = {"channels": [{"label": channel} for channel in channels]}
+
+    if output_path.exists():
+        shutil.rmtree(output_path)
+    os.replace(temp_path, output_path)
+
+
+def find_zarr(input_dir: pathlib.Path) -> Optional[pathlib.Path]:
+    """
+    This function finds the OME-Zarr store in a well-site directory.
+
+    Args:
+        input_dir (pathlib.Path): path to the well-site directory
+
+    Returns:
+        Optional[pathlib.Path]: path to the OME-Zarr store (None if the z-stacks are TIFFs)
+    """
+    store = zarr_path(pathlib.Path(input_dir).parent, pathlib.Path(input_dir).name)
+    return store if store.is_dir() else None
+
+
+def zarr_channels(store: pathlib.Path) -> List[str]:
+    """
+    This function reads the channel names from the metadata of an OME-Zarr store.
+
+    Args:
+        store (pathlib.Path): path to the OME-Zarr store
+
+    Returns:
+        List[str]: channel names in the order of the channel axis
+    """
+    group = zarr.open_group(str(store), mode="r")
+    return [channel["label"] for channel in group.attrs["omero"]["channels"]]
+
+
+class VirtualZStack:
+    """
+    This class presents the z-slice images of one channel as a lazy (Z, Y, X) array, so a z-stack can be used
+    without writing it to disk first. Z-slices are decoded when they are indexed and the most recently used
+    z-slices are kept in an LRU cache.
+
+    Args:
+        slice_paths (List[pathlib.Path]): paths to the z-slice images, sorted by z-slice
+        cache_size (int, optional): number of decoded z-slices to keep in memory. Defaults to 16.
+    """
+
+    def __init__(self, slice_paths: List[pathlib.Path], cache_size: int = 16):
+        if not slice_paths:
+            raise ValueError("A virtual z-stack needs at least one z-slice")
+        self.slice_paths = [pathlib.Path(path) for path in slice_paths]
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        with tifffile.TiffFile(self.slice_paths[0]) as tif:
+            page = tif.pages[0]
+            self.shape = (len(self.slice_paths), *page.shape)
+            self.dtype = np.dtype(page.dtype)
+
+    @classmethod
+    def from_directory(
+        cls, input_dir: pathlib.Path, channel: str, cache_size: int = 16
+    ) -> "VirtualZStack":
+        """
+        This function creates a virtual z-stack from the z-slice images in a well-site directory
+        (e.g., `NF0014_raw_images/C4-2/..._405_ZS000.tif`). Only z-slices that were imaged in every channel are used,
+        the same as when the z-stacks are written to disk.
+
+        Args:
+            input_dir (pathlib.Path): path to the well-site directory with the z-slice images
+            channel (str): channel to read (e.g., "405")
+            cache_size (int, optional): number of decoded z-slices to keep in memory. Defaults to 16.
+
+        Returns:
+            VirtualZStack: lazy z-stack for the channel
+        """
+        input_dir = pathlib.Path(input_dir)
+        with os.scandir(input_dir) as entries:
+            images = [
+                (entry.path, input_dir.name) for entry in entries if entry.is_file()
+            ]
+        channels = group_zslices(images).get(input_dir.name, {})
+        if channel not in channels:
+            raise FileNotFoundError(
+                f"No z-slices found for channel {channel} in '{input_dir}'"
+            )
+        return cls(channels[channel], cache_size)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def read_slice(self, index: int) -> np.ndarray:
+        """
+        This function reads one z-slice, from the cache if it was read recently.
+
+        Args:
+            index (int): index of the z-slice
+
+        Returns:
+            np.ndarray: z-slice with shape (height, width)
+        """
+        with self._lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                return self._cache[index]
+        # decode outside of the lock so multiple threads can read z-slices at the same time
+        image = tifffile.imread(self.slice_paths[index])
+        with self._lock:
+            self._cache[index] = image
+            self._cache.move_to_end(index)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return image
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        zkey, rest = key[0], key[1:]
+        if isinstance(zkey, (int, np.integer)):
+            return self.read_slice(range(len(self))[zkey])[rest]
+        if isinstance(zkey, slice):
+            indices = range(len(self))[zkey]
+        else:
+            indices = [range(len(self))[index] for index in zkey]
+        zstack = np.empty((len(indices), *self.shape[1:]), dtype=self.dtype)
+        for position, index in enumerate(indices):
+            zstack[position] = self.read_slice(index)
+        return zstack[(slice(None), *rest)]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        zstack = self[:]
+        return zstack if dtype is None else zstack.astype(dtype)
+
+    def subset(self, zslices: Union[slice, Sequence[int]]) -> "VirtualZStack":
+        """
+        This function selects z-slices of the virtual z-stack without decoding them. The decoded z-slices that are
+        in the selection are shared with the new virtual z-stack.
+
+        Args:
+            zslices (Union[slice, Sequence[int]]): z-slices to select
+
+        Returns:
+            VirtualZStack: lazy z-stack with the selected z-slices
+        """
+        indices = (
+            range(len(self))[zslices] if isinstance(zslices, slice) else list(zslices)
+        )
+        virtual_zstack = VirtualZStack(
+            [self.slice_paths[index] for index in indices], self.cache_size
+        )
+        with self._lock:
+            for position, index in enumerate(indices):
+                if index in self._cache:
+                    virtual_zstack._cache[position] = self._cache[index]
+        return virtual_zstack
+
+
+def read_zstack(
+    input_dir: pathlib.Path,
+    channel: str,
+    zslices: Optional[Union[slice, Sequence[int]]] = None,
+    catalog_path: Optional[pathlib.Path] = None,
+) -> Union[np.ndarray, VirtualZStack]:
+    """
+    This function reads the z-stack of one channel for a well-site, from the OME-Zarr store if there is one,
+    otherwise from the TIFF for the channel. If the directory holds the z-slice images of the well-site
+    (e.g., `NF0014_raw_images/C4-2`), a lazy VirtualZStack of the requested z-slices is returned, which decodes the
+    z-slices when they are indexed (use `np.asarray` to read all of them). Only the requested z-slices are decoded.
+
+    Args:
+        input_dir (pathlib.Path): path to the well-site directory (z-stacks or z-slice images)
+        channel (str): channel to read (e.g., "405")
+        zslices (Optional[Union[slice, Sequence[int]]], optional): z-slices to read. Defaults to None (all z-slices).
+        catalog_path (Optional[pathlib.Path], optional): path to the Parquet image catalog used to find TIFFs. Defaults to None.
+
+    Returns:
+        Union[np.ndarray, VirtualZStack]: z-stack with shape (z-slices, height, width)
+    """
+    store = find_zarr(input_dir)
+    if store is not None:
+        array = zarr.open_group(str(store), mode="r")[ZARR_ARRAY_NAME]
+        channel_index = zarr_channels(store).index(channel)
+        if zslices is None:
+            zslices = slice(None)
+        if isinstance(zslices, slice):
+            return array[channel_index, zslices]
+        return array.get_orthogonal_selection((channel_index, list(zslices)))
+
+    channel_paths = get_channel_paths(input_dir, catalog_path)
+    if (
+        channel not in channel_paths
+        or re.search(FILE_REGEX, channel_paths[channel].name)["Zslice"]
+    ):
+        virtual_zstack = VirtualZStack.from_directory(input_dir, channel)
+        if zslices is None:
+            return virtual_zstack
+        return virtual_zstack.subset(zslices)
+
+    path = channel_paths[channel]
+    if zslices is None:
+        return tifffile.imread(path)
+    # z-stacks are written with one page per z-slice, so only the selected pages are decoded
+    if not isinstance(zslices, slice):
+        zslices = list(zslices)
+    zstack = tifffile.imread(path, key=zslices)
+    return zstack if zstack.ndim == 3 else zstack[np.newaxis]
+
+
+def zstack_mtime(
+    input_dir: pathlib.Path, channel: str, catalog_path: Optional[pathlib.Path] = None
+) -> int:
+    """
+    This function gets the time the z-stack of one channel for a well-site was last modified, from the same files
+    that read_zstack reads (every file of the OME-Zarr store, the TIFF for the channel or its z-slice images).
+
+    Args:
+        input_dir (pathlib.Path): path to the well-site directory (z-stacks or z-slice images)
+        channel (str): channel of the z-stack (e.g., "405")
+        catalog_path (Optional[pathlib.Path], optional): path to the Parquet image catalog used to find TIFFs. Defaults to None.
+
+    Returns:
+        int: latest modification time of the files of the z-stack in nanoseconds
+    """
+    store = find_zarr(input_dir)
+    if store is not None:
+        paths = [path for path in store.rglob("*") if path.is_file()]
+    else:
+        channel_paths = get_channel_paths(input_dir, catalog_path)
+        if (
+            channel not in channel_paths
+            or re.search(FILE_REGEX, channel_paths[channel].name)["Zslice"]
+        ):
+            paths = VirtualZStack.from_directory(input_dir, channel).slice_paths
+        else:
+            paths = [channel_paths[channel]]
+    return max(pathlib.Path(path).stat().st_mtime_ns for path in paths)